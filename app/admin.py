@@ -29,7 +29,8 @@ class CustomUserAdmin(UserAdmin):
 
 
 class TeamAdmin(admin.ModelAdmin):
-    list_display = ('name', 'country', 'value')
+    list_display = ('name', 'country', 'value', 'in_pool')
+    list_filter = ('in_pool', )
 
 
 class PlayerAdmin(admin.ModelAdmin):
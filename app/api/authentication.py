@@ -0,0 +1,73 @@
+import copy
+import hashlib
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from ..cache import TwoLevelCache
+from ..models import Team, User
+
+token_cache = TwoLevelCache('auth_token',
+                            local_size=settings.AUTH_TOKEN_CACHE_LOCAL_SIZE,
+                            local_timeout=settings.AUTH_TOKEN_CACHE_LOCAL_TIMEOUT,
+                            shared_timeout=settings.AUTH_TOKEN_CACHE_TIMEOUT)
+
+
+def token_digest(key):
+    # tokens are credentials, the shared cache only sees their digests
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def cached_user(user):
+    """
+    A copy of the user to cache, without the password hash and without related objects, like the token,
+    whose key is the credential itself. The password is deferred, so it is read from the database if needed
+    and left out of saves
+    """
+    user = copy.copy(user)
+    del user.__dict__['password']
+    user._state.fields_cache.clear()
+    return user
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication which keeps the user of the token in token_cache, keyed by the digest of the token,
+    so most requests are authenticated without the Token and User query.
+    Entries are removed when the token is deleted (logout, user delete), when the user is saved (e.g. role change)
+    and when the user's team is deleted.
+    """
+
+    def authenticate_credentials(self, key):
+        # unknown tokens and inactive users raise AuthenticationFailed in load, and are not cached
+        load = lambda: cached_user(super(CachedTokenAuthentication, self).authenticate_credentials(key)[0])
+        user = token_cache.get_or_load(token_digest(key), load)
+        return user, Token(key=key, user=user)
+
+
+def forget_tokens(keys):
+    # now, and again after the commit, as requests reading the rows before it may have cached them meanwhile
+    digests = [token_digest(key) for key in keys]
+    token_cache.delete(*digests)
+    transaction.on_commit(lambda: token_cache.delete(*digests))
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    forget_tokens([instance.key])
+
+
+@receiver(post_save, sender=User)
+def forget_user_tokens(sender, instance, created=False, **kwargs):
+    if not created:
+        forget_tokens(Token.objects.filter(user_id=instance.pk).values_list('key', flat=True))
+
+
+@receiver(pre_delete, sender=Team)
+def forget_owner_tokens(sender, instance, **kwargs):
+    # the owner's team is set to null by an update, without saving the user
+    forget_tokens(Token.objects.filter(user__team_id=instance.pk).values_list('key', flat=True))
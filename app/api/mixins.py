@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.db import connection
+from rest_framework import status
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+import structlog
+
+from .. import search
+from ..models import User
+from ..profiling import PROFILE_PARAMETER
+
+logger = structlog.get_logger("django_structlog")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryCounter:
+    """Execute wrapper counting the queries run on a connection. Savepoint statements are not counted"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if not sql.lstrip().upper().startswith(('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')):
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+class QueryBudgetMixin:
+    """
+    Counts the SQL queries run while a view handles a request, authentication included.
+    A view running more than its max_queries logs a warning, and raises QueryBudgetExceeded
+    when settings.API_QUERY_BUDGET_STRICT is set, so N+1 regressions fail the tests.
+    """
+    max_queries = None
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.max_queries is None:
+            return super(QueryBudgetMixin, self).dispatch(request, *args, **kwargs)
+
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            response = super(QueryBudgetMixin, self).dispatch(request, *args, **kwargs)
+
+        if counter.count > self.max_queries:
+            logger.warning("query_budget_exceeded", view=self.__class__.__name__, queries=counter.count,
+                           max_queries=self.max_queries)
+            if settings.API_QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded('{view} ran {count} queries, budget is {max_queries}'.format(
+                    view=self.__class__.__name__, count=counter.count, max_queries=self.max_queries))
+
+        return response
+
+
+class OwnershipMixin:
+    """
+    Checks the object permissions (see permissions.IsOwnerOrAdmin) on the team or player a view acts on,
+    and turns a denial into the error message of the view, e.g. 'Can not update other user's team'.
+    """
+    not_owner_message = 'Player not found in your team'
+
+    def ownership_errors(self, obj):
+        if self.request.user.role == User.USER and not self.request.user.team_id:
+            return ['User has no team']
+        try:
+            self.check_object_permissions(self.request, obj)
+        except PermissionDenied:
+            return [self.not_owner_message]
+        return []
+
+
+class SearchMixin:
+    """
+    Search endpoint of a list view, over the search_schema of app.search.
+    Parameters are validated by the schema, then the configured backend answers with a page of rendered results,
+    a Link header to the next page and the X-Search-Backend header.
+    """
+    search_schema = None
+    # query parameters of the pagination, the profiler and the format override of the renderers, not of the search
+    pagination_params = ('cursor', 'page_size', PROFILE_PARAMETER, api_settings.URL_FORMAT_OVERRIDE)
+
+    def get(self, request, *args, **kwargs):
+        error_message = list()
+        try:
+            return super(SearchMixin, self).get(request, *args, **kwargs)
+        except Exception as e:
+            error_message.extend(e.args)
+
+        return Response(data=error_message, status=status.HTTP_400_BAD_REQUEST)
+
+    def get_search_params(self):
+        """Search parameters are read from the request body, or from the query string when there is no body"""
+        if self.request.data:
+            return self.request.data
+        return {key: value for key, value in self.request.query_params.items() if key not in self.pagination_params}
+
+    def get_filters(self):
+        return search.parse_params(self.get_search_params(), self.search_schema)
+
+    def search(self, filters):
+        page_size = self.paginator.get_page_size(self.request)
+        results, next_cursor, backend = search.execute(self.search_schema, filters, page_size,
+                                                       cursor=self.request.query_params.get('cursor'))
+
+        headers = {'X-Search-Backend': backend}
+        if next_cursor:
+            next_link = replace_query_param(self.request.build_absolute_uri(), 'cursor', next_cursor)
+            headers['Link'] = '<{url}>; rel="next"'.format(url=next_link)
+        return Response(results, headers=headers)
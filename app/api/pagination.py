@@ -0,0 +1,29 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination on the primary key, so every page is an index range scan no matter how deep it is.
+    Pages are returned as plain lists to keep the response envelope of app.api.renderers.Renderer unchanged,
+    links with the opaque cursors of the next and previous pages are sent in the Link header.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
+
+    def get_paginated_response(self, data):
+        links = list()
+        next_link = self.get_next_link()
+        if next_link:
+            links.append('<{url}>; rel="next"'.format(url=next_link))
+        previous_link = self.get_previous_link()
+        if previous_link:
+            links.append('<{url}>; rel="prev"'.format(url=previous_link))
+
+        headers = {'Link': ', '.join(links)} if links else None
+        return Response(data, headers=headers)
+
+    def get_paginated_response_schema(self, schema):
+        return schema
@@ -1,5 +1,8 @@
+import ipaddress
+
+from django.conf import settings
 from rest_framework.permissions import BasePermission
-from ..models import User
+from ..models import User, Team
 
 
 class IsAdminRoleUser(BasePermission):
@@ -9,3 +12,34 @@ class IsAdminRoleUser(BasePermission):
 
     def has_permission(self, request, view):
         return bool(request.user and request.user.role == User.ADMIN)
+
+
+class IsAdminRoleUserOrAllowedNetwork(BasePermission):
+    """
+    Allows access to admin role users, and to anyone connecting from METRICS_ALLOWED_NETWORKS.
+    The address is the one of the connection: forwarded headers are not trusted, scrapers must not go through a proxy.
+    """
+
+    def has_permission(self, request, view):
+        if getattr(request.user, 'role', None) == User.ADMIN:
+            return True
+        address = ipaddress.ip_address(request.META['REMOTE_ADDR'])
+        return any(address in ipaddress.ip_network(network) for network in settings.METRICS_ALLOWED_NETWORKS)
+
+
+def owner_team_id(obj):
+    """Id of the team a team or a player belongs to: a team to itself, a player to its team, None for free players"""
+    return obj.pk if isinstance(obj, Team) else obj.team_id
+
+
+class IsOwnerOrAdmin(BasePermission):
+    """
+    Allows admin role users to act on any team or player, and other users only on their own team and its players.
+    Compares team ids of the user and the object, without any query.
+    """
+
+    def has_object_permission(self, request, view, obj):
+        if request.user.role == User.ADMIN:
+            return True
+        team_id = owner_team_id(obj)
+        return team_id is not None and team_id == request.user.team_id
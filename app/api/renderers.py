@@ -1,9 +1,15 @@
 from rest_framework import renderers
 
+from ..instrumentation import RENDER, timed
+
 
 class Renderer(renderers.JSONRenderer):
 
     def render(self, data, media_type=None, renderer_context=None):
+        with timed(RENDER):
+            return self._render(data, media_type, renderer_context)
+
+    def _render(self, data, media_type=None, renderer_context=None):
         success = True if 200 <= renderer_context['response'].status_code < 300 else False
         error_messages = []
         if not success:
@@ -34,3 +40,17 @@ class Renderer(renderers.JSONRenderer):
             'error_messages': error_messages
         }
         return super(Renderer, self).render(resp, media_type, renderer_context)
+
+
+class PrometheusRenderer(renderers.BaseRenderer):
+    """Renders text as it is, and errors as their messages, one per line"""
+    media_type = 'text/plain'
+    format = 'txt'
+    charset = 'utf-8'
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def render(self, data, media_type=None, renderer_context=None):
+        if isinstance(data, str):
+            return data.encode(self.charset)
+        values = data.values() if isinstance(data, dict) else data
+        return '\n'.join(str(value) for value in values).encode(self.charset)
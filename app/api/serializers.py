@@ -8,10 +8,19 @@ from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers, fields
 from rest_framework.exceptions import ValidationError
 
+from ..instrumentation import SERIALIZER, timed
 from ..models import User, Team, Player, TransferList
 
 
-class UserSerializer(serializers.ModelSerializer):
+class TimedMixin:
+    """Adds the time spent rendering the serializer's data to the request's timings"""
+
+    def to_representation(self, instance):
+        with timed(SERIALIZER):
+            return super(TimedMixin, self).to_representation(instance)
+
+
+class UserSerializer(TimedMixin, serializers.ModelSerializer):
     team = serializers.SerializerMethodField('team_name', read_only=True)
     team_id = serializers.SerializerMethodField('team_identifier', read_only=True)
 
@@ -19,7 +28,7 @@ class UserSerializer(serializers.ModelSerializer):
         return obj.team.name if obj.team else ''
 
     def team_identifier(self, obj):
-        return obj.team.id if obj.team else ''
+        return obj.team_id if obj.team_id else ''
 
     class Meta:
         model = User
@@ -88,13 +97,18 @@ class UserLoginSerializer(serializers.Serializer):
         return attrs
 
 
-class PlayerSerializer(serializers.ModelSerializer):
+class PlayerSerializer(TimedMixin, serializers.ModelSerializer):
     price = serializers.DecimalField(decimal_places=2, max_digits=12, default=0, coerce_to_string=False, validators=[MinValueValidator(Decimal('0'))])
 
     def update(self, instance, validated_data):
+        old_price, old_category = instance.price, instance.category
         instance = super(PlayerSerializer, self).update(instance, validated_data)
         if instance.team:
-            instance.team.recalculate_team_value(defer_save=False)
+            deltas = {'value': instance.price - old_price}
+            if instance.category != old_category:
+                deltas[Team.category_counter(old_category)] = -1
+                deltas[Team.category_counter(instance.category)] = 1
+            instance.team.update_counters(**deltas)
 
         return instance
 
@@ -103,7 +117,7 @@ class PlayerSerializer(serializers.ModelSerializer):
         fields = ['id', 'first_name', 'last_name', 'age', 'price', 'country', 'category']
 
 
-class PlayerCreateSerializer(serializers.ModelSerializer):
+class PlayerCreateSerializer(TimedMixin, serializers.ModelSerializer):
     id = serializers.IntegerField(read_only=True)
     price = serializers.DecimalField(decimal_places=2, max_digits=12, default=0, coerce_to_string=False, validators=[MinValueValidator(Decimal('0'))])
 
@@ -119,7 +133,7 @@ class PlayerDeleteSerializer(serializers.ModelSerializer):
         fields = ['id', ]
 
 
-class TeamSerializer(serializers.ModelSerializer):
+class TeamSerializer(TimedMixin, serializers.ModelSerializer):
     value = serializers.DecimalField(read_only=True, decimal_places=2, min_value=0, max_digits=12, coerce_to_string=False, validators=[MinValueValidator(Decimal('0'))])
     budget = serializers.DecimalField(read_only=True, decimal_places=2, min_value=0, max_digits=12, coerce_to_string=False, validators=[MinValueValidator(Decimal('0'))])
     players = PlayerSerializer(many=True, read_only=True)
@@ -129,7 +143,7 @@ class TeamSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'country', 'value', 'budget', 'players']
 
 
-class TeamUpdateSerializer(serializers.ModelSerializer):
+class TeamUpdateSerializer(TimedMixin, serializers.ModelSerializer):
     id = serializers.IntegerField(read_only=True)
     value = serializers.DecimalField(decimal_places=2, min_value=0, max_digits=12, coerce_to_string=False, validators=[MinValueValidator(Decimal('0'))])
     budget = serializers.DecimalField(decimal_places=2, min_value=0, max_digits=12, coerce_to_string=False, validators=[MinValueValidator(Decimal('0'))])
@@ -154,7 +168,7 @@ class TeamDeleteSerializer(serializers.ModelSerializer):
         fields = ['id', ]
 
 
-class TransferListSerializer(serializers.ModelSerializer):
+class TransferListSerializer(TimedMixin, serializers.ModelSerializer):
     player = PlayerSerializer(many=False, read_only=True)
     asking_price = serializers.DecimalField(decimal_places=2, min_value=0, max_digits=12, coerce_to_string=False, validators=[MinValueValidator(Decimal('0'))])
 
@@ -1,7 +1,9 @@
 from django.urls import path, re_path
 from .views import UsersListView, UserRegisterView, UserLoginView, LogoutView, TeamDetailView, TeamUpdateView, \
     PlayerUpdateView, SetPlayerToTransferList, TransferListView, BuyTransferView, UserUpdateView, UserDeleteView, \
-    TeamListView, TeamCreateView, TeamDeleteView, PlayerCreateView, PlayerListView, PlayerDelete, TeamAddPlayerView
+    TeamListView, TeamCreateView, TeamDeleteView, PlayerCreateView, PlayerListView, PlayerDelete, TeamAddPlayerView, \
+    MetricsView, PlayerSearchView, PlayerAutocompleteView, TransferAutocompleteView, \
+    TransferFacetsView, PrometheusMetricsView
 
 urlpatterns = [
     path('user/register', UserRegisterView.as_view(), name='user_register'),
@@ -19,15 +21,21 @@ urlpatterns = [
     path('player/list', PlayerListView.as_view(), name='player_list'),  # only for admin
     path('player/update', PlayerUpdateView.as_view(), name='player_update'),
     path('player/delete', PlayerDelete.as_view(), name='player_delete'),  # only for admin
+    path('player/search', PlayerSearchView.as_view(), name='player_search'),
+    path('player/autocomplete', PlayerAutocompleteView.as_view(), name='player_autocomplete'),
 
     path('transfer/set', SetPlayerToTransferList.as_view(), name='set_player_to_transfer_list'),
     path('transfer/list', TransferListView.as_view(), name='transfer_list'),
+    path('transfer/autocomplete', TransferAutocompleteView.as_view(), name='transfer_autocomplete'),
+    path('transfer/facets', TransferFacetsView.as_view(), name='transfer_facets'),
     path('transfer/buy', BuyTransferView.as_view(), name='transfer_buy'),
 
     # only admin apis
     path('users/', UsersListView.as_view(), name='users_list'),
     path('user/update', UserUpdateView.as_view(), name='user_update'),
     path('user/delete', UserDeleteView.as_view(), name='user_delete'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
+    path('metrics/prometheus', PrometheusMetricsView.as_view(), name='metrics_prometheus'),  # admin or allowed networks
 
 
 
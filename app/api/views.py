@@ -1,4 +1,6 @@
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.cache import patch_cache_control
 from pytz import country_names
 from rest_framework import generics, status, views
 from rest_framework.authtoken.models import Token
@@ -8,29 +10,39 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 
 import structlog
 
-from ..documents import TransferListDocument
-from ..models import User, Team, Player, TransferList
+from .. import metrics, pool, search
+from ..models import User, Team, Player, TransferList, team_cache
 from .serializers import UserSerializer, UserRegisterSerializer, UserLoginSerializer, TeamSerializer, \
     TeamUpdateSerializer, PlayerSerializer, TransferListSerializer, TeamDeleteSerializer, PlayerCreateSerializer, \
     PlayerDeleteSerializer, TeamAddPlayerSerializer
-from .permissions import IsAdminRoleUser
-from .renderers import Renderer
+from .mixins import OwnershipMixin, QueryBudgetMixin, SearchMixin
+from .permissions import IsAdminRoleUser, IsAdminRoleUserOrAllowedNetwork, IsOwnerOrAdmin
+from .renderers import PrometheusRenderer, Renderer
 
 logger = structlog.get_logger("django_structlog")
 
+registrations_counter = metrics.counter('user_registrations_total', 'Registration requests by result (success, failed)')
 
-class UsersListView(generics.ListAPIView):
+
+def own_team(user):
+    """The team of the user from the object cache, None when the user has no team"""
+    return team_cache.get(user.team_id) if user.team_id else None
+
+
+class UsersListView(QueryBudgetMixin, generics.ListAPIView):
     serializer_class = UserSerializer
     permission_classes = [IsAuthenticated, IsAdminRoleUser, ]
+    max_queries = 2
 
     def get_queryset(self):
-        users = User.objects.filter(role=User.USER)
+        users = User.objects.filter(role=User.USER).select_related('team')
         return users
 
 
-class UserRegisterView(generics.CreateAPIView):
+class UserRegisterView(QueryBudgetMixin, generics.CreateAPIView):
     serializer_class = UserRegisterSerializer
     permission_classes = [AllowAny, ]
+    max_queries = 10
 
     def post(self, request, *args, **kwargs):
         error_message = list()
@@ -49,6 +61,7 @@ class UserRegisterView(generics.CreateAPIView):
             error_message.extend(e.args)
 
         if error_message:
+            registrations_counter.inc(result='failed')
             return Response(data=error_message, status=status.HTTP_400_BAD_REQUEST)
 
         return super().post(request, *args, **kwargs)
@@ -61,15 +74,18 @@ class UserRegisterView(generics.CreateAPIView):
             headers = self.get_success_headers(serializer.data)
             user = serializer.instance
             token, created = Token.objects.get_or_create(user=user)
-            team = Team.objects.generate_team(user)
+            team = pool.assign_team(user)
+            registrations_counter.inc(result='success')
             return Response({'token': token.key, 'type': 'user', 'team_id': team.id}, status=status.HTTP_201_CREATED, headers=headers)
         except Exception as e:
+            registrations_counter.inc(result='failed')
             return Response(data=e.args, status=status.HTTP_400_BAD_REQUEST)
 
 
-class UserUpdateView(generics.UpdateAPIView):
+class UserUpdateView(QueryBudgetMixin, generics.UpdateAPIView):
     serializer_class = UserSerializer
     permission_classes = [IsAuthenticated, IsAdminRoleUser, ]
+    max_queries = 5
 
     def update(self, request, *args, **kwargs):
         try:
@@ -104,9 +120,10 @@ class UserUpdateView(generics.UpdateAPIView):
         return user
 
 
-class UserDeleteView(generics.DestroyAPIView):
+class UserDeleteView(QueryBudgetMixin, generics.DestroyAPIView):
     permission_classes = [IsAuthenticated, IsAdminRoleUser, ]
     serializer_class = UserSerializer
+    max_queries = 8
 
     def delete(self, request, *args, **kwargs):
         try:
@@ -135,10 +152,11 @@ class UserDeleteView(generics.DestroyAPIView):
         return user
 
 
-class UserLoginView(ObtainAuthToken):
+class UserLoginView(QueryBudgetMixin, ObtainAuthToken):
     serializer_class = UserLoginSerializer
     permission_classes = [AllowAny, ]
     renderer_classes = (Renderer,)
+    max_queries = 4
 
     def post(self, request, *args, **kwargs):
         error_message = list()
@@ -162,15 +180,14 @@ class UserLoginView(ObtainAuthToken):
         user = serializer.validated_data['user']
         token, created = Token.objects.get_or_create(user=user)
         user_type = 'admin' if user.role == User.ADMIN else 'user'
-        team_id = None
-        if user.team:
-            team_id = user.team.id
+        team_id = user.team_id
         return Response({'token': token.key, 'type': user_type, 'team_id': team_id})
 
 
-class LogoutView(views.APIView):
+class LogoutView(QueryBudgetMixin, views.APIView):
     permission_classes = [IsAuthenticated, ]
     http_method_names = ['post', ]
+    max_queries = 3
 
     def post(self, request, *args, **kwargs):
 
@@ -178,18 +195,21 @@ class LogoutView(views.APIView):
         return Response(status=status.HTTP_200_OK)
 
 
-class TeamListView(generics.ListAPIView):
+class TeamListView(QueryBudgetMixin, generics.ListAPIView):
     serializer_class = TeamUpdateSerializer
     permission_classes = [IsAuthenticated, IsAdminRoleUser, ]
+    max_queries = 2
 
     def get_queryset(self):
-        teams = Team.objects.all()
+        teams = Team.objects.filter(in_pool=False).select_related('owner')
         return teams
 
 
-class TeamDetailView(generics.RetrieveAPIView):
+class TeamDetailView(OwnershipMixin, QueryBudgetMixin, generics.RetrieveAPIView):
     serializer_class = TeamSerializer
-    permission_classes = [IsAuthenticated, ]
+    permission_classes = [IsAuthenticated, IsOwnerOrAdmin, ]
+    max_queries = 4
+    not_owner_message = 'Can not see other user\'s team'
 
     def get(self, request, *args, **kwargs):
         try:
@@ -203,14 +223,8 @@ class TeamDetailView(generics.RetrieveAPIView):
 
         try:
             team_id = self.request.data['id']
-            team = Team.objects.get(id=team_id)
-            if self.request.user.role == User.USER:
-                self_team = self.request.user.team
-                if self_team:
-                    if self_team.id != team.id:
-                        error_message.append('Can not see other user\'s team')
-                else:
-                    error_message.append('User has no team')
+            team = team_cache.get(team_id)
+            error_message.extend(self.ownership_errors(team))
         except KeyError:
             error_message.append('parameter id is not sent')
         except ObjectDoesNotExist:
@@ -224,9 +238,11 @@ class TeamDetailView(generics.RetrieveAPIView):
         return team
 
 
-class TeamUpdateView(generics.UpdateAPIView):
+class TeamUpdateView(OwnershipMixin, QueryBudgetMixin, generics.UpdateAPIView):
     serializer_class = TeamUpdateSerializer
-    permission_classes = [IsAuthenticated, ]
+    permission_classes = [IsAuthenticated, IsOwnerOrAdmin, ]
+    max_queries = 6
+    not_owner_message = 'Can not update other user\'s team'
 
     def update(self, request, *args, **kwargs):
         try:
@@ -242,13 +258,7 @@ class TeamUpdateView(generics.UpdateAPIView):
         try:
             team_id = self.request.data['id']
             team = Team.objects.get(id=team_id)
-            if self.request.user.role == User.USER:
-                self_team = self.request.user.team
-                if self_team:
-                    if self_team.id != team.id:
-                        error_message.append('Can not update other user\'s team')
-                else:
-                    error_message.append('User has no team')
+            error_message.extend(self.ownership_errors(team))
 
             name = self.request.data['name']
             if not name:
@@ -278,9 +288,10 @@ class TeamUpdateView(generics.UpdateAPIView):
         return team
 
 
-class TeamCreateView(generics.CreateAPIView):
+class TeamCreateView(QueryBudgetMixin, generics.CreateAPIView):
     serializer_class = TeamUpdateSerializer
     permission_classes = [IsAuthenticated, IsAdminRoleUser]
+    max_queries = 4
 
     def post(self, request, *args, **kwargs):
         error_message = list()
@@ -309,9 +320,12 @@ class TeamCreateView(generics.CreateAPIView):
         return super().post(request, *args, **kwargs)
 
 
-class TeamDeleteView(generics.DestroyAPIView):
+class TeamDeleteView(QueryBudgetMixin, generics.DestroyAPIView):
     serializer_class = TeamDeleteSerializer
     permission_classes = [IsAuthenticated, IsAdminRoleUser]
+    # measured: token, team, cascade collection (owner, players, listings, 3 x history), owner's tokens,
+    # owner and both history sides set to null, 4 deletes, outbox entry of the listings, begin on SQLite
+    max_queries = 18
 
     def delete(self, request, *args, **kwargs):
         try:
@@ -338,18 +352,21 @@ class TeamDeleteView(generics.DestroyAPIView):
         return team
 
 
-class PlayerListView(generics.ListAPIView):
+class PlayerListView(QueryBudgetMixin, generics.ListAPIView):
     serializer_class = PlayerSerializer
     permission_classes = [IsAuthenticated, IsAdminRoleUser, ]
+    max_queries = 2
 
     def get_queryset(self):
-        players = Player.objects.all()
+        # players of pool teams are not in the game yet, free agents without a team are
+        players = Player.objects.exclude(team__in_pool=True)
         return players
 
 
-class PlayerCreateView(generics.CreateAPIView):
+class PlayerCreateView(QueryBudgetMixin, generics.CreateAPIView):
     serializer_class = PlayerCreateSerializer
     permission_classes = [IsAuthenticated, IsAdminRoleUser]
+    max_queries = 3
 
     def post(self, request, *args, **kwargs):
         error_message = list()
@@ -413,9 +430,10 @@ class PlayerCreateView(generics.CreateAPIView):
         return super(PlayerCreateView, self).post(request, *args, **kwargs)
 
 
-class PlayerDelete(generics.DestroyAPIView):
+class PlayerDelete(QueryBudgetMixin, generics.DestroyAPIView):
     serializer_class = PlayerDeleteSerializer
     permission_classes = [IsAuthenticated, IsAdminRoleUser]
+    max_queries = 6
 
     def delete(self, request, *args, **kwargs):
         try:
@@ -442,9 +460,10 @@ class PlayerDelete(generics.DestroyAPIView):
         return player
 
 
-class PlayerUpdateView(generics.UpdateAPIView):
+class PlayerUpdateView(OwnershipMixin, QueryBudgetMixin, generics.UpdateAPIView):
     serializer_class = PlayerSerializer
-    permission_classes = [IsAuthenticated, ]
+    permission_classes = [IsAuthenticated, IsOwnerOrAdmin, ]
+    max_queries = 8
 
     def update(self, request, *args, **kwargs):
         try:
@@ -492,13 +511,8 @@ class PlayerUpdateView(generics.UpdateAPIView):
         except Exception as e:
             error_message.extend(e.args)
 
-        if self.request.user.role == User.USER:
-            self_team = self.request.user.team
-            if self_team:
-                if player not in self_team.players.all():
-                    error_message.append('Player not found in your team')
-            else:
-                error_message.append('User has no team')
+        if player:
+            error_message.extend(self.ownership_errors(player))
 
         if error_message:
             raise Exception(*error_message)
@@ -506,10 +520,11 @@ class PlayerUpdateView(generics.UpdateAPIView):
         return player
 
 
-class SetPlayerToTransferList(views.APIView):
+class SetPlayerToTransferList(OwnershipMixin, QueryBudgetMixin, views.APIView):
 
-    permission_classes = [IsAuthenticated, ]
+    permission_classes = [IsAuthenticated, IsOwnerOrAdmin, ]
     http_method_names = ['post', ]
+    max_queries = 6
 
     def post(self, request, *args, **kwargs):
         error_message = list()
@@ -526,17 +541,9 @@ class SetPlayerToTransferList(views.APIView):
             else:
                 error_message.append('asking_price must be number')
 
+            # from the database, not player_cache: a copy cached before a sale would let the old owner list the player
             player = Player.objects.get(id=player_id)
-            if request.user.role == User.USER:
-                self_team = request.user.team
-                if self_team:
-                    if player.team:
-                        if player.team.id != self_team.id:
-                            error_message.append('Player not found in your team')
-                    else:
-                        error_message.append('Player not found in your team')
-                else:
-                    error_message.append('User has no teem')
+            error_message.extend(self.ownership_errors(player))
 
         except KeyError as key:
             error_message.append('{param} is not sent'.format(param=key))
@@ -557,86 +564,130 @@ class SetPlayerToTransferList(views.APIView):
         return Response(data=error_message, status=status.HTTP_400_BAD_REQUEST)
 
 
-class TransferListView(generics.ListAPIView):
+class TransferListView(SearchMixin, QueryBudgetMixin, generics.ListAPIView):
     serializer_class = TransferListSerializer
     permission_classes = [IsAuthenticated, ]
+    max_queries = 2
+    search_schema = search.TRANSFERS
+
+    def list(self, request, *args, **kwargs):
+        filters = self.get_filters()
+        if not filters:
+            response = super(TransferListView, self).list(request, *args, **kwargs)
+            response['X-Search-Backend'] = search.DATABASE
+            return response
+
+        # searches are answered from elasticsearch hits alone, paged with search_after,
+        # or by the database while elasticsearch is failing
+        return self.search(filters)
+
+    def get_queryset(self):
+        transfers = TransferList.objects.select_related('player')
+        return transfers
+
+
+class PlayerSearchView(SearchMixin, QueryBudgetMixin, generics.ListAPIView):
+    permission_classes = [IsAuthenticated, ]
+    max_queries = 2
+    search_schema = search.PLAYERS
+
+    def list(self, request, *args, **kwargs):
+        return self.search(self.get_filters())
+
+
+class TransferFacetsView(SearchMixin, QueryBudgetMixin, generics.ListAPIView):
+    """Counts for the filter sidebar of the transfer list, e.g. per category, under the same filters as its search"""
+    permission_classes = [IsAuthenticated, ]
+    max_queries = 5
+    search_schema = search.TRANSFERS
+
+    def list(self, request, *args, **kwargs):
+        facets, backend = search.facets(self.search_schema, self.get_filters())
+        response = Response(facets, headers={'X-Search-Backend': backend})
+        # the facets of the market change slowly, clients may reuse them for as long as the server does
+        patch_cache_control(response, private=True, max_age=settings.SEARCH_FACETS_CACHE_TIMEOUT)
+        return response
+
+
+class AutocompleteView(QueryBudgetMixin, views.APIView):
+    """Player name suggestions for a typed prefix, e.g. ?q=mes&size=5, over the search_schema of app.search"""
+    permission_classes = [IsAuthenticated, ]
+    http_method_names = ['get', ]
+    max_queries = 2
+    search_schema = None
 
     def get(self, request, *args, **kwargs):
-        error_message = list()
         try:
-            if request.data:
-                allowed_params = (
-                    'asking_price', 'player__country', 'player__name', 'player__team__name', 'player__age',
-                    'player__category')
-                m = map(lambda x: x in request.data, allowed_params)
-                m2 = map(lambda x: x in allowed_params, request.data)
-                if any(m) and all(m2):
-                    return super(TransferListView, self).get(request, *args, **kwargs)
-                else:
-                    error_message.append('wrong param is sent')
-            else:
-                return super(TransferListView, self).get(request, *args, **kwargs)
+            prefix, size = search.parse_autocomplete_params(request.query_params)
+            suggestions, backend = search.autocomplete(self.search_schema, prefix, size)
         except Exception as e:
-            error_message.extend(e.args)
+            return Response(data=e.args, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response(data=error_message, status=status.HTTP_400_BAD_REQUEST)
+        return Response(suggestions, status=status.HTTP_200_OK, headers={'X-Search-Backend': backend})
 
-    def get_queryset(self):
-        transfers = None
-        if self.request.data:
-            # elasticsearch
-            s = TransferListDocument.search()
-            for key, value in self.request.data.items():
-                s = s.query("match", **{key: value})
-            # search_result = TransferListDocument.search().filter('match', **self.request.data)
-            # transfers = search_result.to_queryset()
-            transfers = s.to_queryset()
-        else:
-            transfers = TransferList.objects.all()
-        return transfers
+
+class TransferAutocompleteView(AutocompleteView):
+    search_schema = search.TRANSFERS
+
+
+class PlayerAutocompleteView(AutocompleteView):
+    search_schema = search.PLAYERS
 
 
-class BuyTransferView(views.APIView):
+class BuyTransferView(QueryBudgetMixin, views.APIView):
     permission_classes = [IsAuthenticated, ]
     http_method_names = ['post', ]
+    # measured: token, buying team (changed by its previous buy), listing, the transfer (listing and teams locked,
+    # player, both teams, history, listing deleted, one outbox insert) and begin on SQLite or lock_timeout on postgres
+    max_queries = 11
 
     def post(self, request, *args, **kwargs):
         error_message = list()
-        player = None
-        buying_team = request.user.team
-
-        if not buying_team:
-            error_message.append('User has no team')
+        player_id = None
 
         try:
             player_id = request.data['player_id']
-            player = Player.objects.get(id=player_id)
         except KeyError as key:
             error_message.append('{param} is not sent'.format(param=key))
-        except ObjectDoesNotExist:
-            error_message.append('Player not found')
-        except Exception as e:
-            error_message.extend(e.args)
 
         if error_message:
             return Response(data=error_message, status=status.HTTP_400_BAD_REQUEST)
 
-        transfer_offer = player.transfer_offer
-        if transfer_offer:
-            try:
+        # only one buyer at a time gets past the claim, the others are answered without touching the database
+        try:
+            TransferList.claim(player_id)
+        except Exception as e:
+            return Response(data=e.args, status=status.HTTP_400_BAD_REQUEST)
+
+        sold = False
+        try:
+            buying_team = own_team(request.user)
+            if not buying_team:
+                error_message.append('User has no team')
+            else:
+                transfer_offer = TransferList.objects.get(player_id=player_id)
                 transfer_offer.make_transfer(buying_team)
-                return Response(status=status.HTTP_200_OK)
-            except Exception as ex:
-                error_message.extend(ex.args)
-        else:
-            error_message.append('This player is not on Transfer list')
+                sold = True
+        except ObjectDoesNotExist:
+            if not Player.objects.filter(id=player_id).exists():
+                error_message.append('Player not found')
+            else:
+                error_message.append('This player is not on Transfer list')
+        except Exception as ex:
+            error_message.extend(ex.args)
+        finally:
+            TransferList.release(player_id, sold=sold)
+
+        if sold:
+            return Response(status=status.HTTP_200_OK)
 
         return Response(data=error_message, status=status.HTTP_400_BAD_REQUEST)
 
 
-class TeamAddPlayerView(generics.UpdateAPIView):
+class TeamAddPlayerView(QueryBudgetMixin, generics.UpdateAPIView):
     serializer_class = TeamAddPlayerSerializer
     permission_classes = [IsAuthenticated, IsAdminRoleUser, ]
+    max_queries = 6
 
     def update(self, request, *args, **kwargs):
         try:
@@ -663,3 +714,25 @@ class TeamAddPlayerView(generics.UpdateAPIView):
             raise Exception(*error_message)
 
         return team
+
+
+class MetricsView(QueryBudgetMixin, views.APIView):
+    permission_classes = [IsAuthenticated, IsAdminRoleUser, ]
+    http_method_names = ['get', ]
+    max_queries = 4
+
+    def get(self, request, *args, **kwargs):
+        return Response(metrics.collect(), status=status.HTTP_200_OK)
+
+
+class PrometheusMetricsView(QueryBudgetMixin, views.APIView):
+    """The metrics of all workers in the Prometheus text format, for admins and scrapers from METRICS_ALLOWED_NETWORKS"""
+    permission_classes = [IsAdminRoleUserOrAllowedNetwork, ]
+    renderer_classes = [PrometheusRenderer, ]
+    http_method_names = ['get', ]
+    # the token, when not cached, and the computed gauges
+    max_queries = 5
+
+    def get(self, request, *args, **kwargs):
+        return Response(metrics.render_text(metrics.collect()), status=status.HTTP_200_OK,
+                        content_type=PrometheusRenderer.content_type)
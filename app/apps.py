@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        # connects the receivers removing deleted tokens and saved users from the token cache
+        from .api import authentication  # noqa: F401
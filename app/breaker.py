@@ -0,0 +1,64 @@
+import threading
+import time
+
+from . import metrics
+
+breaker_state_gauge = metrics.gauge('circuit_breaker_state', 'State of the circuit breakers of the worker (0 closed, 1 half open, 2 open)')
+breaker_trips_counter = metrics.counter('circuit_breaker_trips_total', 'Circuit breakers opened by name')
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while, in-process, so each worker decides on its own.
+
+    Closed: calls are allowed, failure_threshold consecutive failures open the breaker.
+    Open: calls are refused until reset_timeout seconds passed since it opened.
+    Half open: one probe call is let through, its success closes the breaker and its failure opens it again.
+    A probe that never reports its outcome is replaced by another one after reset_timeout.
+    """
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may be made now. Moves an open breaker to half open when it is time for a probe"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                # restart the timer, so the next probe is only let through if this one does not report
+                self.opened_at = self.clock()
+                self._publish()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._publish()
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    breaker_trips_counter.inc(name=self.name)
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+            self._publish()
+
+    def _publish(self):
+        breaker_state_gauge.set(self.STATE_VALUES[self.state], name=self.name)
@@ -0,0 +1,173 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from . import metrics
+
+cache_requests_counter = metrics.counter('cache_requests_total', 'Two-level cache lookups by cache and tier answering them (local, shared, miss)')
+
+
+class TwoLevelCache:
+    """
+    A bounded in-process LRU in front of the shared cache, for values read on most requests.
+
+    Every key has a version number in the shared cache, and values are stored with the version they were loaded under.
+    delete() bumps the versions, so values loaded before it are never served again from the shared cache,
+    even when they are written after it by a request that read the database earlier.
+    Versions are read with a generation of the whole cache, which clear() bumps to outdate every key at once.
+
+    Values are kept local_timeout seconds in the process and shared_timeout seconds in the shared cache.
+    With verify_local, a local hit still reads the version of the key, so deletes are seen at once by every worker
+    and the local tier only saves transferring and unpickling the value. Without it, local hits cost nothing
+    and other workers may serve a deleted value for up to local_timeout seconds.
+    Local values are kept pickled, each lookup gets its own copy.
+    """
+
+    def __init__(self, name, local_size, local_timeout, shared_timeout, verify_local=True, clock=time.monotonic):
+        self.name = name
+        self.local_size = local_size
+        self.local_timeout = local_timeout
+        self.shared_timeout = shared_timeout
+        self.verify_local = verify_local
+        self.clock = clock
+        # key -> (version, pickled value, expires at), least recently used first
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def shared_key(self, key):
+        return '{name}:{key}'.format(name=self.name, key=key)
+
+    def version_key(self, key):
+        return '{name}:version:{key}'.format(name=self.name, key=key)
+
+    def generation_key(self):
+        return '{name}:generation'.format(name=self.name)
+
+    @staticmethod
+    def current_version(shared, key):
+        """The version in shared, the values read from the shared cache, started when it is missing"""
+        if shared.get(key) is None:
+            # started from the clock, so a version evicted from the shared cache is not reused
+            cache.add(key, time.time_ns(), None)
+            shared[key] = cache.get(key)
+        return shared[key]
+
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            if entry[2] <= self.clock():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return entry
+
+    def _local_set(self, key, version, value):
+        with self._lock:
+            self._local[key] = (version, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self.clock() + self.local_timeout)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def _local_hit(self, entry):
+        cache_requests_counter.inc(cache=self.name, result='local')
+        return pickle.loads(entry[1])
+
+    def get_or_load(self, key, load):
+        """
+        The value of key, or the result of load() which is then cached. Nothing is cached when load returns None.
+        The version is read before load() runs, so a value deleted while it was loaded is stored as outdated.
+        """
+        entry = self._local_get(key)
+        if entry is not None and not self.verify_local:
+            return self._local_hit(entry)
+
+        generation_key, version_key, shared_key = self.generation_key(), self.version_key(key), self.shared_key(key)
+        if entry is not None:
+            versions = cache.get_many([generation_key, version_key])
+            if (versions.get(generation_key), versions.get(version_key)) == entry[0]:
+                return self._local_hit(entry)
+
+        shared = cache.get_many([generation_key, version_key, shared_key])
+        version = (self.current_version(shared, generation_key), self.current_version(shared, version_key))
+
+        stored = shared.get(shared_key)
+        if stored is not None and stored[0] == version:
+            cache_requests_counter.inc(cache=self.name, result='shared')
+            self._local_set(key, version, stored[1])
+            return stored[1]
+
+        cache_requests_counter.inc(cache=self.name, result='miss')
+        value = load()
+        if value is not None:
+            cache.set(shared_key, (version, value), self.shared_timeout)
+            self._local_set(key, version, value)
+        return value
+
+    def delete(self, *keys):
+        for key in keys:
+            try:
+                cache.incr(self.version_key(key))
+            except ValueError:
+                # no version means nothing was cached under the key
+                pass
+        self.forget_local(*keys)
+
+    def clear(self):
+        """Outdate the values of every key"""
+        try:
+            cache.incr(self.generation_key())
+        except ValueError:
+            # no generation means nothing was cached
+            pass
+        with self._lock:
+            self._local.clear()
+
+    def forget_local(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+
+class ObjectCache:
+    """
+    Read-through cache of the instances of a model by primary key, for read-only point lookups.
+    Instances are invalidated when they are saved or deleted, and by invalidate() after changes that send no signal,
+    like queryset updates. Do not save a cached instance: it may be a few seconds old.
+    """
+
+    def __init__(self, model, local_size, local_timeout, shared_timeout):
+        self.model = model
+        self.cache = TwoLevelCache('objects:{model}'.format(model=model._meta.label_lower), local_size, local_timeout,
+                                   shared_timeout, verify_local=False)
+        post_save.connect(self.handle_change, sender=model, weak=False)
+        post_delete.connect(self.handle_change, sender=model, weak=False)
+
+    def get(self, pk):
+        """The instance with the primary key. Raises DoesNotExist like Model.objects.get"""
+        # '7' and 7 share an entry, wrong values raise like a query filtering by them
+        pk = self.model._meta.pk.get_prep_value(pk)
+        instance = self.cache.get_or_load(pk, lambda: self.model.objects.filter(pk=pk).first())
+        if instance is None:
+            raise self.model.DoesNotExist('{model} matching query does not exist.'.format(model=self.model._meta.object_name))
+        return instance
+
+    def invalidate(self, *pks):
+        # now, so the changing transaction does not read old copies, and again after the commit,
+        # as requests reading the rows before it may have cached them meanwhile
+        self.cache.delete(*pks)
+        transaction.on_commit(lambda: self.cache.delete(*pks))
+
+    def invalidate_all(self):
+        """Like invalidate, for every instance, after updates of the whole table"""
+        self.cache.clear()
+        transaction.on_commit(self.cache.clear)
+
+    def handle_change(self, sender, instance, **kwargs):
+        self.invalidate(instance.pk)
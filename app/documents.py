@@ -59,18 +59,25 @@ class PlayerDocument(Document):
 
 @registry.register_document
 class TransferListDocument(Document):
+    # everything TransferListSerializer renders is stored, so searches can be answered from _source alone
+    id = fields.IntegerField(attr='id')
     player = fields.ObjectField(properties={
-        # 'first_name': fields.TextField(),
-        # 'last_name': fields.TextField(),
+        'id': fields.IntegerField(),
+        'first_name': fields.TextField(),
+        'last_name': fields.TextField(),
         'name': fields.TextField(attr='name'),
-        'country': fields.TextField(),
+        # exact codes, filtered with term queries
+        'country': fields.KeywordField(),
         'age': fields.IntegerField(),
-        'category': fields.TextField(),
+        'category': fields.KeywordField(),
+        'price': fields.DoubleField(),
         'team': fields.ObjectField(properties={
                 'name': fields.TextField(),
-                'country': fields.TextField(),
+                'country': fields.KeywordField(),
             })
     })
+    # prefixes of the player name for autocomplete, completion suggestions are served from memory
+    name_suggest = fields.CompletionField()
 
     class Index:
         # Name of the elastic search index
@@ -89,6 +96,13 @@ class TransferListDocument(Document):
 
         related_models = [Player, ]
 
+        # Model fields read by the document, saves changing none of them are not sent to Elasticsearch
+        # (see app.signals.ChangeAwareSignalProcessor)
+        tracked_fields = {
+            TransferList: ['asking_price', 'player'],
+            Player: ['first_name', 'last_name', 'country', 'age', 'category', 'price', 'team'],
+        }
+
         # Ignore auto updating of Elasticsearch when a model is saved
         # or deleted:
         # ignore_signals = True
@@ -100,10 +114,14 @@ class TransferListDocument(Document):
         # (by default it uses the database driver's default setting)
         # queryset_pagination = 5000
 
+    def prepare_name_suggest(self, instance):
+        # typing the last name alone suggests the player too
+        return [instance.player.name, instance.player.last_name]
+
     def get_queryset(self):
         """Not mandatory but to improve performance we can select related in one sql request"""
         return super(TransferListDocument, self).get_queryset().select_related(
-            'player'
+            'player', 'player__team'
         )
 
     def get_instances_from_related(self, related_instance):
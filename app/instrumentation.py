@@ -0,0 +1,311 @@
+import contextvars
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.dispatch import receiver
+from django_structlog.signals import bind_extra_request_finished_metadata
+from elasticsearch import Transport
+from elasticsearch_dsl.connections import connections as es_connections
+
+import structlog
+
+from . import metrics
+
+logger = structlog.get_logger("django_structlog")
+
+request_duration_histogram = metrics.histogram('http_request_duration_seconds', 'Request latency by view, method and status')
+request_queries_histogram = metrics.histogram('http_request_db_queries', 'SQL queries made by requests by view',
+                                              buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+elasticsearch_duration_histogram = metrics.histogram('elasticsearch_request_duration_seconds', 'Elasticsearch request latency by method')
+slow_queries_counter = metrics.counter('db_slow_queries_total', 'SQL queries slower than SLOW_QUERY_THRESHOLD_MS by view')
+
+# timings of the request handled by the current thread, None outside of requests
+current_timings = contextvars.ContextVar('request_timings', default=None)
+
+# Server-Timing metric names, in the order of the header
+DB = 'db'
+ES = 'es'
+SERIALIZER = 'serializer'
+RENDER = 'render'
+
+
+class RequestTimings:
+    """Time spent, and number of calls, per kind of work of one request, with the text of its first queries"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.queries = list()
+        # (connection alias, sql, params, seconds) of the queries slower than SLOW_QUERY_THRESHOLD_MS
+        self.slow_queries = list()
+        self._depth = defaultdict(int)
+
+    def record(self, kind, seconds, text=None):
+        self.seconds[kind] += seconds
+        self.counts[kind] += 1
+        if text is not None and len(self.queries) < settings.SLOW_REQUEST_MAX_QUERIES:
+            self.queries.append({'kind': kind, 'ms': round(seconds * 1000, 2), 'text': text[:settings.SLOW_REQUEST_MAX_QUERY_LENGTH]})
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def context(self):
+        """Fields bound to the request's log entries"""
+        return {
+            'sql_queries': self.counts[DB], 'sql_ms': round(self.seconds[DB] * 1000, 2),
+            'es_calls': self.counts[ES], 'es_ms': round(self.seconds[ES] * 1000, 2),
+            'serializer_ms': round(self.seconds[SERIALIZER] * 1000, 2),
+            'render_ms': round(self.seconds[RENDER] * 1000, 2),
+            'duration_ms': round(self.elapsed() * 1000, 2),
+        }
+
+    def server_timing(self):
+        metrics = ['{kind};dur={ms:.2f};desc="{count} calls"'.format(kind=kind, ms=self.seconds[kind] * 1000, count=self.counts[kind])
+                   for kind in (DB, ES)]
+        metrics += ['{kind};dur={ms:.2f}'.format(kind=kind, ms=self.seconds[kind] * 1000) for kind in (SERIALIZER, RENDER)]
+        metrics.append('total;dur={ms:.2f}'.format(ms=self.elapsed() * 1000))
+        return ', '.join(metrics)
+
+
+@contextmanager
+def timed(kind):
+    """Add the time of the block to the current request. Nested blocks of the same kind are counted once"""
+    timings = current_timings.get()
+    if timings is None or timings._depth[kind]:
+        yield
+        return
+
+    timings._depth[kind] += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings._depth[kind] -= 1
+        timings.record(kind, time.perf_counter() - started)
+
+
+class QueryTimer:
+    """Execute wrapper timing the SQL queries of a request"""
+
+    def __init__(self, timings):
+        self.timings = timings
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - started
+            # parameters are left out, they may hold emails, tokens or passwords
+            self.timings.record(DB, seconds, sql)
+            if not many and seconds * 1000 >= settings.SLOW_QUERY_THRESHOLD_MS \
+                    and len(self.timings.slow_queries) < settings.SLOW_REQUEST_MAX_QUERIES:
+                self.timings.slow_queries.append((context['connection'].alias, sql, params, seconds))
+
+
+EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+IN_LIST = re.compile(r'IN \((%s, )*%s\)')
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def fingerprint(sql):
+    """The same for queries differing only by their parameters, including the length of IN lists"""
+    normalized = IN_LIST.sub('IN (...)', ' '.join(sql.split()))
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+
+def redact(plan):
+    """The plan with the string constants of its conditions replaced, they are the query's parameters"""
+    if isinstance(plan, dict):
+        return {key: redact(value) for key, value in plan.items()}
+    if isinstance(plan, list):
+        return [redact(value) for value in plan]
+    if isinstance(plan, str):
+        return STRING_LITERAL.sub("'?'", plan)
+    return plan
+
+
+def explain(alias, sql, params):
+    """
+    The postgres plan of the query, without running it. Runs on the thread of PlanExplainer, whose connections
+    are its own, so the request's transaction, possibly broken, and its query counts are left alone.
+    The connection is kept open for the next plans
+    """
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (ANALYZE off, FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+    except Exception:
+        # it may be broken, the next plan connects again
+        connection.close()
+        raise
+    return json.loads(plan) if isinstance(plan, str) else plan
+
+
+def log_plan(view, alias, sql, params, seconds, query_fingerprint):
+    try:
+        plan = redact(explain(alias, sql, params))
+    except Exception as e:
+        logger.warning("slow_query_explain_failed", view=view, fingerprint=query_fingerprint, error=str(e))
+        return
+    logger.warning("slow_query_plan", view=view, fingerprint=query_fingerprint, ms=round(seconds * 1000, 2),
+                   sql=sql[:settings.SLOW_REQUEST_MAX_QUERY_LENGTH], plan=plan)
+
+
+class PlanExplainer:
+    """
+    Explains slow queries on a thread of its own, started in each process on first use, so requests never wait
+    for the plans. Queries submitted while size of them are waiting are dropped
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, view, alias, sql, params, seconds, query_fingerprint):
+        """Queue the query, False when it was dropped"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # threads do not survive the fork of the workers
+                self._pid, self._queue = os.getpid(), queue.Queue(self.size)
+                threading.Thread(target=self._run, args=(self._queue, ), name='plan-explainer', daemon=True).start()
+        try:
+            self._queue.put_nowait((view, alias, sql, params, seconds, query_fingerprint))
+        except queue.Full:
+            return False
+        return True
+
+    def join(self):
+        """Wait until the queued queries are explained"""
+        if self._queue is not None:
+            self._queue.join()
+
+    @staticmethod
+    def _run(jobs):
+        while True:
+            job = jobs.get()
+            try:
+                log_plan(*job)
+            finally:
+                jobs.task_done()
+
+
+plan_explainer = PlanExplainer(settings.SLOW_QUERY_EXPLAIN_QUEUE_SIZE)
+
+
+def explain_slow_queries(view, slow_queries):
+    """
+    Log the plans of slow queries, once per query fingerprint every SLOW_QUERY_EXPLAIN_INTERVAL seconds over all workers,
+    so a query made slow by e.g. a missing index is logged soon without flooding the log with it.
+    The plans are logged by plan_explainer, after the response was sent
+    """
+    for alias, sql, params, seconds in slow_queries:
+        slow_queries_counter.inc(view=view)
+        if connections[alias].vendor != 'postgresql' or not EXPLAINABLE.match(sql):
+            continue
+        query_fingerprint = fingerprint(sql)
+        if not cache.add('slow_query_plan:{fingerprint}'.format(fingerprint=query_fingerprint), True,
+                         settings.SLOW_QUERY_EXPLAIN_INTERVAL):
+            continue
+        if not plan_explainer.submit(view, alias, sql, params, seconds, query_fingerprint):
+            logger.warning("slow_query_explain_dropped", view=view, fingerprint=query_fingerprint)
+
+
+class InstrumentedTransport(Transport):
+    """
+    Elasticsearch transport observing the latency of every request,
+    and adding the time of those made while handling a request to its timings
+    """
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        started = time.perf_counter()
+        try:
+            return super(InstrumentedTransport, self).perform_request(method, url, headers, params, body)
+        finally:
+            seconds = time.perf_counter() - started
+            elasticsearch_duration_histogram.observe(seconds, method=method)
+            timings = current_timings.get()
+            if timings is not None:
+                text = '{method} {url}'.format(method=method, url=url)
+                if body is not None:
+                    text += ' ' + (body if isinstance(body, str) else json.dumps(body, default=str))
+                timings.record(ES, seconds, text)
+
+
+def instrument_elasticsearch():
+    """Make the elasticsearch connections of ELASTICSEARCH_DSL use InstrumentedTransport"""
+    es_connections.configure(**{
+        alias: dict(options, transport_class=InstrumentedTransport) for alias, options in settings.ELASTICSEARCH_DSL.items()
+    })
+
+
+@receiver(bind_extra_request_finished_metadata)
+def add_request_timings(request, logger, log_kwargs=None, **kwargs):
+    """Adds the totals of InstrumentationMiddleware to request_finished, and to no other log entry of the thread"""
+    context = getattr(request, 'timings', None)
+    if context is None:
+        return
+    if log_kwargs is not None:
+        log_kwargs.update(context)
+    else:
+        # older django_structlog versions log request_finished with the bound context, restored after the request
+        logger.bind(**context)
+
+
+class InstrumentationMiddleware:
+    """
+    Times the SQL queries, elasticsearch requests, serializers and rendering of every request.
+    The totals are added to request_finished of django_structlog's RequestMiddleware, which must come before
+    this middleware, and to slow_request, and sent in the Server-Timing header.
+    Requests slower than SLOW_REQUEST_THRESHOLD_MS are logged with the text of their queries.
+    Latency and query count histograms are kept by view, and shared with the other workers.
+    The plans of queries slower than SLOW_QUERY_THRESHOLD_MS are logged once the response is ready.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # after django_elasticsearch_dsl configured the connections from the settings, when the apps were ready
+        instrument_elasticsearch()
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(QueryTimer(timings)))
+                response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+
+        context = request.timings = timings.context()
+        # url names, so the number of label values does not grow with the urls requested
+        view = request.resolver_match.url_name if request.resolver_match else None
+        view = view or 'unmatched'
+        request_duration_histogram.observe(context['duration_ms'] / 1000, view=view, method=request.method,
+                                           status=response.status_code)
+        request_queries_histogram.observe(context['sql_queries'], view=view)
+        explain_slow_queries(view, timings.slow_queries)
+        metrics.flush()
+
+        if settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = timings.server_timing()
+
+        if context['duration_ms'] >= settings.SLOW_REQUEST_THRESHOLD_MS:
+            logger.warning("slow_request", method=request.method, path=request.path, status=response.status_code,
+                           queries=timings.queries, **context)
+        return response
@@ -0,0 +1,180 @@
+import json
+import os
+import statistics
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+import structlog
+
+from ...api.mixins import QueryCounter
+from ...api.renderers import Renderer
+from ...api.serializers import TeamSerializer, TransferListSerializer
+from ...api.views import TransferListView
+from ...models import User, Team, TransferList
+from .benchmark_search import generate_dataset
+
+logger = structlog.get_logger("django_structlog")
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Descriptions of the cases of results slower than their baseline by more than tolerance (0.2 for 20%),
+    in p50 latency or operations per second, or running more queries. p99 is too noisy to fail on
+    """
+    found = list()
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['queries'] > base['queries']:
+            found.append('{name}: {queries} queries, baseline {base}'.format(name=name, queries=result['queries'], base=base['queries']))
+        if result['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            found.append('{name}: p50 {value:.2f} ms, baseline {base:.2f} ms'.format(name=name, value=result['p50_ms'], base=base['p50_ms']))
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            found.append('{name}: {value:.1f} ops/sec, baseline {base:.1f}'.format(name=name, value=result['ops_per_sec'], base=base['ops_per_sec']))
+    return found
+
+
+class Command(BaseCommand):
+    help = ('Measure the core operations (team generation, transfers, team values, serializing, the transfer list, '
+            'rendering) and compare them with a stored baseline, failing on regressions. '
+            'Everything done by the benchmarks is rolled back. '
+            'With --teams, a reproducible dataset is generated first: run it against a scratch database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--teams', type=int, default=0,
+                            help='Number of teams to generate before benchmarking, 0 to use the existing data')
+        parser.add_argument('--listed', type=float, default=0.1,
+                            help='Share of the generated players put on the transfer list')
+        parser.add_argument('--seed', type=int, default=1,
+                            help='Seed of the generated dataset')
+        parser.add_argument('--repeat', type=int, default=50,
+                            help='Runs of each benchmark')
+        parser.add_argument('--only', default='',
+                            help='Comma separated benchmarks to run, all by default')
+        parser.add_argument('--render-size', type=int, default=1000,
+                            help='Transfer listings in the payload of the render benchmark')
+        parser.add_argument('--baseline', default=settings.BENCHMARK_BASELINE,
+                            help='JSON file with the results to compare with')
+        parser.add_argument('--tolerance', type=float, default=settings.BENCHMARK_TOLERANCE,
+                            help='Allowed slowdown against the baseline, 0.2 for 20%%')
+        parser.add_argument('--save', action='store_true',
+                            help='Store the results as the new baseline instead of comparing')
+
+    def benchmarks(self, render_size):
+        """name -> (setup, operation): setup runs before every run and is not measured, its result is passed to operation"""
+        teams = list(Team.objects.order_by('id')[:2])
+        if len(teams) < 2 or not TransferList.objects.exists():
+            raise CommandError('There is not enough data, generate a dataset with --teams')
+
+        user = User.objects.create_user(email='benchmark@example.com', password=None)
+        factory = APIRequestFactory()
+        transfer_list_view = TransferListView.as_view()
+        payload = TransferListSerializer(TransferList.objects.select_related('player').order_by('id')[:render_size], many=True).data
+        runs = {'transfer': 0}
+
+        def listed_player():
+            # players go back and forth between the two teams, so the squads never run out,
+            # the cheapest first as every transfer raises the price of the player
+            seller, buyer = teams if runs['transfer'] % 2 == 0 else reversed(teams)
+            runs['transfer'] += 1
+            player = seller.players.filter(transfer_offer__isnull=True).order_by('price', 'id').first()
+            return TransferList.objects.create(player=player, asking_price=Decimal('1')), buyer
+
+        def transfer_list_request():
+            # the next page link needs an allowed host
+            request = factory.get('/api/transfer/list', HTTP_HOST=settings.ALLOWED_HOSTS[0].lstrip('.'))
+            force_authenticate(request, user=user)
+            return request,
+
+        def transfer_list(request):
+            response = transfer_list_view(request).render()
+            if response.status_code != 200:
+                raise CommandError('The transfer list answered {status}: {content}'.format(
+                    status=response.status_code, content=response.content.decode()))
+
+        return {
+            'generate_team': (None, lambda: Team.objects.generate_team()),
+            'make_transfer': (listed_player, lambda listing, buyer: listing.make_transfer(buyer)),
+            'recalculate_team_value': (None, lambda: teams[0].recalculate_team_value()),
+            'serialize_team': (lambda: (Team.objects.prefetch_related('players').get(pk=teams[0].pk), ),
+                               lambda team: TeamSerializer(team).data),
+            'transfer_list_view': (transfer_list_request, transfer_list),
+            'render_transfer_list': (None, lambda: Renderer().render(payload, renderer_context={'response': Response()})),
+        }
+
+    @staticmethod
+    def measure(setup, operation, repeat):
+        # once unmeasured, to warm up caches and connections
+        operation(*(setup() if setup else ()))
+
+        timings, queries = list(), list()
+        for _ in range(repeat):
+            args = setup() if setup else ()
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                started = time.perf_counter()
+                operation(*args)
+                timings.append(time.perf_counter() - started)
+            queries.append(counter.count)
+
+        timings.sort()
+        return {
+            'ops_per_sec': round(len(timings) / sum(timings), 2),
+            'p50_ms': round(timings[len(timings) // 2] * 1000, 3),
+            'p99_ms': round(timings[min(int(len(timings) * 0.99), len(timings) - 1)] * 1000, 3),
+            'mean_ms': round(statistics.mean(timings) * 1000, 3),
+            'queries': max(queries),
+        }
+
+    def handle(self, *args, **options):
+        if options['teams']:
+            generate_dataset(options['teams'], options['listed'], options['seed'])
+
+        only = [name for name in options['only'].split(',') if name]
+        results = dict()
+        with transaction.atomic():
+            benchmarks = self.benchmarks(options['render_size'])
+            unknown = set(only) - set(benchmarks)
+            if unknown:
+                raise CommandError('Unknown benchmarks: {names}'.format(names=', '.join(sorted(unknown))))
+
+            self.stdout.write('{name:<24} {ops:>10} {p50:>9} {p99:>9} {queries:>8}'.format(
+                name='benchmark', ops='ops/sec', p50='p50 ms', p99='p99 ms', queries='queries'))
+            for name, (setup, operation) in benchmarks.items():
+                if only and name not in only:
+                    continue
+                result = results[name] = self.measure(setup, operation, options['repeat'])
+                logger.info("benchmark", benchmark=name, **result)
+                self.stdout.write('{name:<24} {ops_per_sec:>10.1f} {p50_ms:>9.3f} {p99_ms:>9.3f} {queries:>8}'.format(name=name, **result))
+            transaction.set_rollback(True)
+
+        if options['save']:
+            os.makedirs(os.path.dirname(options['baseline']) or '.', exist_ok=True)
+            with open(options['baseline'], 'w') as f:
+                json.dump({'database': connection.vendor, 'repeat': options['repeat'], 'created': timezone.now().isoformat(),
+                           'benchmarks': results}, f, indent=2, sort_keys=True)
+            self.stdout.write('Baseline saved to {path}'.format(path=options['baseline']))
+            return
+
+        if not os.path.exists(options['baseline']):
+            self.stdout.write('No baseline at {path}, store one with --save'.format(path=options['baseline']))
+            return
+
+        with open(options['baseline']) as f:
+            baseline = json.load(f)
+        if baseline['database'] != connection.vendor:
+            raise CommandError('The baseline was measured on {database}, not {vendor}'.format(
+                database=baseline['database'], vendor=connection.vendor))
+
+        found = regressions(results, baseline['benchmarks'], options['tolerance'])
+        if found:
+            raise CommandError('Regressions past {tolerance:.0%}:\n{found}'.format(tolerance=options['tolerance'], found='\n'.join(found)))
+        self.stdout.write(self.style.SUCCESS('No regressions past {tolerance:.0%}'.format(tolerance=options['tolerance'])))
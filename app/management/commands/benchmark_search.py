@@ -0,0 +1,98 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+import structlog
+
+from ... import reindex, search
+from ...documents import TransferListDocument
+from ...models import Player, Team, TransferList
+from ...sampler import Sampler
+
+logger = structlog.get_logger("django_structlog")
+
+
+def generate_dataset(teams, listed, seed):
+    """Generate teams with full squads and put a share of their players on the transfer list, the same for a seed"""
+    generated = Team.objects.generate_teams(teams, sampler=Sampler(seed))
+    players = list(Player.objects.filter(team__in=generated).order_by('id').values_list('id', 'price'))
+    listed_players = random.Random(seed).sample(players, int(len(players) * listed))
+    # listed directly, elasticsearch gets them from a full reindex
+    TransferList.objects.bulk_create([
+        TransferList(player_id=player_id, asking_price=price * 2) for player_id, price in listed_players
+    ])
+
+
+class Command(BaseCommand):
+    help = ('Compare the latency of the search backends on the same queries. '
+            'With --teams, a reproducible dataset is generated first: run it against a scratch database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backends', default='elasticsearch,postgres,database',
+                            help='Comma separated backends to compare')
+        parser.add_argument('--teams', type=int, default=0,
+                            help='Number of teams to generate before benchmarking, 0 to use the existing data')
+        parser.add_argument('--listed', type=float, default=0.1,
+                            help='Share of the generated players put on the transfer list')
+        parser.add_argument('--seed', type=int, default=1,
+                            help='Seed of the generated dataset')
+        parser.add_argument('--repeat', type=int, default=50,
+                            help='Runs of each query per backend')
+        parser.add_argument('--page-size', type=int, default=100)
+
+    def seed(self, teams, listed, seed, backends):
+        generate_dataset(teams, listed, seed)
+        if search.ELASTICSEARCH in [backend.name for backend in backends]:
+            reindex.reindex(TransferListDocument._index)
+
+    @staticmethod
+    def queries():
+        """Transfer list searches, from plain filters to full text, using words that exist in the data"""
+        listing = TransferList.objects.select_related('player__team').order_by('id').first()
+        if not listing:
+            raise CommandError('There is nothing to search, generate a dataset with --teams')
+
+        return {
+            'category': {'player__category': 'DEF'},
+            'country_and_price': {'player__country': listing.player.country, 'asking_price__lte': listing.asking_price * 2},
+            'age_range_ordered': {'player__age__gte': 20, 'player__age__lt': 30, 'ordering': '-asking_price'},
+            'player_name': {'player__name': listing.player.first_name},
+            'team_name': {'player__team__name': listing.player.team.name.split()[-1]},
+        }
+
+    def handle(self, *args, **options):
+        backends = [search.get_backend(name) for name in options['backends'].split(',')]
+        if options['teams']:
+            self.seed(options['teams'], options['listed'], options['seed'], backends)
+
+        queries = self.queries()
+        self.stdout.write('{query:<20} {backend:<14} {mean:>9} {p50:>9} {p95:>9} {results:>8}'.format(
+            query='query', backend='backend', mean='mean ms', p50='p50 ms', p95='p95 ms', results='results'))
+
+        for query_name, params in queries.items():
+            filters = search.parse_params(params)
+            for backend in backends:
+                try:
+                    # warm up caches and connections
+                    results, _ = backend.search(search.TRANSFERS, filters, options['page_size'])
+                except Exception as e:
+                    self.stdout.write('{query:<20} {backend:<14} failed: {error}'.format(
+                        query=query_name, backend=backend.name, error=e))
+                    continue
+
+                timings = list()
+                for _ in range(options['repeat']):
+                    started = time.perf_counter()
+                    backend.search(search.TRANSFERS, filters, options['page_size'])
+                    timings.append((time.perf_counter() - started) * 1000)
+
+                timings.sort()
+                mean = statistics.mean(timings)
+                p50 = timings[len(timings) // 2]
+                p95 = timings[min(int(len(timings) * 0.95), len(timings) - 1)]
+                logger.info("search_benchmark", query=query_name, backend=backend.name,
+                            mean_ms=round(mean, 2), p50_ms=round(p50, 2), p95_ms=round(p95, 2), results=len(results))
+                self.stdout.write('{query:<20} {backend:<14} {mean:>9.2f} {p50:>9.2f} {p95:>9.2f} {results:>8}'.format(
+                    query=query_name, backend=backend.name, mean=mean, p50=p50, p95=p95, results=len(results)))
@@ -0,0 +1,45 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import structlog
+
+from ... import metrics, outbox
+
+logger = structlog.get_logger("django_structlog")
+
+
+class Command(BaseCommand):
+    help = 'Apply Elasticsearch writes queued in the outbox table in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.SEARCH_INDEX_DRAIN_BATCH_SIZE,
+                            help='Number of queued entries applied per bulk request')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds to sleep when the queue is empty. Empty the queue and exit if 0')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            try:
+                drained = outbox.drain(batch_size=options['batch_size'])
+            except Exception as e:
+                if not options['interval']:
+                    raise
+                # entries stay queued, retried after the interval
+                logger.error("search_index_drain_failed", error=str(e))
+                drained = 0
+            # the counters of the drains are served by the metrics endpoints of the web workers
+            metrics.flush()
+
+            if drained:
+                logger.info("search_index_drain",
+                            drained=drained,
+                            seconds=round(time.monotonic() - started, 3),
+                            lag=round(outbox.queue_lag(), 3))
+                continue
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from ...models import Team
+
+
+class Command(BaseCommand):
+    help = 'Recompute team values from their players\' prices, in case the incrementally kept values drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of teams updated per statement')
+
+    def handle(self, *args, **options):
+        updated = 0
+        last_id = 0
+        while True:
+            # the next batch of ids after the last one, so the ids are never all loaded at once
+            team_ids = list(Team.objects.filter(pk__gt=last_id).order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not team_ids:
+                break
+            updated += Team.objects.recalculate_values(team_ids)
+            last_id = team_ids[-1]
+
+        self.stdout.write('Recalculated value of {count} teams'.format(count=updated))
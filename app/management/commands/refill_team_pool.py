@@ -0,0 +1,41 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import structlog
+
+from ... import metrics, pool
+
+logger = structlog.get_logger("django_structlog")
+
+
+class Command(BaseCommand):
+    help = 'Keep the pool of pre-generated teams, claimed on user registration, topped up'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=settings.TEAM_POOL_SIZE,
+                            help='Number of teams to keep in the pool')
+        parser.add_argument('--batch-size', type=int, default=settings.TEAM_POOL_REFILL_BATCH_SIZE,
+                            help='Number of teams generated per transaction')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds to sleep between refills. Refill once and exit if 0')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            refilled = pool.refill(size=options['size'], batch_size=options['batch_size'])
+            elapsed = time.monotonic() - started
+
+            if refilled:
+                logger.info("team_pool_refill",
+                            refilled=refilled,
+                            depth=pool.pool_depth(),
+                            seconds=round(elapsed, 3),
+                            teams_per_second=round(refilled / elapsed, 1) if elapsed else None)
+            # the counters of the refills are served by the metrics endpoints of the web workers
+            metrics.flush()
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,48 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django_elasticsearch_dsl.registries import registry
+
+import structlog
+
+from ... import reindex
+
+logger = structlog.get_logger("django_structlog")
+
+
+class Command(BaseCommand):
+    help = ('Rebuild Elasticsearch indices without downtime: load a new versioned index in parallel, '
+            'verify it and swap the alias searches use. Replaces search_index --rebuild')
+
+    def add_arguments(self, parser):
+        parser.add_argument('indices', nargs='*',
+                            help='Names of the indices to rebuild, all registered indices by default')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of processes indexing chunks')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of rows per bulk request')
+        parser.add_argument('--keep-old', action='store_true',
+                            help='Do not delete the previous index after the swap')
+        parser.add_argument('--pause-timeout', type=int, default=3600,
+                            help='Seconds the outbox worker is held back at most while an index is rebuilt')
+
+    def report(self, **progress):
+        logger.info("search_reindex_progress", **progress)
+        self.stdout.write('{index}: {indexed}/{total} documents, {chunks}/{of_chunks} chunks, {docs_per_second} docs/s'.format(**progress))
+
+    def handle(self, *args, **options):
+        indices = {index._name: index for index in registry.get_indices()}
+        names = options['indices'] or list(indices)
+        unknown = set(names) - set(indices)
+        if unknown:
+            raise CommandError('Unknown indices: {names}'.format(names=', '.join(sorted(unknown))))
+
+        for name in names:
+            try:
+                index_name = reindex.reindex(indices[name], workers=options['workers'], chunk_size=options['chunk_size'],
+                                             keep_old=options['keep_old'], pause_timeout=options['pause_timeout'],
+                                             report=self.report)
+            except reindex.ReindexError as e:
+                raise CommandError(str(e))
+
+            self.stdout.write('{alias} now points to {index}'.format(alias=name, index=index_name))
@@ -0,0 +1,369 @@
+import bisect
+import fcntl
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+# upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# files of the metrics directory besides the directories of the hosts: the merged metrics of exited processes,
+# and the lock collecting processes hold while they read the directory and merge files into the archive
+ARCHIVE_FILE = 'archive.json'
+LOCK_FILE = 'collect.lock'
+# processes write their files in a directory named after their host, as containers sharing the metrics directory
+# have pid namespaces of their own
+HOST = socket.gethostname()
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        with self._lock:
+            return [(dict(key), value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down.
+    If function is given, the gauge is computed by calling it every time the metrics are collected.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, function=None):
+        super(Gauge, self).__init__(name, documentation)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.function:
+            return [({}, self.function())]
+        return super(Gauge, self).samples()
+
+
+class Summary(Metric):
+    """Count and sum of observed values, e.g. durations in seconds"""
+    type = 'summary'
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            count, total = self._values.get(key, (0, 0))
+            self._values[key] = (count + 1, total + value)
+
+    def samples(self):
+        return [(labels, {'count': count, 'sum': total}) for labels, (count, total) in super(Summary, self).samples()]
+
+
+class Histogram(Metric):
+    """Observed values counted in buckets by upper bound, with their count and sum"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # the first bucket with an upper bound of at least value, the last one is +Inf
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts = list(counts)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        result = list()
+        for labels, (counts, total) in super(Histogram, self).samples():
+            buckets, cumulative = dict(), 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                buckets[format_value(bound)] = cumulative
+            result.append((labels, {'buckets': buckets, 'count': cumulative, 'sum': total}))
+        return result
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def merge_values(type, value, other):
+    """Sum of two samples of a metric of the type, from different processes"""
+    if type == 'summary':
+        return {'count': value['count'] + other['count'], 'sum': value['sum'] + other['sum']}
+    if type == 'histogram':
+        return {'buckets': {bound: count + other['buckets'].get(bound, 0) for bound, count in value['buckets'].items()},
+                'count': value['count'] + other['count'], 'sum': value['sum'] + other['sum']}
+    return value + other
+
+
+def merge_samples(merged, type, samples, **extra_labels):
+    """Add samples of a metric of the type to merged, a dict of samples by labels"""
+    for sample in samples:
+        labels = dict(sample['labels'], **extra_labels)
+        key = Metric._key(labels)
+        if key in merged:
+            merged[key]['value'] = merge_values(type, merged[key]['value'], sample['value'])
+        else:
+            merged[key] = {'labels': labels, 'value': sample['value']}
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(directory, file_name, value):
+    # written aside and renamed, so other processes never read half a file
+    descriptor, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(descriptor, 'w') as f:
+        json.dump(value, f)
+    os.replace(path, os.path.join(directory, file_name))
+
+
+def process_files(directory):
+    """
+    (path in directory, host, pid, alive) of the files of the processes in the host directories of directory.
+    A pid may be reused once its process exited: of the files named with the same pid, only the latest written
+    may be of a live process. The pids of other hosts can not be checked, their latest files are taken as alive
+    """
+    files = dict()
+    for host in os.listdir(directory):
+        if not os.path.isdir(os.path.join(directory, host)):
+            continue
+        for file_name in os.listdir(os.path.join(directory, host)):
+            name, extension = os.path.splitext(file_name)
+            pid = name.partition('-')[0]
+            if extension != '.json' or not pid.isdigit():
+                continue
+            path = os.path.join(host, file_name)
+            written = os.stat(os.path.join(directory, path)).st_mtime
+            files.setdefault((host, pid), list()).append((written, path))
+
+    result = list()
+    for (host, pid), written in sorted(files.items()):
+        alive = process_alive(int(pid)) if host == HOST else True
+        written.sort()
+        for i, (_, path) in enumerate(written):
+            result.append((path, host, pid, alive and i == len(written) - 1))
+    return result
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Registry:
+    """
+    The metrics of the process. Processes sharing a directory, like the gunicorn workers,
+    write their metrics to a file of their own in it, and collect_all() adds up the files of every process.
+    Gauges computed by a function are only computed by the collecting process.
+    """
+
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = threading.Lock()
+        self._flushed_at = None
+        self._file_pid = None
+        self._file_name = None
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def collect(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        result = dict()
+        for metric in metrics:
+            result[metric.name] = {
+                'type': metric.type,
+                'help': metric.documentation,
+                'samples': [{'labels': labels, 'value': value} for labels, value in metric.samples()]
+            }
+        return result
+
+    def flush(self, directory):
+        """Write the metrics of this process to its file in the directory of its host in directory"""
+        with self._lock:
+            metrics = [metric for metric in self._metrics.values() if not getattr(metric, 'function', None)]
+            self._flushed_at = time.monotonic()
+            pid = os.getpid()
+            if self._file_pid != pid:
+                # unique, so a process reusing the pid of an exited one does not overwrite its file,
+                # and made again in forked processes
+                self._file_pid = pid
+                self._file_name = os.path.join(HOST, '{pid}-{id}.json'.format(pid=pid, id=uuid.uuid4().hex))
+            file_name = self._file_name
+
+        snapshot = {
+            metric.name: {'type': metric.type, 'help': metric.documentation,
+                          'samples': [{'labels': labels, 'value': value} for labels, value in metric.samples()]}
+            for metric in metrics
+        }
+        os.makedirs(os.path.join(directory, HOST), exist_ok=True)
+        write_json(directory, file_name, snapshot)
+
+    def flush_if_due(self, directory, interval):
+        if self._flushed_at is None or time.monotonic() - self._flushed_at >= interval:
+            self.flush(directory)
+
+    @staticmethod
+    def archive(directory, file_names):
+        """Merge the files of exited processes into the archive file and remove them. Their gauges are dropped"""
+        path = os.path.join(directory, ARCHIVE_FILE)
+        archived = read_json(path) if os.path.exists(path) else dict()
+        for file_name in file_names:
+            for name, metric in read_json(os.path.join(directory, file_name)).items():
+                if metric['type'] == 'gauge':
+                    continue
+                merged = {Metric._key(sample['labels']): sample for sample in archived[name]['samples']} if name in archived else dict()
+                merge_samples(merged, metric['type'], metric['samples'])
+                archived[name] = dict(metric, samples=list(merged.values()))
+
+        write_json(directory, ARCHIVE_FILE, archived)
+        for file_name in file_names:
+            os.remove(os.path.join(directory, file_name))
+
+    def collect_all(self, directory):
+        """
+        Metrics of every process which wrote to directory. Counters, summaries and histograms are added up,
+        including those of exited processes, whose files are merged into the archive file.
+        Gauges are labelled by host and pid and left out once their process exited
+        """
+        self.flush(directory)
+        local = self.collect()
+        result = {name: dict(metric, samples=list()) for name, metric in local.items()}
+        samples = dict()
+
+        # one process at a time, so a file is never archived twice
+        with open(os.path.join(directory, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            files = process_files(directory)
+            dead = [path for path, host, pid, alive in files if not alive]
+            if dead:
+                self.archive(directory, dead)
+
+            snapshots = [(read_json(os.path.join(directory, path)), {'host': host, 'pid': pid})
+                         for path, host, pid, alive in files if alive]
+            if os.path.exists(os.path.join(directory, ARCHIVE_FILE)):
+                snapshots.append((read_json(os.path.join(directory, ARCHIVE_FILE)), None))
+
+        for snapshot, process in snapshots:
+            for name, metric in snapshot.items():
+                result.setdefault(name, dict(metric, samples=list()))
+                merged = samples.setdefault(name, dict())
+                if metric['type'] == 'gauge':
+                    merge_samples(merged, metric['type'], metric['samples'], **process)
+                else:
+                    merge_samples(merged, metric['type'], metric['samples'])
+
+        for name, metric in result.items():
+            if name in samples:
+                metric['samples'] = list(samples[name].values())
+            else:
+                # computed by a function, not written to the files
+                metric['samples'] = local[name]['samples']
+        return result
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_text(collected):
+    """The collected metrics in the Prometheus text exposition format"""
+    lines = list()
+
+    def sample(name, labels, value):
+        if labels:
+            name += '{' + ','.join('{label}="{value}"'.format(label=label, value=escape_label(label_value))
+                                   for label, label_value in sorted(labels.items())) + '}'
+        lines.append('{name} {value}'.format(name=name, value=format_value(value)))
+
+    for name, metric in collected.items():
+        lines.append('# HELP {name} {help}'.format(name=name, help=metric['help'].replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE {name} {type}'.format(name=name, type=metric['type']))
+        for item in metric['samples']:
+            labels, value = item['labels'], item['value']
+            if metric['type'] == 'histogram':
+                for bound, count in value['buckets'].items():
+                    sample(name + '_bucket', dict(labels, le=bound), count)
+            if metric['type'] in ('summary', 'histogram'):
+                sample(name + '_count', labels, value['count'])
+                sample(name + '_sum', labels, value['sum'])
+            else:
+                sample(name, labels, value)
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def collect():
+    """Metrics of every process sharing METRICS_DIR, or of this process only when it is not set"""
+    if settings.METRICS_DIR:
+        return REGISTRY.collect_all(settings.METRICS_DIR)
+    return REGISTRY.collect()
+
+
+def flush():
+    """Make the metrics of this process visible to the others, at most every METRICS_FLUSH_INTERVAL seconds"""
+    if settings.METRICS_DIR:
+        REGISTRY.flush_if_due(settings.METRICS_DIR, settings.METRICS_FLUSH_INTERVAL)
+
+
+def counter(name, documentation):
+    return REGISTRY.register(Counter(name, documentation))
+
+
+def gauge(name, documentation, function=None):
+    return REGISTRY.register(Gauge(name, documentation, function))
+
+
+def summary(name, documentation):
+    return REGISTRY.register(Summary(name, documentation))
+
+
+def histogram(name, documentation, buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, buckets))
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.5 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_auto_20210717_0621'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='in_pool',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='team',
+            name='pooled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
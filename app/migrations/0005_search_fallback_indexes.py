@@ -0,0 +1,26 @@
+# Generated by Django 3.2.5 on 2026-10-18 14:00
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_searchindexoutbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(django.db.models.functions.text.Upper('first_name'), name='player_first_name_upper_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(django.db.models.functions.text.Upper('last_name'), name='player_last_name_upper_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transferlist',
+            index=models.Index(fields=['asking_price', 'id'], name='transfer_asking_price_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.5 on 2026-10-18 16:00
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+# indexes of app.search.PostgresBackend, the expressions must stay the same as the ones of its queries
+SEARCH_INDEXES = {
+    'player_name_search_idx': "ON app_player USING gin "
+                              "(to_tsvector('simple'::regconfig, COALESCE(first_name, '') || ' ' || COALESCE(last_name, '')))",
+    'player_first_name_trgm_idx': "ON app_player USING gin (first_name gin_trgm_ops)",
+    'player_last_name_trgm_idx': "ON app_player USING gin (last_name gin_trgm_ops)",
+    'team_name_search_idx': "ON app_team USING gin (to_tsvector('simple'::regconfig, COALESCE(name, '')))",
+    'team_name_trgm_idx': "ON app_team USING gin (name gin_trgm_ops)",
+}
+
+
+def create_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, definition in SEARCH_INDEXES.items():
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS {name} {definition}'.format(name=name, definition=definition))
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name in SEARCH_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {name}'.format(name=name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_search_fallback_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(fields=['country'], name='player_country_idx'),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
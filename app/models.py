@@ -1,16 +1,40 @@
 import random
+import time
 from decimal import Decimal
 
+import structlog
+
 from django.core.validators import MinValueValidator
 from pytz import country_names
-import names
 from names_generator import generate_name
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction, connections, OperationalError
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Upper
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.base_user import BaseUserManager
 
+from . import metrics
+from .cache import ObjectCache
+from .sampler import default_sampler
+
+logger = structlog.get_logger("django_structlog")
+
+# postgres errors after which a transfer is retried
+TRANSFER_RETRY_ERRORS = {
+    '40P01': 'deadlock',
+    '40001': 'serialization_failure',
+}
+LOCK_NOT_AVAILABLE = '55P03'
+
+transfers_counter = metrics.counter('transfers_total', 'Completed transfers by result (success, failed)')
+transfer_retries_counter = metrics.counter('transfer_retries_total', 'Retried transfer transactions by reason')
+lock_wait_summary = metrics.summary('transfer_lock_wait_seconds', 'Time spent waiting for transfer row locks')
+buy_rejections_counter = metrics.counter('transfer_buy_rejections_total', 'Buy requests rejected without a transfer by reason')
+
 
 class UserManager(BaseUserManager):
     def create_user(self, email, password, **extra_fields):
@@ -65,72 +89,116 @@ class User(AbstractUser):
 
 
 class TeamManager(models.Manager):
-    def generate_team(self, user=None, name=None, country=None):
-        countries = tuple(country_names.keys())
-        num_of_countries = len(countries)-1
+    # keeps a single multi-row player insert well below the postgres bind parameter limit
+    PLAYERS_INSERT_BATCH_SIZE = 2000
+
+    def _build_team(self, name=None, country=None, in_pool=False, sampler=None):
+        sampler = sampler or default_sampler
         team = self.model(
             name=(name if name else generate_name(style='capital')),
-            country=(country if country else countries[random.randint(0, num_of_countries)]),
+            country=(country if country else sampler.countries(1)[0]),
             value=settings.TEAM_TOTAL_PLAYERS * settings.PLAYER_INITIAL_PRICE,
-            budget=settings.TEAM_INITIAL_BUDGET
+            budget=settings.TEAM_INITIAL_BUDGET,
+            gk_count=settings.TEAM_GOALKEEPERS,
+            def_count=settings.TEAM_DEFENDERS,
+            mid_count=settings.TEAM_MIDFIELDERS,
+            fwd_count=settings.TEAM_FORWARDS,
+            in_pool=in_pool,
+            pooled_at=(timezone.now() if in_pool else None)
         )
-        team.save()
-
-        for _ in range(settings.TEAM_GOALKEEPERS):
-            player = Player(
-                category='GK',
-                first_name=names.get_first_name('male'),
-                last_name=names.get_last_name(),
-                country=countries[random.randint(0, num_of_countries)],
-                age=random.randint(18, 40),
-                price=settings.PLAYER_INITIAL_PRICE
-            )
-            player.save()
-            team.add_player(player, defer_save=True)
-
-        for _ in range(settings.TEAM_DEFENDERS):
-            player = Player(
-                category='DEF',
-                first_name=names.get_first_name('male'),
-                last_name=names.get_last_name(),
-                country=countries[random.randint(0, num_of_countries)],
-                age=random.randint(18, 40),
-                price=settings.PLAYER_INITIAL_PRICE
-            )
-            player.save()
-            team.add_player(player, defer_save=True)
-
-        for _ in range(settings.TEAM_MIDFIELDERS):
-            player = Player(
-                category='MID',
-                first_name=names.get_first_name('male'),
-                last_name=names.get_last_name(),
-                country=countries[random.randint(0, num_of_countries)],
-                age=random.randint(18, 40),
-                price=settings.PLAYER_INITIAL_PRICE
-            )
-            player.save()
-            team.add_player(player, defer_save=True)
-
-        for _ in range(settings.TEAM_FORWARDS):
-            player = Player(
-                category='FWD',
-                first_name=names.get_first_name('male'),
-                last_name=names.get_last_name(),
-                country=countries[random.randint(0, num_of_countries)],
-                age=random.randint(18, 40),
-                price=settings.PLAYER_INITIAL_PRICE
-            )
-            player.save()
-            team.add_player(player, defer_save=True)
-
-        team.save()
-        if user:
+        return team
+
+    def _build_squad(self, team, sampler=None):
+        """Build the initial players of the team in memory, without touching the database"""
+        sampler = sampler or default_sampler
+        categories = (
+            ['GK'] * settings.TEAM_GOALKEEPERS +
+            ['DEF'] * settings.TEAM_DEFENDERS +
+            ['MID'] * settings.TEAM_MIDFIELDERS +
+            ['FWD'] * settings.TEAM_FORWARDS
+        )
+        return [
+            Player(price=settings.PLAYER_INITIAL_PRICE, team=team, **attributes)
+            for attributes in sampler.players(categories)
+        ]
+
+    def generate_team(self, user=None, name=None, country=None):
+        """
+        Create a team with a full squad of randomly generated players.
+        The team row already carries its final counters and value, so the whole squad costs
+        one insert for the team, one multi-row insert for the players and, optionally, one user update.
+        """
+        team = self._build_team(name=name, country=country)
+
+        with transaction.atomic():
+            team.save()
+            Player.objects.bulk_create(self._build_squad(team))
+
+            if user:
+                user.team = team
+                user.save(update_fields=['team'])
+
+        return team
+
+    def generate_teams(self, n, batch_size=500, in_pool=False, sampler=None):
+        """
+        Create n teams with full squads, without owners.
+        Teams are inserted in batches of batch_size, each batch in its own transaction.
+        Pass in_pool=True to put the teams into the pool of teams waiting to be claimed on registration,
+        and a seeded app.sampler.Sampler to get reproducible squads.
+        """
+        teams = list()
+        while len(teams) < n:
+            batch = [self._build_team(in_pool=in_pool, sampler=sampler) for _ in range(min(batch_size, n - len(teams)))]
+            with transaction.atomic():
+                if connections[self.db].features.can_return_rows_from_bulk_insert:
+                    self.bulk_create(batch)
+                else:
+                    for team in batch:
+                        team.save()
+                players = list()
+                for team in batch:
+                    players.extend(self._build_squad(team, sampler=sampler))
+                Player.objects.bulk_create(players, batch_size=self.PLAYERS_INSERT_BATCH_SIZE)
+            teams.extend(batch)
+
+        return teams
+
+    def claim_pooled_team(self, user):
+        """
+        Atomically take one team out of the pool and give it to the user.
+        Concurrent registrations skip rows already locked by each other, so they never wait on the same team.
+        Returns None when the pool is empty.
+        """
+        with transaction.atomic():
+            team = self.select_for_update(skip_locked=True).filter(in_pool=True).order_by('id').first()
+            if team is None:
+                return None
+
+            team.in_pool = False
+            team.save(update_fields=['in_pool'])
             user.team = team
-            user.save()
+            user.save(update_fields=['team'])
 
         return team
 
+    def recalculate_values(self, teams=None):
+        """
+        Recompute the value of the given teams (all teams by default) from their players' prices
+        with a single UPDATE ... SET value = (SELECT SUM(price) ...) statement.
+        """
+        total = Player.objects.filter(team=OuterRef('pk')).order_by().values('team').annotate(total=Sum('price')).values('total')
+        value = Coalesce(Subquery(total, output_field=models.DecimalField()), Value(Decimal('0')), output_field=models.DecimalField())
+        if teams is None:
+            # the whole table, without sending every id back and forth
+            updated = self.update(value=value)
+            team_cache.invalidate_all()
+            return updated
+
+        updated = self.filter(pk__in=teams).update(value=value)
+        team_cache.invalidate(*teams)
+        return updated
+
 
 class Team(models.Model):
     name = models.CharField(max_length=128, blank=False, null=False)
@@ -143,6 +211,10 @@ class Team(models.Model):
     mid_count = models.PositiveSmallIntegerField(default=0)
     fwd_count = models.PositiveSmallIntegerField(default=0)
 
+    # pre-generated teams waiting to be claimed by newly registered users
+    in_pool = models.BooleanField(default=False, db_index=True)
+    pooled_at = models.DateTimeField(blank=True, null=True)
+
     objects = TeamManager()
 
     def __str__(self):
@@ -169,46 +241,58 @@ class Team(models.Model):
         '''
 
         self.players.add(player)
+        # a bulk update of the player's team, which sends no signal
+        player_cache.invalidate(player.pk)
 
-        if player.category == 'GK':
-            self.gk_count += 1
-        elif player.category == 'DEF':
-            self.def_count += 1
-        elif player.category == 'MID':
-            self.mid_count += 1
-        elif player.category == 'FWD':
-            self.fwd_count += 1
-
-        if not defer_save:
-            self.save()
+        if defer_save:
+            counter = self.category_counter(player.category)
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.value += player.price
+        else:
+            self.update_counters(**self.roster_deltas(player.category, player.price))
 
     def remove_player(self, player, defer_save=False):
 
-        if player in self.players.all():
+        if player.team_id == self.id:
             self.players.remove(player)
-
-            if player.category == 'GK':
-                self.gk_count -= 1
-            elif player.category == 'DEF':
-                self.def_count -= 1
-            elif player.category == 'MID':
-                self.mid_count -= 1
-            elif player.category == 'FWD':
-                self.fwd_count -= 1
+            player_cache.invalidate(player.pk)
         else:
             raise Exception('Player not found in Team')
 
-        if not defer_save:
-            self.save()
+        if defer_save:
+            counter = self.category_counter(player.category)
+            setattr(self, counter, getattr(self, counter) - 1)
+            self.value -= player.price
+        else:
+            self.update_counters(**self.roster_deltas(player.category, player.price, count=-1))
+
+    @staticmethod
+    def category_counter(category):
+        return '{category}_count'.format(category=category.lower())
+
+    @classmethod
+    def roster_deltas(cls, category, price, count=1):
+        """Changes of the counters and the value of a team gaining (or, with negative count, losing) players"""
+        return {cls.category_counter(category): count, 'value': count * price}
+
+    def update_counters(self, **deltas):
+        """
+        Move numeric fields of the team by the given deltas, e.g. update_counters(value=-price, gk_count=-1).
+        The row is changed with a single UPDATE computed by the database, so concurrent changes are not lost,
+        and the same deltas are applied to this instance.
+        """
+        Team.objects.filter(pk=self.pk).update(**{field: F(field) + delta for field, delta in deltas.items()})
+        for field, delta in deltas.items():
+            setattr(self, field, getattr(self, field) + delta)
+        # transfers change both teams through here, inside their transaction
+        team_cache.invalidate(self.pk)
 
     def recalculate_team_value(self, defer_save=False):
-        total_value = 0
-        for player in self.players.all():
-            total_value += player.price
-        self.value = total_value
+        """Recompute the value from the players' prices. Team value is normally kept up to date by update_counters"""
+        self.value = self.players.aggregate(total=Sum('price'))['total'] or Decimal('0')
 
         if not defer_save:
-            self.save()
+            self.save(update_fields=['value'])
 
 
 class Player(models.Model):
@@ -227,6 +311,15 @@ class Player(models.Model):
 
     team = models.ForeignKey('Team', on_delete=models.CASCADE, related_name='players', blank=True, null=True)
 
+    class Meta:
+        # name lookups of the database search fallback are case insensitive.
+        # Full text and trigram indexes of the postgres search backend are created in migration 0006
+        indexes = [
+            models.Index(Upper('first_name'), name='player_first_name_upper_idx'),
+            models.Index(Upper('last_name'), name='player_last_name_upper_idx'),
+            models.Index(fields=['country'], name='player_country_idx'),
+        ]
+
     def __str__(self):
         return '[{team}] {first_name} {last_name}'.format(team=self.team.name, first_name=self.first_name, last_name=self.last_name)
 
@@ -236,19 +329,17 @@ class Player(models.Model):
 
     def increase_price(self):
         increase_percent = (random.randint(10, 100) + 100) / 100
-        self.price = Decimal(increase_percent) * self.price
+        self.price = (Decimal(increase_percent) * self.price).quantize(Decimal('0.01'))
 
     def set_to_transfer_list(self, asking_price):
         transfer_offer, created = TransferList.objects.get_or_create(player=self, asking_price=asking_price)
         if not created:
             raise Exception('This player is already in Transfer List')
+        cache.delete(TransferList.sold_key(self.id))
 
     def delete(self, using=None, keep_parents=False):
         if self.team:
-            self.team.value -= self.price
-            cnt = self.team.__getattribute__('{category}_count'.format(category=self.category.lower()))
-            self.team.__setattr__('{category}_count'.format(category=self.category.lower()), cnt - 1)
-            self.team.save()
+            self.team.update_counters(**Team.roster_deltas(self.category, self.price, count=-1))
         return super(Player, self).delete(using, keep_parents)
 
 
@@ -256,36 +347,125 @@ class TransferList(models.Model):
     player = models.OneToOneField('Player', related_name='transfer_offer', on_delete=models.CASCADE)
     asking_price = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(Decimal('0'))])
 
+    class Meta:
+        # price filters and keyset pages ordered by price of the database search fallback
+        indexes = [
+            models.Index(fields=['asking_price', 'id'], name='transfer_asking_price_idx'),
+        ]
+
     def __str__(self):
         return '{player} {price}'.format(player=self.player, price=self.asking_price)
 
-    def make_transfer(self, buying_team):
-        selling_team = self.player.team
+    @staticmethod
+    def lease_key(player_id):
+        return 'transfer:lease:{player_id}'.format(player_id=player_id)
+
+    @staticmethod
+    def sold_key(player_id):
+        return 'transfer:sold:{player_id}'.format(player_id=player_id)
+
+    @classmethod
+    def claim(cls, player_id):
+        """
+        Try to become the only buyer working on the listing of the player, using an atomic add to the shared cache.
+        Buyers who lose the race are rejected here, before touching any database rows.
+        Raises an Exception when the player was just sold or another buyer holds the claim.
+        """
+        if cache.get(cls.sold_key(player_id)):
+            buy_rejections_counter.inc(reason='sold')
+            raise Exception('This player is already sold')
+
+        if not cache.add(cls.lease_key(player_id), True, timeout=settings.TRANSFER_LEASE_TIMEOUT):
+            buy_rejections_counter.inc(reason='claimed')
+            raise Exception('This player is being sold to another team')
+
+    @classmethod
+    def release(cls, player_id, sold=False):
+        if sold:
+            cache.set(cls.sold_key(player_id), True, timeout=settings.TRANSFER_SOLD_MARKER_TIMEOUT)
+        cache.delete(cls.lease_key(player_id))
 
-        if selling_team:
-            if selling_team.id == buying_team.id:
+    def make_transfer(self, buying_team):
+        """
+        Sell the listed player to buying_team in one transaction.
+        The listing is locked first and then both teams in the order of their ids, so concurrent buys of the same
+        listing are serialized and transfers between the same teams can't deadlock each other.
+        Deadlocks and serialization failures caused by other writers are retried.
+        """
+        attempts = settings.TRANSFER_MAX_RETRIES + 1
+        for attempt in range(attempts):
+            try:
+                self._make_transfer(buying_team)
+                transfers_counter.inc(result='success')
+                return
+            except OperationalError as e:
+                reason = TRANSFER_RETRY_ERRORS.get(getattr(e.__cause__, 'pgcode', None))
+                # a transaction can't be retried from inside an outer atomic block which is already broken
+                can_retry = reason and attempt + 1 < attempts and not connections[self._state.db].in_atomic_block
+                if can_retry:
+                    transfer_retries_counter.inc(reason=reason)
+                    logger.warning("transfer_retry", listing=self.pk, reason=reason, attempt=attempt + 1)
+                    continue
+
+                transfers_counter.inc(result='failed')
+                if reason or getattr(e.__cause__, 'pgcode', None) == LOCK_NOT_AVAILABLE:
+                    raise Exception('Transfer could not be completed, please try again')
+                raise
+            except Exception:
+                transfers_counter.inc(result='failed')
+                raise
+
+    def _make_transfer(self, buying_team):
+        # outbox imports the models
+        from . import outbox
+
+        # the listing is reindexed by the player's save and then deleted, only its delete is queued
+        with transaction.atomic(using=self._state.db), outbox.batched():
+            connection = connections[self._state.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL lock_timeout = %s', ['{}ms'.format(settings.TRANSFER_LOCK_TIMEOUT_MS)])
+
+            lock_started = time.monotonic()
+            # don't queue behind another buyer holding the listing, fail right away instead
+            listing = TransferList.objects.select_for_update(nowait=True).select_related('player').filter(pk=self.pk).first()
+            if listing is None:
+                raise Exception('This player is already sold')
+
+            player = listing.player
+            if player.team_id == buying_team.id:
                 raise Exception('Buying team is same with selling team')
 
-        if buying_team.budget < self.asking_price:
-            raise Exception('Buying team does not have enough budget to buy this player!')
-        else:
+            team_ids = sorted({player.team_id, buying_team.id} - {None})
+            teams = {team.id: team for team in Team.objects.select_for_update().filter(pk__in=team_ids).order_by('id')}
+            lock_wait = time.monotonic() - lock_started
+            lock_wait_summary.observe(lock_wait)
+
+            selling_team = teams.get(player.team_id)
+            locked_buying_team = teams[buying_team.id]
+            if locked_buying_team.budget < listing.asking_price:
+                raise Exception('Buying team does not have enough budget to buy this player!')
+
+            old_price = player.price
+            player.increase_price()
+
             if selling_team:
-                selling_team.remove_player(self.player, defer_save=True)
-                selling_team.budget += self.asking_price
-                selling_team.recalculate_team_value(defer_save=True)
-                selling_team.save()
-
-            self.player.increase_price()
-            self.player.save()
-            buying_team.add_player(self.player, defer_save=True)
-            buying_team.recalculate_team_value(defer_save=True)
-            buying_team.budget -= self.asking_price
-            buying_team.save()
-
-            transfer = TransferHistory(player=self.player, sell_team=selling_team, buy_team=buying_team, sell_price=self.asking_price)
+                selling_team.update_counters(budget=listing.asking_price,
+                                             **Team.roster_deltas(player.category, old_price, count=-1))
+
+            player.team = locked_buying_team
+            player.save(update_fields=['price', 'team'])
+            locked_buying_team.update_counters(budget=-listing.asking_price,
+                                               **Team.roster_deltas(player.category, player.price))
+
+            transfer = TransferHistory(player=player, sell_team=selling_team, buy_team=locked_buying_team, sell_price=listing.asking_price)
             transfer.save()
 
-            self.delete()
+            listing.delete()
+
+        buying_team.budget = locked_buying_team.budget
+        logger.info("transfer_completed", player=player.id, sell_team=(selling_team.id if selling_team else None),
+                    buy_team=buying_team.id, lock_wait=round(lock_wait, 4))
 
 
 class TransferHistory(models.Model):
@@ -302,3 +482,29 @@ class TransferHistory(models.Model):
             sell_team=self.sell_team,
             buy_team=self.buy_team
         )
+
+
+class SearchIndexOutbox(models.Model):
+    """
+    Elasticsearch writes waiting to be applied by the drain_search_index command.
+    Entries are written in the same transaction as the model change, so no change is lost when Elasticsearch is down.
+    """
+    INDEX = 'index'
+    DELETE = 'delete'
+    ACTIONS = (
+        (INDEX, 'Index'),
+        (DELETE, 'Delete'),
+    )
+    # label of the indexed model, e.g. app.TransferList
+    model = models.CharField(max_length=128)
+    object_id = models.BigIntegerField()
+    action = models.CharField(max_length=16, choices=ACTIONS, default=INDEX)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{action} {model} {object_id}'.format(action=self.action, model=self.model, object_id=self.object_id)
+
+
+# read-through caches of Team and Player point lookups, invalidated by saves, deletes and the updates above
+team_cache = ObjectCache(Team, settings.OBJECT_CACHE_LOCAL_SIZE, settings.OBJECT_CACHE_LOCAL_TIMEOUT, settings.OBJECT_CACHE_TIMEOUT)
+player_cache = ObjectCache(Player, settings.OBJECT_CACHE_LOCAL_SIZE, settings.OBJECT_CACHE_LOCAL_TIMEOUT, settings.OBJECT_CACHE_TIMEOUT)
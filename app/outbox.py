@@ -0,0 +1,147 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django_elasticsearch_dsl.registries import registry
+
+from . import metrics
+from .models import SearchIndexOutbox
+
+INDEX = SearchIndexOutbox.INDEX
+DELETE = SearchIndexOutbox.DELETE
+
+PAUSE_KEY = 'search_index_outbox:paused'
+
+
+def queue_depth():
+    return SearchIndexOutbox.objects.count()
+
+
+def queue_lag():
+    """Seconds the oldest waiting entry has been queued for, 0 if the queue is empty"""
+    oldest = SearchIndexOutbox.objects.order_by('id').values_list('created_at', flat=True).first()
+    return (timezone.now() - oldest).total_seconds() if oldest else 0
+
+
+queue_depth_gauge = metrics.gauge('search_index_outbox_depth', 'Elasticsearch writes waiting in the outbox', queue_depth)
+queue_lag_gauge = metrics.gauge('search_index_outbox_lag_seconds', 'Age of the oldest Elasticsearch write waiting in the outbox', queue_lag)
+drained_counter = metrics.counter('search_index_outbox_drained_total', 'Outbox entries taken by the worker')
+writes_counter = metrics.counter('search_index_outbox_writes_total', 'Documents written to Elasticsearch by the worker by action (index, delete)')
+
+
+# entries of the batched() block running in the thread, None outside of one
+_batch = threading.local()
+
+
+def enqueue(model, object_ids, action=INDEX):
+    pending = getattr(_batch, 'entries', None)
+    if pending is None:
+        write([(model._meta.label, object_id, action) for object_id in object_ids])
+        return
+
+    for object_id in object_ids:
+        # only the last action of an object matters, see collapse()
+        pending.pop((model._meta.label, object_id), None)
+        pending[model._meta.label, object_id] = action
+
+
+def write(entries):
+    SearchIndexOutbox.objects.bulk_create([
+        SearchIndexOutbox(model=label, object_id=object_id, action=action) for label, object_id, action in entries
+    ])
+
+
+@contextmanager
+def batched():
+    """
+    Queue the entries of the block with a single insert at its end, keeping the last action of each object.
+    Use it inside the transaction of the changes: nothing is queued when the block raises.
+    Nested blocks are part of the outermost one
+    """
+    if getattr(_batch, 'entries', None) is not None:
+        yield
+        return
+
+    _batch.entries = dict()
+    try:
+        yield
+        entries = _batch.entries
+    finally:
+        _batch.entries = None
+    if entries:
+        write([(label, object_id, action) for (label, object_id), action in entries.items()])
+
+
+def pause(timeout):
+    """Stop draining, e.g. while an index is rebuilt. Entries keep being queued and are applied after resume"""
+    cache.set(PAUSE_KEY, True, timeout)
+
+
+def resume():
+    cache.delete(PAUSE_KEY)
+
+
+def paused():
+    return bool(cache.get(PAUSE_KEY))
+
+
+def collapse(entries):
+    """
+    Merge entries of the same object. Indexing reads the current row, so only the last action of each object matters.
+    Returns {model label: {action: set of object ids}}
+    """
+    latest = dict()
+    for entry in sorted(entries, key=lambda entry: entry.id):
+        latest[entry.model, entry.object_id] = entry.action
+
+    actions = defaultdict(lambda: {INDEX: set(), DELETE: set()})
+    for (label, object_id), action in latest.items():
+        actions[label][action].add(object_id)
+    return actions
+
+
+def apply(model, object_ids):
+    """Write one bulk request per document of the model and action"""
+    for document in registry.get_documents([model]):
+        index_ids = object_ids[INDEX]
+        delete_ids = set(object_ids[DELETE])
+
+        if index_ids:
+            instances = list(document().get_queryset().filter(pk__in=index_ids))
+            # rows deleted after they were queued for indexing
+            delete_ids |= index_ids - {instance.pk for instance in instances}
+            if instances:
+                document().update(instances)
+                writes_counter.inc(len(instances), action=INDEX)
+
+        if delete_ids:
+            # documents that were never indexed are not an error
+            document().update([model(pk=object_id) for object_id in delete_ids], action=DELETE, raise_on_error=False)
+            writes_counter.inc(len(delete_ids), action=DELETE)
+
+
+def drain(batch_size=None):
+    """
+    Apply up to batch_size queued entries to Elasticsearch. Returns the number of taken entries.
+    Entries are removed in the transaction that applied them, so they stay queued if Elasticsearch fails.
+    Run a single worker: entries of one document taken by two workers may be written out of order.
+    """
+    if paused():
+        return 0
+
+    with transaction.atomic():
+        entries = list(SearchIndexOutbox.objects.select_for_update(skip_locked=True).order_by('id')[:batch_size])
+        if not entries:
+            return 0
+
+        for label, object_ids in collapse(entries).items():
+            apply(apps.get_model(label), object_ids)
+
+        SearchIndexOutbox.objects.filter(id__in=[entry.id for entry in entries]).delete()
+
+    drained_counter.inc(len(entries))
+    return len(entries)
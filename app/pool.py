@@ -0,0 +1,60 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+import structlog
+
+from . import metrics
+from .models import Team
+
+logger = structlog.get_logger("django_structlog")
+
+REFILL_RATE_WINDOW = timedelta(hours=1)
+
+
+def pool_depth():
+    return Team.objects.filter(in_pool=True).count()
+
+
+def refill_rate():
+    """Teams put into the pool per minute, averaged over the last hour"""
+    since = timezone.now() - REFILL_RATE_WINDOW
+    refilled = Team.objects.filter(pooled_at__gte=since).count()
+    return refilled / (REFILL_RATE_WINDOW.total_seconds() / 60)
+
+
+pool_depth_gauge = metrics.gauge('team_pool_depth', 'Pre-generated teams waiting to be claimed', pool_depth)
+refill_rate_gauge = metrics.gauge('team_pool_refill_rate', 'Teams added to the pool per minute over the last hour', refill_rate)
+claims_counter = metrics.counter('team_pool_claims_total', 'Team assignments on registration by result (hit, miss)')
+refilled_counter = metrics.counter('team_pool_refilled_total', 'Teams generated into the pool')
+
+
+def assign_team(user):
+    """
+    Give a newly registered user a team.
+    A ready-made team is claimed from the pool, and a new one is generated only when the pool is empty.
+    """
+    team = Team.objects.claim_pooled_team(user)
+    if team:
+        claims_counter.inc(result='hit')
+    else:
+        claims_counter.inc(result='miss')
+        logger.warning("team_pool_empty", message="Team pool is empty, generating team on demand")
+        team = Team.objects.generate_team(user)
+
+    return team
+
+
+def refill(size=None, batch_size=None):
+    """Top the pool up to size teams. Returns the number of generated teams"""
+    size = size if size is not None else settings.TEAM_POOL_SIZE
+    batch_size = batch_size if batch_size else settings.TEAM_POOL_REFILL_BATCH_SIZE
+
+    missing = size - pool_depth()
+    if missing <= 0:
+        return 0
+
+    Team.objects.generate_teams(missing, batch_size=batch_size, in_pool=True)
+    refilled_counter.inc(missing)
+    return missing
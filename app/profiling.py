@@ -0,0 +1,143 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.exceptions import AuthenticationFailed
+
+import structlog
+
+from .api.authentication import CachedTokenAuthentication
+from .api.permissions import IsAdminRoleUser
+
+logger = structlog.get_logger("django_structlog")
+
+# profiling is asked for with this header, or with a query parameter of the same name
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PARAMETER = 'profile'
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread from another thread every interval seconds, for at most max_seconds.
+    Stacks are counted in the folded format of flame graph tools: frames from the outermost, separated by ';'
+    """
+
+    def __init__(self, thread_id, interval, max_seconds):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.stacks[self.fold(frame)] += 1
+
+    @staticmethod
+    def fold(frame):
+        frames = list()
+        while frame is not None:
+            code = frame.f_code
+            frames.append('{function} ({file}:{line})'.format(
+                function=code.co_name, file=os.path.relpath(code.co_filename, settings.BASE_DIR), line=code.co_firstlineno
+            ).replace(';', ':'))
+            frame = frame.f_back
+        return ';'.join(reversed(frames))
+
+    def folded(self):
+        return ''.join('{stack} {count}\n'.format(stack=stack, count=count) for stack, count in self.stacks.most_common())
+
+
+_profiling = threading.Lock()
+
+
+def acquire_slot():
+    """
+    Whether a profile may be taken now: one at a time per worker, and at most PROFILER_MAX_PER_MINUTE
+    over all workers. Release the worker's slot with _profiling.release() when it returned True
+    """
+    if not _profiling.acquire(blocking=False):
+        return False
+
+    key = 'profiler:{minute}'.format(minute=int(time.time() // 60))
+    cache.add(key, 0, 60)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # evicted meanwhile
+        count = 1
+    if count > settings.PROFILER_MAX_PER_MINUTE:
+        _profiling.release()
+        return False
+    return True
+
+
+def is_admin(request):
+    """Whether the request carries the token of an admin role user, without failing on bad tokens"""
+    try:
+        authenticated = CachedTokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return authenticated is not None and IsAdminRoleUser().has_permission(SimpleNamespace(user=authenticated[0]), None)
+
+
+class ProfilerMiddleware:
+    """
+    Samples the stack of requests of admin role users sending the X-Profile header or the profile query parameter,
+    and writes it to PROFILER_DIR in the folded format of flame graph tools (flamegraph.pl, speedscope).
+    The name of the file is sent back in the X-Profile header, or 'refused' when the rate limit was hit.
+    Requests without the flag only pay for checking it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not (request.headers.get(PROFILE_HEADER) or request.GET.get(PROFILE_PARAMETER)) or not is_admin(request):
+            return self.get_response(request)
+
+        if not acquire_slot():
+            logger.warning("profile_refused", path=request.path)
+            response = self.get_response(request)
+            response[PROFILE_HEADER] = 'refused'
+            return response
+
+        try:
+            sampler = StackSampler(threading.get_ident(), settings.PROFILER_INTERVAL, settings.PROFILER_MAX_SECONDS)
+            sampler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                sampler.stop()
+
+            view = request.resolver_match.url_name if request.resolver_match else None
+            now = time.time()
+            file_name = '{time}.{ms:03d}-{view}-{pid}.folded'.format(time=time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+                                                                     ms=int(now * 1000) % 1000, view=view or 'unmatched',
+                                                                     pid=os.getpid())
+            os.makedirs(settings.PROFILER_DIR, exist_ok=True)
+            with open(os.path.join(settings.PROFILER_DIR, file_name), 'w') as f:
+                f.write(sampler.folded())
+        finally:
+            _profiling.release()
+
+        logger.info("request_profiled", path=request.path, file=file_name, samples=sum(sampler.stacks.values()))
+        response[PROFILE_HEADER] = file_name
+        return response
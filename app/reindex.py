@@ -0,0 +1,156 @@
+import time
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.db import connections as db_connections
+from django.utils import timezone
+from django_elasticsearch_dsl.registries import registry
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl.connections import connections
+
+import structlog
+
+from . import outbox
+
+logger = structlog.get_logger("django_structlog")
+
+# settings of the index while it is loaded, restored before it is swapped in
+BULK_LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+
+class ReindexError(Exception):
+    pass
+
+
+def versioned_name(alias):
+    return '{alias}-{version}'.format(alias=alias, version=timezone.now().strftime('%Y%m%d%H%M%S'))
+
+
+def chunk_bounds(queryset, chunk_size):
+    """First and last primary key of consecutive chunks of chunk_size rows"""
+    pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+    return [(pks[i], pks[min(i + chunk_size, len(pks)) - 1]) for i in range(0, len(pks), chunk_size)]
+
+
+def init_worker():
+    # database and elasticsearch connections inherited from the parent process must not be shared
+    db_connections.close_all()
+    for alias, options in settings.ELASTICSEARCH_DSL.items():
+        connections.create_connection(alias, **options)
+
+
+def index_chunk(task):
+    """Index the rows of one chunk into index_name with a bulk request. Returns the number of indexed documents"""
+    document_class, index_name, first_pk, last_pk = task
+    document = document_class()
+    queryset = document.get_queryset().filter(pk__gte=first_pk, pk__lte=last_pk).order_by('pk')
+    actions = (
+        {'_index': index_name, '_id': document.generate_id(instance), '_source': document.prepare(instance)}
+        for instance in queryset.iterator() if document.should_index_object(instance)
+    )
+    indexed, _ = bulk(connections.get_connection(), actions, refresh=False)
+    return indexed
+
+
+def documents_of(index):
+    return [document for document in registry.get_documents() if document._index._name == index._name]
+
+
+def load(index, index_name, workers, chunk_size, report):
+    """Index all rows of the documents of index into index_name using worker processes. Returns the number of indexed documents"""
+    tasks = list()
+    total = 0
+    for document in documents_of(index):
+        queryset = document().get_queryset()
+        total += queryset.count()
+        tasks += [(document, index_name, first, last) for first, last in chunk_bounds(queryset, chunk_size)]
+
+    if workers > 1:
+        db_connections.close_all()
+        pool = Pool(workers, initializer=init_worker)
+        counts = pool.imap_unordered(index_chunk, tasks)
+    else:
+        pool = None
+        counts = map(index_chunk, tasks)
+
+    started = time.monotonic()
+    indexed = 0
+    try:
+        for chunks, count in enumerate(counts, start=1):
+            indexed += count
+            elapsed = time.monotonic() - started
+            report(index=index_name, indexed=indexed, total=total, chunks=chunks, of_chunks=len(tasks),
+                   docs_per_second=round(indexed / elapsed, 1) if elapsed else None)
+    finally:
+        if pool:
+            pool.terminate()
+
+    return indexed
+
+
+def swap_alias(alias, index_name, using=None):
+    """
+    Point alias at index_name, in one atomic request. Returns the names of the indices the alias pointed at before.
+    An index named like the alias (created by search_index --create) is deleted in the same request.
+    """
+    client = connections.get_connection(using)
+    actions = list()
+    previous = list()
+
+    if client.indices.exists_alias(name=alias):
+        previous = list(client.indices.get_alias(name=alias).keys())
+        actions += [{'remove': {'index': name, 'alias': alias}} for name in previous]
+    elif client.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    client.indices.update_aliases(body={'actions': actions})
+    return previous
+
+
+def reindex(index, workers=1, chunk_size=1000, keep_old=False, pause_timeout=3600, report=None):
+    """
+    Build a new versioned index for the documents of index and swap the alias named like the index to it.
+    Searches keep using the current index until the swap. The outbox is not drained meanwhile,
+    so writes made during the build are applied to the new index after it.
+    Returns the name of the new index.
+    """
+    report = report or (lambda **progress: None)
+    alias = index._name
+    index_name = versioned_name(alias)
+
+    new_index = index.clone(name=index_name)
+    target_settings = {key: value for key, value in index.to_dict().get('settings', {}).items() if key in BULK_LOAD_SETTINGS}
+    new_index.settings(**BULK_LOAD_SETTINGS)
+
+    outbox.pause(pause_timeout)
+    try:
+        new_index.create()
+        try:
+            indexed = load(index, index_name, workers, chunk_size, report)
+
+            new_index.put_settings(body={'index': {
+                'refresh_interval': target_settings.get('refresh_interval', '1s'),
+                'number_of_replicas': target_settings.get('number_of_replicas', 1),
+            }})
+            new_index.refresh()
+
+            count = connections.get_connection().count(index=index_name)['count']
+            if count != indexed:
+                raise ReindexError('{index} has {count} documents, {indexed} were indexed'.format(
+                    index=index_name, count=count, indexed=indexed))
+
+            previous = swap_alias(alias, index_name)
+        except Exception:
+            new_index.delete(ignore=404)
+            raise
+    finally:
+        outbox.resume()
+
+    logger.info("search_reindex_completed", alias=alias, index=index_name, documents=indexed, previous=previous)
+
+    if not keep_old:
+        for name in previous:
+            connections.get_connection().indices.delete(index=name, ignore=404)
+
+    return index_name
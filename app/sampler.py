@@ -0,0 +1,74 @@
+import random
+from functools import lru_cache
+from itertools import accumulate
+
+import names
+from pytz import country_names
+
+COUNTRIES = tuple(country_names.keys())
+
+MIN_PLAYER_AGE = 18
+MAX_PLAYER_AGE = 40
+AGES = tuple(range(MIN_PLAYER_AGE, MAX_PLAYER_AGE + 1))
+
+
+@lru_cache(maxsize=None)
+def load_distribution(filename):
+    """
+    Read a name distribution file of the `names` package once per process.
+    Returns the capitalized names and their cumulative weights, ready for random.choices.
+    """
+    population = list()
+    weights = list()
+    with open(filename) as name_file:
+        for line in name_file:
+            name, frequency, _, _ = line.split()
+            population.append(name.capitalize())
+            weights.append(float(frequency))
+
+    return tuple(population), tuple(accumulate(weights))
+
+
+class Sampler:
+    """
+    Draws random player attributes in batches.
+    Name distributions are shared by all samplers of the process, each sampler has its own random generator,
+    so pass a seed to get reproducible squads.
+    """
+
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+
+    def seed(self, seed=None):
+        self.random.seed(seed)
+
+    def _names(self, distribution, k):
+        population, cum_weights = load_distribution(names.FILES[distribution])
+        return self.random.choices(population, cum_weights=cum_weights, k=k)
+
+    def first_names(self, k):
+        return self._names('first:male', k)
+
+    def last_names(self, k):
+        return self._names('last', k)
+
+    def countries(self, k):
+        return self.random.choices(COUNTRIES, k=k)
+
+    def ages(self, k):
+        return self.random.choices(AGES, k=k)
+
+    def categories(self, k, choices=('GK', 'DEF', 'MID', 'FWD')):
+        return self.random.choices(choices, k=k)
+
+    def players(self, categories):
+        """Draw the attributes of one player per given category, as keyword arguments for Player"""
+        k = len(categories)
+        columns = zip(categories, self.first_names(k), self.last_names(k), self.countries(k), self.ages(k))
+        return [
+            dict(category=category, first_name=first_name, last_name=last_name, country=country, age=age)
+            for category, first_name, last_name, country, age in columns
+        ]
+
+
+default_sampler = Sampler()
@@ -0,0 +1,617 @@
+import base64
+import hashlib
+import json
+from decimal import Decimal, InvalidOperation
+from functools import reduce
+from operator import add, or_
+from urllib.parse import quote
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import Count, F, FloatField, Q
+from django.db.models.functions import Cast, Floor
+from elasticsearch.exceptions import TransportError
+
+import structlog
+
+from . import metrics
+from .breaker import CircuitBreaker
+from .documents import TransferListDocument
+from .models import Player, TransferList
+
+logger = structlog.get_logger("django_structlog")
+
+PLAYER_FIELDS = ('id', 'first_name', 'last_name', 'age', 'price', 'country', 'category')
+RANGE_LOOKUPS = ('gte', 'gt', 'lte', 'lt')
+
+# names of the backends answering searches, sent in the X-Search-Backend header
+ELASTICSEARCH = 'elasticsearch'
+POSTGRES = 'postgres'
+DATABASE = 'database'
+
+search_breaker = CircuitBreaker('elasticsearch_search',
+                                failure_threshold=settings.SEARCH_BREAKER_FAILURE_THRESHOLD,
+                                reset_timeout=settings.SEARCH_BREAKER_RESET_TIMEOUT)
+searches_counter = metrics.counter('searches_total', 'Searches by search (transfers, players) and the backend that answered them')
+autocomplete_counter = metrics.counter('search_autocomplete_total', 'Autocomplete requests by search, backend and cache result (hit, miss)')
+facets_counter = metrics.counter('search_facets_total', 'Facet requests by search, backend and cache result (hit, miss)')
+
+
+def render_player(player):
+    values = {field: getattr(player, field) for field in PLAYER_FIELDS}
+    # prices are doubles in elasticsearch, every backend renders them the same
+    values['price'] = float(values['price'])
+    return values
+
+
+def render_suggestion(player_id, first_name, last_name):
+    return {'id': player_id, 'name': '{first_name} {last_name}'.format(first_name=first_name, last_name=last_name)}
+
+
+def render_listing(listing):
+    """The same dict render_hit makes of a hit"""
+    return {'player': render_player(listing.player), 'asking_price': float(listing.asking_price)}
+
+
+class SearchSchema:
+    """
+    Params of a search over players, or over rows pointing to a player like transfer listings.
+    prefix is the path from the searched model to the player, e.g. 'player__' for the transfer list.
+    """
+
+    def __init__(self, name, queryset, prefix, ranges, ordering, render, price):
+        self.name = name
+        self.queryset = queryset
+        self.prefix = prefix
+        # price counted by the price histogram facet
+        self.price = price
+        # full text matches, the only scored part of a search
+        self.text = (prefix + 'name', prefix + 'team__name')
+        # exact values, several values may be sent comma separated
+        self.terms = (prefix + 'country', prefix + 'category')
+        # numbers, matched exactly or by range with the __gte, __gt, __lte and __lt suffixes
+        self.ranges = ranges
+        self.ordering = ordering
+        self.render = render
+
+
+TRANSFERS = SearchSchema('transfers', TransferList.objects.select_related('player'), 'player__',
+                         ranges={'asking_price': float, 'player__age': int},
+                         ordering=('asking_price', 'player__age', 'player__price', 'id'),
+                         render=render_listing, price='asking_price')
+# players of pooled teams are not visible to users yet
+PLAYERS = SearchSchema('players', Player.objects.exclude(team__in_pool=True), '',
+                       ranges={'price': float, 'age': int},
+                       ordering=('price', 'age', 'id'),
+                       render=render_player, price='price')
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class InvalidSearchParams(Exception):
+    pass
+
+
+class SearchFilters:
+    """Parsed search parameters, independent of the search backend"""
+
+    def __init__(self):
+        self.text = dict()
+        self.terms = dict()
+        self.ranges = dict()
+        self.ordering = list()
+
+    def __bool__(self):
+        return bool(self.text or self.terms or self.ranges or self.ordering)
+
+    def key(self):
+        """Digest of what the filters match, the same for the same filters sent in any order"""
+        matched = json.dumps([self.text, {param: sorted(values) for param, values in self.terms.items()}, self.ranges],
+                             sort_keys=True)
+        return hashlib.sha1(matched.encode()).hexdigest()
+
+
+def parse_params(params, schema=TRANSFERS):
+    """
+    Validate search parameters of the schema, e.g. {'player__category': 'DEF', 'player__age__lt': 25,
+    'asking_price__gte': 1000000, 'asking_price__lte': 3000000, 'ordering': 'asking_price'} for the transfer list.
+    Raises InvalidSearchParams listing every wrong parameter.
+    """
+    filters = SearchFilters()
+    error_message = list()
+
+    for key, value in params.items():
+        if key in schema.text:
+            filters.text[key] = str(value)
+        elif key in schema.terms:
+            filters.terms[key] = [v.strip().upper() for v in str(value).split(',') if v.strip()]
+        elif key == 'ordering':
+            for name in str(value).split(','):
+                name = name.strip()
+                if name.lstrip('-') not in schema.ordering:
+                    error_message.append('can not order by "{name}"'.format(name=name))
+                else:
+                    filters.ordering.append(name)
+        else:
+            field, lookup = key, 'exact'
+            for range_lookup in RANGE_LOOKUPS:
+                if key.endswith('__' + range_lookup):
+                    field, lookup = key[:-len(range_lookup) - 2], range_lookup
+            if field not in schema.ranges:
+                error_message.append('wrong param is sent: {key}'.format(key=key))
+                continue
+            try:
+                number = schema.ranges[field](value)
+            except (TypeError, ValueError):
+                error_message.append('{key} must be number'.format(key=key))
+                continue
+            filters.ranges.setdefault(field, dict())[lookup] = number
+
+    if error_message:
+        raise InvalidSearchParams(*error_message)
+
+    return filters
+
+
+def es_field(param):
+    return param.replace('__', '.')
+
+
+def encode_cursor(backend, sort, sort_values):
+    """Cursor of the page after sort_values, tagged with the backend and the sort that produced them"""
+    cursor = {'backend': backend, 'sort': sort, 'after': sort_values}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor')
+    if not isinstance(cursor, dict) or not isinstance(cursor.get('backend'), str) \
+            or not isinstance(cursor.get('sort'), list) or not isinstance(cursor.get('after'), list):
+        raise InvalidCursor('Invalid cursor')
+    return cursor
+
+
+def resume(cursor, backend, sort):
+    """
+    The sort values the page starts after, or None for the first page.
+    A cursor of another backend or sort, e.g. written by elasticsearch before a fallback to the database,
+    can not be read by this one, so the search starts over from the first page
+    """
+    if cursor is None:
+        return None
+    if cursor['backend'] != backend or cursor['sort'] != sort:
+        logger.info("search_cursor_restarted", backend=backend, cursor_backend=cursor['backend'])
+        return None
+    return cursor['after']
+
+
+def render_hit(source):
+    """Turn the _source of a TransferListDocument hit into the same dict TransferListSerializer renders"""
+    player = source.get('player', {})
+    return {
+        'player': {field: player.get(field) for field in PLAYER_FIELDS},
+        'asking_price': source.get('asking_price'),
+    }
+
+
+def build_search(filters):
+    """
+    Build the elasticsearch query of the filters.
+    Terms and ranges go to filter context, where they are cached and not scored. Only text matches are scored.
+    """
+    s = TransferListDocument.search(using=settings.SEARCH_CONNECTION)
+    for param, value in filters.text.items():
+        s = s.query("match", **{es_field(param): value})
+
+    for param, values in filters.terms.items():
+        s = s.filter("terms", **{es_field(param): values})
+
+    for param, lookups in filters.ranges.items():
+        exact = lookups.get('exact')
+        if exact is not None:
+            s = s.filter("term", **{es_field(param): exact})
+        bounds = {lookup: value for lookup, value in lookups.items() if lookup != 'exact'}
+        if bounds:
+            s = s.filter("range", **{es_field(param): bounds})
+
+    if filters.ordering:
+        sort = [{es_field(name.lstrip('-')): 'desc' if name.startswith('-') else 'asc'} for name in filters.ordering]
+    elif filters.text:
+        sort = [{'_score': 'desc'}]
+    else:
+        sort = []
+    if 'id' not in [name.lstrip('-') for name in filters.ordering]:
+        # a unique tiebreaker keeps search_after pages stable
+        sort.append({'id': 'asc'})
+
+    return s.sort(*sort)
+
+
+def search_transfers(filters, page_size, cursor=None):
+    """
+    Search the transfer list in elasticsearch and render the results straight from the hits, without a database query.
+    Pages are walked with search_after, the returned cursor points after the last result or is None on the last page.
+    """
+    s = build_search(filters)
+    sort = s.to_dict().get('sort', [])
+    search_after = resume(cursor, ELASTICSEARCH, sort)
+    s = s.source(['asking_price'] + ['player.{field}'.format(field=field) for field in PLAYER_FIELDS])
+    if search_after:
+        s = s.extra(search_after=search_after)
+    # one extra hit tells whether there is a next page
+    s = s.extra(size=page_size + 1)
+    s = s.params(request_timeout=settings.SEARCH_REQUEST_TIMEOUT)
+
+    hits = s.execute().hits
+    results = [render_hit(hit.to_dict()) for hit in hits[:page_size]]
+
+    next_cursor = None
+    if len(hits) > page_size:
+        next_cursor = encode_cursor(ELASTICSEARCH, sort, list(hits[page_size - 1].meta.sort))
+    return results, next_cursor
+
+
+def sort_value(row, field):
+    value = row
+    for attr in field.split('__'):
+        value = getattr(value, attr)
+    # prices go as strings, a float could not be compared exactly with the decimal column
+    return str(value) if isinstance(value, Decimal) else value
+
+
+def parse_sort_value(value):
+    """The value of sort_value back from a cursor"""
+    if isinstance(value, str):
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            raise InvalidCursor('Invalid cursor')
+    return value
+
+
+def after(sort, values):
+    """Rows after the given sort values: greater in the first field, or equal in it and after them in the next ones"""
+    clauses = list()
+    for i, (field, descending) in enumerate(sort):
+        clause = Q(**{'{field}__{lookup}'.format(field=field, lookup='lt' if descending else 'gt'): values[i]})
+        for (equal_field, _), value in zip(sort[:i], values):
+            clause &= Q(**{equal_field: value})
+        clauses.append(clause)
+    return reduce(or_, clauses)
+
+
+def suggest_transfers(prefix, size):
+    """Players on the transfer list whose full or last name starts with prefix, from the completion suggester"""
+    s = TransferListDocument.search(using=settings.SEARCH_CONNECTION)
+    s = s.suggest('names', prefix, completion={'field': 'name_suggest', 'size': size})
+    s = s.source(['player.id', 'player.name']).extra(size=0)
+    s = s.params(request_timeout=settings.SEARCH_REQUEST_TIMEOUT)
+
+    options = s.execute().suggest.names[0].options
+    return [{'id': option._source.player.id, 'name': option._source.player.name} for option in options]
+
+
+def age_range(bounds):
+    low, high = bounds
+    return {'from': low, 'to': high}
+
+
+def facet_transfers(filters):
+    """Facets of the transfer listings matching the filters, from aggregations of one request without hits"""
+    s = build_search(filters).extra(size=0, track_total_hits=True)
+    s.aggs.bucket('category', 'terms', field='player.category', size=settings.SEARCH_FACET_TERMS_SIZE)
+    s.aggs.bucket('country', 'terms', field='player.country', size=settings.SEARCH_FACET_TERMS_SIZE)
+    s.aggs.bucket('price', 'histogram', field='asking_price', interval=settings.SEARCH_FACET_PRICE_INTERVAL, min_doc_count=1)
+    s.aggs.bucket('age', 'range', field='player.age', ranges=[
+        {key: value for key, value in age_range(bounds).items() if value is not None} for bounds in settings.SEARCH_FACET_AGE_RANGES
+    ])
+    s = s.params(request_timeout=settings.SEARCH_REQUEST_TIMEOUT)
+
+    response = s.execute()
+    aggregations = response.aggregations
+    return {
+        'total': response.hits.total.value,
+        'category': [{'value': bucket.key, 'count': bucket.doc_count} for bucket in aggregations.category.buckets],
+        'country': [{'value': bucket.key, 'count': bucket.doc_count} for bucket in aggregations.country.buckets],
+        'price': [{'from': bucket.key, 'to': bucket.key + settings.SEARCH_FACET_PRICE_INTERVAL, 'count': bucket.doc_count}
+                  for bucket in aggregations.price.buckets],
+        'age': [dict(age_range(bounds), count=bucket.doc_count)
+                for bounds, bucket in zip(settings.SEARCH_FACET_AGE_RANGES, aggregations.age.buckets)],
+    }
+
+
+class ElasticsearchBackend:
+    name = ELASTICSEARCH
+    # players are not indexed
+    schemas = (TRANSFERS.name, )
+
+    def search(self, schema, filters, page_size, cursor=None):
+        return search_transfers(filters, page_size, cursor)
+
+    def suggest(self, schema, prefix, size):
+        return suggest_transfers(prefix, size)
+
+    def facets(self, schema, filters):
+        return facet_transfers(filters)
+
+
+class DatabaseBackend:
+    """
+    Searches with the ORM on any database.
+    Text is matched by whole words, on name columns indexed in upper case, and results are not scored.
+    """
+    name = DATABASE
+    schemas = (TRANSFERS.name, PLAYERS.name)
+
+    def match_text(self, schema, rows, filters):
+        lookups = {
+            schema.prefix + 'name': (schema.prefix + 'first_name__iexact', schema.prefix + 'last_name__iexact'),
+            schema.prefix + 'team__name': (schema.prefix + 'team__name__icontains', ),
+        }
+        for param, value in filters.text.items():
+            # any of the words matches, like a match query; an empty Q(pk__in=[]) matches nothing when there are no words
+            words = [Q(**{lookup: word}) for word in value.split() for lookup in lookups[param]]
+            rows = rows.filter(reduce(or_, words, Q(pk__in=[])))
+        return rows
+
+    def sort(self, filters):
+        """(field, descending) pairs, ending with the id tiebreaker like the elasticsearch sort"""
+        sort = [(name.lstrip('-'), name.startswith('-')) for name in filters.ordering]
+        if 'id' not in [field for field, descending in sort]:
+            sort.append(('id', False))
+        return sort
+
+    def filter(self, schema, filters):
+        rows = self.match_text(schema, schema.queryset.all(), filters)
+
+        for param, values in filters.terms.items():
+            rows = rows.filter(**{param + '__in': values})
+
+        for param, lookups in filters.ranges.items():
+            rows = rows.filter(**{param if lookup == 'exact' else '{param}__{lookup}'.format(param=param, lookup=lookup): value
+                                  for lookup, value in lookups.items()})
+        return rows
+
+    def search(self, schema, filters, page_size, cursor=None):
+        rows = self.filter(schema, filters)
+
+        sort = self.sort(filters)
+        # as it reads back from the json of cursors
+        sort_key = [[field, descending] for field, descending in sort]
+        search_after = resume(cursor, self.name, sort_key)
+        if search_after:
+            if len(search_after) != len(sort):
+                raise InvalidCursor('Invalid cursor')
+            rows = rows.filter(after(sort, [parse_sort_value(value) for value in search_after]))
+        rows = rows.order_by(*['-' + field if descending else field for field, descending in sort])
+
+        page = list(rows[:page_size + 1])
+        results = [schema.render(row) for row in page[:page_size]]
+
+        next_cursor = None
+        if len(page) > page_size:
+            next_cursor = encode_cursor(self.name, sort_key, [sort_value(page[page_size - 1], field) for field, descending in sort])
+        return results, next_cursor
+
+    def suggest(self, schema, prefix, size):
+        """Players whose first name, last name or full name starts with prefix, in alphabetical order"""
+        first_name, last_name = schema.prefix + 'first_name', schema.prefix + 'last_name'
+        matches = Q(**{first_name + '__istartswith': prefix}) | Q(**{last_name + '__istartswith': prefix})
+        head, _, tail = prefix.partition(' ')
+        if tail:
+            matches |= Q(**{first_name + '__iexact': head, last_name + '__istartswith': tail})
+
+        rows = schema.queryset.filter(matches).order_by(last_name, first_name, schema.prefix + 'id')
+        return [render_suggestion(*row) for row in rows.values_list(schema.prefix + 'id', first_name, last_name)[:size]]
+
+    @staticmethod
+    def count_by(rows, field, size=None):
+        counts = rows.values(field).annotate(count=Count('pk')).order_by('-count', field)
+        return [{'value': row[field], 'count': row['count']} for row in counts[:size]]
+
+    def facets(self, schema, filters):
+        """The facets of facet_transfers, with grouped queries over the filtered rows"""
+        rows = self.filter(schema, filters)
+        age = schema.prefix + 'age'
+        interval = settings.SEARCH_FACET_PRICE_INTERVAL
+
+        # the total and every age bucket in one query
+        age_filters = list()
+        for low, high in settings.SEARCH_FACET_AGE_RANGES:
+            bucket = Q()
+            if low is not None:
+                bucket &= Q(**{age + '__gte': low})
+            if high is not None:
+                bucket &= Q(**{age + '__lt': high})
+            age_filters.append(bucket)
+        counts = rows.aggregate(total=Count('pk'), **{
+            'age_{i}'.format(i=i): Count('pk', filter=bucket) for i, bucket in enumerate(age_filters)
+        })
+
+        prices = rows.annotate(price_bucket=Floor(F(schema.price) / interval)).values('price_bucket') \
+            .annotate(count=Count('pk')).order_by('price_bucket')
+
+        return {
+            'total': counts['total'],
+            'category': self.count_by(rows, schema.prefix + 'category', settings.SEARCH_FACET_TERMS_SIZE),
+            'country': self.count_by(rows, schema.prefix + 'country', settings.SEARCH_FACET_TERMS_SIZE),
+            'price': [{'from': float(row['price_bucket'] * interval), 'to': float((row['price_bucket'] + 1) * interval),
+                       'count': row['count']} for row in prices],
+            # empty buckets are kept, as elasticsearch range aggregations do
+            'age': [dict(age_range(bounds), count=counts['age_{i}'.format(i=i)])
+                    for i, bounds in enumerate(settings.SEARCH_FACET_AGE_RANGES)],
+        }
+
+
+class PostgresBackend(DatabaseBackend):
+    """
+    Searches with postgres full text search and trigram similarity, so ES is not needed.
+    Player names match by words or by similarity, which tolerates typos, team names the same way.
+    Both use the GIN indexes of migration 0006, the expressions here must stay the same as the indexed ones.
+    """
+    name = POSTGRES
+
+    @staticmethod
+    def text_vector(*fields):
+        return SearchVector(*fields, config='simple')
+
+    @staticmethod
+    def text_query(value):
+        return reduce(or_, [SearchQuery(word, config='simple') for word in value.split()])
+
+    def match_text(self, schema, rows, filters):
+        ranks = list()
+        for i, (param, value) in enumerate(filters.text.items()):
+            if not value.split():
+                return rows.none()
+
+            query = self.text_query(value)
+            if param == schema.prefix + 'name':
+                fields = (schema.prefix + 'first_name', schema.prefix + 'last_name')
+            else:
+                fields = (schema.prefix + 'team__name', )
+
+            vector = self.text_vector(*fields)
+            alias = 'text_vector_{i}'.format(i=i)
+            similar = [Q(**{field + '__trigram_similar': value}) for field in fields]
+            rows = rows.annotate(**{alias: vector}).filter(reduce(or_, similar, Q(**{alias: query})))
+            ranks.append(SearchRank(vector, query) + reduce(add, [TrigramSimilarity(field, value) for field in fields]))
+
+        if ranks:
+            # double precision, so ranks survive the round trip through cursors exactly
+            rows = rows.annotate(rank=Cast(reduce(add, ranks), FloatField()))
+        return rows
+
+    def sort(self, filters):
+        if filters.text and not filters.ordering:
+            return [('rank', True), ('id', False)]
+        return super(PostgresBackend, self).sort(filters)
+
+
+BACKENDS = {backend.name: backend for backend in (ElasticsearchBackend(), PostgresBackend(), DatabaseBackend())}
+
+
+def get_backend(name):
+    """The backend of the name; postgres needs its full text and trigram functions, other databases get the database backend"""
+    if name == POSTGRES and connection.vendor != 'postgresql':
+        name = DATABASE
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ImproperlyConfigured('Unknown search backend "{name}"'.format(name=name))
+
+
+def is_outage(error):
+    """Whether an elasticsearch error means it is unreachable or overloaded, not that the request was wrong"""
+    return not isinstance(error.status_code, int) or error.status_code >= 500 or error.status_code == 429
+
+
+def call(schema, method, *args):
+    """
+    Call method of the backend configured for the schema in SEARCH_BACKENDS.
+    Elasticsearch calls are answered by SEARCH_FALLBACK_BACKEND while its circuit breaker is open.
+    Returns the result and the name of the backend that answered.
+    """
+    backend = get_backend(settings.SEARCH_BACKENDS[schema.name])
+    if schema.name not in backend.schemas:
+        raise ImproperlyConfigured('{backend} can not search {schema}'.format(backend=backend.name, schema=schema.name))
+
+    if backend.name == ELASTICSEARCH:
+        if search_breaker.allow():
+            try:
+                result = getattr(backend, method)(schema, *args)
+            except TransportError as e:
+                if not is_outage(e):
+                    search_breaker.success()
+                    raise
+                search_breaker.failure()
+                logger.warning("search_fallback", error=str(e), breaker=search_breaker.state)
+            else:
+                search_breaker.success()
+                return result, backend.name
+
+        backend = get_backend(settings.SEARCH_FALLBACK_BACKEND)
+
+    return getattr(backend, method)(schema, *args), backend.name
+
+
+def execute(schema, filters, page_size, cursor=None):
+    """Search with the configured backend. Returns the results, the cursor of the next page and the name of the backend that answered"""
+    cursor = decode_cursor(cursor) if cursor else None
+    (results, next_cursor), backend = call(schema, 'search', filters, page_size, cursor)
+    searches_counter.inc(search=schema.name, backend=backend)
+    return results, next_cursor, backend
+
+
+def parse_autocomplete_params(params):
+    """Validate the q and size parameters of an autocomplete request. Returns the normalized prefix and the size"""
+    error_message = list()
+    # the same prefix typed in any case or spacing shares one cache entry
+    prefix = ' '.join(str(params.get('q', '')).split()).lower()
+    size = settings.SEARCH_AUTOCOMPLETE_SIZE
+
+    if not prefix:
+        error_message.append('q is not sent')
+    elif len(prefix) > settings.SEARCH_AUTOCOMPLETE_MAX_LENGTH:
+        error_message.append('q must be at most {length} characters'.format(length=settings.SEARCH_AUTOCOMPLETE_MAX_LENGTH))
+
+    if 'size' in params:
+        try:
+            size = int(params['size'])
+        except (TypeError, ValueError):
+            error_message.append('size must be number')
+        else:
+            if not 1 <= size <= settings.SEARCH_AUTOCOMPLETE_MAX_SIZE:
+                error_message.append('size must be between 1 and {size}'.format(size=settings.SEARCH_AUTOCOMPLETE_MAX_SIZE))
+
+    if error_message:
+        raise InvalidSearchParams(*error_message)
+
+    return prefix, size
+
+
+def autocomplete_key(schema, prefix, size):
+    # quoted, memcached keys can not contain spaces or control characters
+    return 'search_autocomplete:{schema}:{size}:{prefix}'.format(schema=schema.name, size=size, prefix=quote(prefix))
+
+
+def cached_call(counter, key, timeout, schema, method, *args):
+    """call() answered from the shared cache for timeout seconds. Returns the result and the name of the backend"""
+    cached = cache.get(key)
+    if cached is not None:
+        counter.inc(search=schema.name, backend=cached[1], cache='hit')
+        return cached
+
+    result, backend = call(schema, method, *args)
+    cache.set(key, (result, backend), timeout)
+    counter.inc(search=schema.name, backend=backend, cache='miss')
+    return result, backend
+
+
+def autocomplete(schema, prefix, size):
+    """
+    Top size suggestions of players whose name starts with prefix, as {'id', 'name'} dicts.
+    Results are kept in the shared cache for SEARCH_AUTOCOMPLETE_CACHE_TIMEOUT seconds, so popular prefixes
+    are answered without reaching the backend; a sold or renamed player may be suggested until then.
+    Returns the suggestions and the name of the backend that answered them.
+    """
+    return cached_call(autocomplete_counter, autocomplete_key(schema, prefix, size), settings.SEARCH_AUTOCOMPLETE_CACHE_TIMEOUT,
+                       schema, 'suggest', prefix, size)
+
+
+def facets(schema, filters):
+    """
+    Counts of the rows matching the filters: total, per category and country, per price interval and age range.
+    Ordering is ignored. Results are cached for SEARCH_FACETS_CACHE_TIMEOUT seconds per distinct filters.
+    Returns the facets and the name of the backend that answered them.
+    """
+    key = 'search_facets:{schema}:{filters}'.format(schema=schema.name, filters=filters.key())
+    return cached_call(facets_counter, key, settings.SEARCH_FACETS_CACHE_TIMEOUT, schema, 'facets', filters)
@@ -0,0 +1,169 @@
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models
+from django_elasticsearch_dsl.apps import DEDConfig
+from django_elasticsearch_dsl.registries import registry
+from django_elasticsearch_dsl.signals import RealTimeSignalProcessor
+
+from . import metrics, outbox
+
+index_updates_counter = metrics.counter('search_index_updates_total', 'Elasticsearch document updates caused by model saves by result (sent, skipped)')
+
+
+class ChangeAwareSignalProcessor(RealTimeSignalProcessor):
+    """
+    Real-time signal processor which writes to Elasticsearch only when a save changed a field that is indexed.
+
+    Documents list the model fields they read in Django.tracked_fields, per model, e.g.
+        tracked_fields = {TransferList: ['asking_price', 'player'], Player: ['first_name', 'price']}
+    Values of tracked fields are remembered when an instance is loaded, and on save only the documents
+    (own and related) reading one of the changed fields are updated.
+    Documents that do not declare tracked fields for a model are updated on every save, as with RealTimeSignalProcessor.
+    """
+
+    def setup(self):
+        self.tracked_fields = self.collect_tracked_fields()
+        self.snapshot_fields = dict()
+        for (document, model), fields in self.tracked_fields.items():
+            self.snapshot_fields[model] = self.snapshot_fields.get(model, frozenset()) | fields
+
+        # only instances of models read by documents need their values remembered
+        for model in self.snapshot_fields:
+            models.signals.post_init.connect(self.handle_init, sender=model)
+        super(ChangeAwareSignalProcessor, self).setup()
+
+    def teardown(self):
+        for model in self.snapshot_fields:
+            models.signals.post_init.disconnect(self.handle_init, sender=model)
+        super(ChangeAwareSignalProcessor, self).teardown()
+
+    @staticmethod
+    def collect_tracked_fields():
+        """Map (document, model) pairs to the attnames of the model fields the document reads"""
+        tracked_fields = dict()
+        for document in registry.get_documents():
+            for model, field_names in getattr(document.Django, 'tracked_fields', {}).items():
+                tracked_fields[document, model] = frozenset(model._meta.get_field(name).attname for name in field_names)
+        return tracked_fields
+
+    def handle_init(self, sender, instance, **kwargs):
+        fields = self.snapshot_fields.get(sender)
+        if fields:
+            self.remember(instance, fields)
+
+    @staticmethod
+    def remember(instance, fields):
+        # deferred fields are not in __dict__, reading them with getattr would cost a query each
+        instance.__dict__.setdefault('_indexed_state', dict()).update({field: instance.__dict__[field] for field in fields if field in instance.__dict__})
+
+    def saved_fields(self, instance, update_fields=None):
+        fields = self.snapshot_fields[instance.__class__]
+        if update_fields is not None:
+            fields = fields & {instance._meta.get_field(name).attname for name in update_fields}
+        return fields
+
+    def changed_fields(self, instance, fields):
+        """Attnames among fields whose values differ from the ones the instance was loaded (or last saved) with"""
+        state = getattr(instance, '_indexed_state', {})
+        return {
+            field for field in fields
+            if field in instance.__dict__ and (field not in state or state[field] != instance.__dict__[field])
+        }
+
+    def handle_save(self, sender, instance, **kwargs):
+        # m2m changes come through here too, without the post_save arguments; those are always indexed
+        tracked = kwargs.get('signal') is models.signals.post_save and sender in self.snapshot_fields
+        if tracked:
+            fields = self.saved_fields(instance, kwargs.get('update_fields'))
+            changed = None if kwargs.get('created') else self.changed_fields(instance, fields)
+        else:
+            changed = None
+
+        self.update(instance, changed)
+        self.update_related(instance, changed)
+
+        if tracked:
+            # following saves of the same instance are compared against what was just saved
+            self.remember(instance, fields)
+
+    def should_update(self, document, model, changed):
+        tracked = self.tracked_fields.get((document, model))
+        return changed is None or tracked is None or bool(tracked & changed)
+
+    def update(self, instance, changed):
+        if not DEDConfig.autosync_enabled():
+            return
+
+        model = instance.__class__
+        for document in registry.get_documents([model]):
+            if document.django.ignore_signals:
+                continue
+            if self.should_update(document, model, changed):
+                index_updates_counter.inc(result='sent')
+                self.index(document, instance)
+            else:
+                index_updates_counter.inc(result='skipped')
+
+    @staticmethod
+    def deleted_with(model, related_model):
+        """Whether deleting a related_model row deletes the model rows pointing to it, e.g. a player's listing"""
+        relations = [field for field in model._meta.concrete_fields
+                     if field.is_relation and field.related_model is related_model]
+        return bool(relations) and all(field.remote_field.on_delete is models.CASCADE for field in relations)
+
+    def update_related(self, instance, changed, deleted=False):
+        if not DEDConfig.autosync_enabled():
+            return
+
+        model = instance.__class__
+        for document in registry.get_documents():
+            if model not in document.django.related_models:
+                continue
+            # their own delete signals queue them for removal, looking them up would cost a query per deleted row
+            if deleted and self.deleted_with(document.django.model, model):
+                continue
+            if not self.should_update(document, model, changed):
+                index_updates_counter.inc(result='skipped')
+                continue
+
+            document_instance = document()
+            try:
+                related = document_instance.get_instances_from_related(instance)
+            except ObjectDoesNotExist:
+                related = None
+
+            if related is not None:
+                index_updates_counter.inc(result='sent')
+                self.index(document, related)
+
+    def index(self, document, thing):
+        """Write an instance, or instances, of the document's model to Elasticsearch"""
+        document().update(thing)
+
+
+class QueuedSignalProcessor(ChangeAwareSignalProcessor):
+    """
+    Change-aware signal processor which does not call Elasticsearch at all.
+    Writes are recorded in the SearchIndexOutbox table, in the transaction of the model change,
+    and applied in bulk by the drain_search_index command.
+    """
+
+    def index(self, document, thing):
+        if isinstance(thing, models.Model):
+            object_ids = [thing.pk]
+        elif isinstance(thing, models.QuerySet):
+            object_ids = list(thing.values_list('pk', flat=True))
+        else:
+            object_ids = [instance.pk for instance in thing]
+
+        outbox.enqueue(document.django.model, object_ids)
+
+    def handle_pre_delete(self, sender, instance, **kwargs):
+        # documents of related models are queued for reindexing, the worker reads them after the delete
+        self.update_related(instance, None, deleted=True)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        if not DEDConfig.autosync_enabled():
+            return
+
+        if any(not document.django.ignore_signals for document in registry.get_documents([sender])):
+            outbox.enqueue(sender, [instance.pk], action=outbox.DELETE)
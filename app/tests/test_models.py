@@ -1,7 +1,22 @@
+import json
+import os
+import tempfile
 from decimal import Decimal
+from unittest import mock
 
-from django.test import TestCase
-from ..models import User, Team, Player, TransferList, TransferHistory
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from pytz import country_names
+from .. import metrics, outbox, pool, reindex
+from ..documents import TransferListDocument
+from ..management.commands.benchmark import regressions
+from ..models import User, Team, Player, TransferList, TransferHistory, SearchIndexOutbox, team_cache, player_cache
+from ..breaker import CircuitBreaker
+from ..cache import TwoLevelCache
+from ..sampler import Sampler
 
 
 class UserTest(TestCase):
@@ -41,6 +56,68 @@ class TeamTest(TestCase):
 
         self.assertEqual(team_value, self.t1.value)
 
+    def test_generate_team(self):
+        # unit test
+        self.assertEqual(self.t2, User.objects.get(id=self.u1.id).team)
+        self.assertEqual(self.t1.players.count(), settings.TEAM_TOTAL_PLAYERS)
+        self.assertEqual(self.t1.players.filter(category='GK').count(), self.t1.gk_count)
+        self.assertEqual(self.t1.players.filter(category='DEF').count(), self.t1.def_count)
+        self.assertEqual(self.t1.players.filter(category='MID').count(), self.t1.mid_count)
+        self.assertEqual(self.t1.players.filter(category='FWD').count(), self.t1.fwd_count)
+        self.assertEqual(self.t1.value, settings.TEAM_TOTAL_PLAYERS * settings.PLAYER_INITIAL_PRICE)
+
+    def test_generate_team_queries(self):
+        # unit test
+        with CaptureQueriesContext(connection) as ctx:
+            Team.objects.generate_team(name='Bulk Team', country='UZ')
+
+        inserts = [q for q in ctx.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+
+    def test_generate_teams(self):
+        # unit test
+        teams = Team.objects.generate_teams(3, batch_size=2)
+
+        self.assertEqual(len(teams), 3)
+        for team in teams:
+            self.assertFalse(User.objects.filter(team=team).exists())
+            self.assertEqual(team.players.count(), settings.TEAM_TOTAL_PLAYERS)
+
+    def test_recalculate_values(self):
+        # unit test
+        Team.objects.filter(id__in=[self.t1.id, self.t5.id]).update(value=1)
+        Team.objects.recalculate_values([self.t1.id, self.t5.id])
+
+        self.assertEqual(Team.objects.get(id=self.t1.id).value, settings.TEAM_TOTAL_PLAYERS * settings.PLAYER_INITIAL_PRICE)
+        self.assertEqual(Team.objects.get(id=self.t5.id).value, 0)
+
+    def test_recalculate_all_values(self):
+        # unit test
+        team_cache.get(self.t1.id)
+        Team.objects.update(value=1)
+        with self.assertNumQueries(1):
+            # a single UPDATE, without reading the ids
+            updated = Team.objects.recalculate_values()
+
+        self.assertEqual(updated, Team.objects.count())
+        self.assertEqual(team_cache.get(self.t1.id).value, settings.TEAM_TOTAL_PLAYERS * settings.PLAYER_INITIAL_PRICE)
+
+    def test_add_remove_player_value(self):
+        # unit test
+        p1 = Player.objects.create(first_name='fname', last_name='lname', category='FWD', country='US', age=26, price=1000000)
+        self.t5.add_player(p1)
+
+        t5 = Team.objects.get(id=self.t5.id)
+        self.assertEqual(t5.value, 1000000)
+        self.assertEqual(t5.fwd_count, 1)
+
+        t5.remove_player(Player.objects.get(id=p1.id))
+
+        t5 = Team.objects.get(id=self.t5.id)
+        self.assertEqual(t5.value, 0)
+        self.assertEqual(t5.fwd_count, 0)
+        self.assertIsNone(Player.objects.get(id=p1.id).team)
+
     def test_add_player(self):
         # unit test
         p1 = Player.objects.create(first_name='fname', last_name='lname', category='FWD', country='US', age=26, price=1000000)
@@ -49,6 +126,457 @@ class TeamTest(TestCase):
             self.t1.add_player(p1)
 
 
+class TeamPoolTest(TestCase):
+    """ Test module for the pool of pre-generated teams """
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(email='test1@mail.ru', password='password1234567')
+
+    def test_refill(self):
+        # unit test
+        self.assertEqual(pool.refill(size=2, batch_size=1), 2)
+        self.assertEqual(pool.refill(size=2), 0)
+        self.assertEqual(pool.pool_depth(), 2)
+
+    def test_assign_team(self):
+        # unit test
+        pool.refill(size=1)
+        pooled_team = Team.objects.get(in_pool=True)
+
+        self.assertEqual(pool.assign_team(self.u1), pooled_team)
+        self.assertEqual(pool.pool_depth(), 0)
+
+    def test_assign_team_empty_pool(self):
+        # unit test
+        team = pool.assign_team(self.u1)
+
+        self.assertEqual(User.objects.get(id=self.u1.id).team, team)
+        self.assertEqual(team.players.count(), settings.TEAM_TOTAL_PLAYERS)
+
+
+class TransferListTest(TestCase):
+    """ Test module for TransferList model """
+
+    def setUp(self):
+        self.t1 = Team.objects.generate_team()
+        self.t2 = Team.objects.generate_team()
+        self.player = self.t1.players.filter(category='DEF').first()
+        self.player.set_to_transfer_list(1500000)
+
+    def test_make_transfer(self):
+        # unit test
+        self.player.transfer_offer.make_transfer(self.t2)
+
+        player = Player.objects.get(id=self.player.id)
+        t1 = Team.objects.get(id=self.t1.id)
+        t2 = Team.objects.get(id=self.t2.id)
+        initial_value = settings.TEAM_TOTAL_PLAYERS * settings.PLAYER_INITIAL_PRICE
+
+        self.assertEqual(player.team, t2)
+        self.assertGreater(player.price, settings.PLAYER_INITIAL_PRICE)
+        self.assertEqual(t1.budget, settings.TEAM_INITIAL_BUDGET + 1500000)
+        self.assertEqual(t2.budget, settings.TEAM_INITIAL_BUDGET - 1500000)
+        self.assertEqual(t1.def_count, settings.TEAM_DEFENDERS - 1)
+        self.assertEqual(t2.def_count, settings.TEAM_DEFENDERS + 1)
+        self.assertEqual(t1.value, initial_value - settings.PLAYER_INITIAL_PRICE)
+        self.assertEqual(t2.value, initial_value + player.price)
+        self.assertFalse(TransferList.objects.filter(player=player).exists())
+        self.assertEqual(TransferHistory.objects.filter(player=player).count(), 1)
+
+    def test_make_transfer_twice(self):
+        # unit test
+        t3 = Team.objects.generate_team()
+        listing = self.player.transfer_offer
+        stale_listing = TransferList.objects.get(id=listing.id)
+
+        listing.make_transfer(self.t2)
+        with self.assertRaisesMessage(Exception, 'This player is already sold'):
+            stale_listing.make_transfer(t3)
+
+        self.assertEqual(Team.objects.get(id=t3.id).budget, settings.TEAM_INITIAL_BUDGET)
+        self.assertEqual(TransferHistory.objects.filter(player=self.player).count(), 1)
+
+    def test_make_transfer_budget(self):
+        # unit test
+        Team.objects.filter(id=self.t2.id).update(budget=1000)
+
+        with self.assertRaisesMessage(Exception, 'Buying team does not have enough budget to buy this player!'):
+            self.player.transfer_offer.make_transfer(self.t2)
+
+        self.assertEqual(Player.objects.get(id=self.player.id).team_id, self.t1.id)
+        self.assertTrue(TransferList.objects.filter(player=self.player).exists())
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=True)
+class SearchIndexSignalTest(TestCase):
+    """ Test module for queueing reindexing only when indexed fields change """
+
+    def setUp(self):
+        team = Team.objects.generate_team()
+        self.player = team.players.first()
+        self.player.set_to_transfer_list(1500000)
+        self.listing = self.player.transfer_offer
+        SearchIndexOutbox.objects.all().delete()
+
+    def test_unchanged(self):
+        # unit test
+        player = Player.objects.get(id=self.player.id)
+        listing = TransferList.objects.get(player=player)
+
+        player.save()
+        listing.save()
+        player.save(update_fields=['team'])
+
+        self.assertFalse(SearchIndexOutbox.objects.exists())
+
+    def test_changed(self):
+        # unit test
+        player = Player.objects.get(id=self.player.id)
+        listing = TransferList.objects.get(player=player)
+
+        player.first_name = 'Changed'
+        player.save()
+        player.save()
+        listing.asking_price = 2000000
+        listing.save()
+
+        entries = SearchIndexOutbox.objects.all()
+        self.assertEqual(len(entries), 2)
+        for entry in entries:
+            self.assertEqual((entry.model, entry.object_id, entry.action), ('app.TransferList', listing.id, 'index'))
+
+    def test_update_fields(self):
+        # unit test
+        player = Player.objects.get(id=self.player.id)
+        player.increase_price()
+
+        player.save(update_fields=['team'])
+        self.assertEqual(SearchIndexOutbox.objects.count(), 0)
+        player.save(update_fields=['price'])
+        self.assertEqual(SearchIndexOutbox.objects.count(), 1)
+
+    def test_delete(self):
+        # unit test
+        listing_id = self.listing.id
+        self.listing.delete()
+
+        entry = SearchIndexOutbox.objects.get()
+        self.assertEqual((entry.object_id, entry.action), (listing_id, 'delete'))
+
+    def test_delete_team(self):
+        # unit test
+        team = self.player.team
+        listing_id = self.listing.id
+
+        # listings go with their players, they are not looked up player by player to be reindexed
+        with CaptureQueriesContext(connection) as captured:
+            team.delete()
+        self.assertFalse([query for query in captured.captured_queries
+                          if query['sql'].startswith('SELECT') and 'app_transferlist' in query['sql'].split('WHERE')[0]
+                          and '"player_id" = ' in query['sql']])
+
+        entry = SearchIndexOutbox.objects.get()
+        self.assertEqual((entry.object_id, entry.action), (listing_id, 'delete'))
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=True)
+class SearchIndexOutboxTest(TestCase):
+    """ Test module for applying queued Elasticsearch writes """
+
+    def setUp(self):
+        patcher = mock.patch.object(TransferListDocument, 'update')
+        self.update = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        team = Team.objects.generate_team()
+        self.player = team.players.first()
+        self.player.set_to_transfer_list(1500000)
+        self.listing = self.player.transfer_offer
+
+    def test_drain(self):
+        # unit test
+        outbox.enqueue(TransferList, [self.listing.id, self.listing.id])
+
+        self.assertEqual(outbox.drain(), 3)
+        self.update.assert_called_once_with([self.listing])
+        self.assertFalse(SearchIndexOutbox.objects.exists())
+        self.assertEqual(outbox.queue_lag(), 0)
+
+    def test_batched(self):
+        # unit test
+        SearchIndexOutbox.objects.all().delete()
+        with CaptureQueriesContext(connection) as captured:
+            with outbox.batched():
+                outbox.enqueue(TransferList, [self.listing.id])
+                with outbox.batched():
+                    outbox.enqueue(TransferList, [self.listing.id], action=outbox.DELETE)
+                outbox.enqueue(Player, [self.player.id])
+                self.assertFalse(SearchIndexOutbox.objects.exists())
+
+        self.assertEqual(len([query for query in captured.captured_queries if query['sql'].startswith('INSERT')]), 1)
+        self.assertEqual(sorted(SearchIndexOutbox.objects.values_list('model', 'object_id', 'action')),
+                         [('app.Player', self.player.id, 'index'), ('app.TransferList', self.listing.id, 'delete')])
+
+    def test_batched_raises(self):
+        # unit test
+        SearchIndexOutbox.objects.all().delete()
+        with self.assertRaises(ValueError):
+            with outbox.batched():
+                outbox.enqueue(TransferList, [self.listing.id])
+                raise ValueError()
+
+        self.assertFalse(SearchIndexOutbox.objects.exists())
+        outbox.enqueue(TransferList, [self.listing.id])
+        self.assertEqual(SearchIndexOutbox.objects.count(), 1)
+
+    def test_drain_deleted(self):
+        # unit test
+        listing_id = self.listing.id
+        self.listing.delete()
+
+        outbox.drain()
+        self.update.assert_called_once()
+        self.assertEqual(self.update.call_args.kwargs['action'], 'delete')
+        self.assertEqual([listing.pk for listing in self.update.call_args.args[0]], [listing_id])
+
+    def test_drain_paused(self):
+        # unit test
+        outbox.pause(60)
+        self.addCleanup(outbox.resume)
+
+        self.assertEqual(outbox.drain(), 0)
+        self.update.assert_not_called()
+        self.assertEqual(outbox.queue_depth(), 1)
+
+    def test_drain_failed(self):
+        # unit test
+        self.update.side_effect = ConnectionError
+
+        with self.assertRaises(ConnectionError):
+            outbox.drain()
+
+        self.assertEqual(outbox.queue_depth(), 1)
+        self.assertGreaterEqual(outbox.queue_lag(), 0)
+
+
+class ReindexTest(TestCase):
+    """ Test module for rebuilding search indices behind an alias """
+
+    def test_chunk_bounds(self):
+        # unit test
+        teams = Team.objects.generate_teams(5)
+        ids = sorted(team.id for team in teams)
+
+        self.assertEqual(reindex.chunk_bounds(Team.objects.all(), 2), [(ids[0], ids[1]), (ids[2], ids[3]), (ids[4], ids[4])])
+        self.assertEqual(reindex.chunk_bounds(Team.objects.none(), 2), [])
+
+    def test_swap_alias(self):
+        # unit test
+        with mock.patch.object(reindex.connections, 'get_connection') as get_connection:
+            client = get_connection.return_value
+            client.indices.exists_alias.return_value = True
+            client.indices.get_alias.return_value = {'transfer_list-1': {}}
+
+            self.assertEqual(reindex.swap_alias('transfer_list', 'transfer_list-2'), ['transfer_list-1'])
+            client.indices.update_aliases.assert_called_once_with(body={'actions': [
+                {'remove': {'index': 'transfer_list-1', 'alias': 'transfer_list'}},
+                {'add': {'index': 'transfer_list-2', 'alias': 'transfer_list'}},
+            ]})
+
+    def test_swap_alias_replaces_index(self):
+        # unit test
+        with mock.patch.object(reindex.connections, 'get_connection') as get_connection:
+            client = get_connection.return_value
+            client.indices.exists_alias.return_value = False
+            client.indices.exists.return_value = True
+
+            self.assertEqual(reindex.swap_alias('transfer_list', 'transfer_list-2'), [])
+            client.indices.update_aliases.assert_called_once_with(body={'actions': [
+                {'remove_index': {'index': 'transfer_list'}},
+                {'add': {'index': 'transfer_list-2', 'alias': 'transfer_list'}},
+            ]})
+
+
+class CircuitBreakerTest(TestCase):
+    """ Test module for the circuit breaker """
+
+    def setUp(self):
+        self.now = 0
+        self.breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=10, clock=lambda: self.now)
+
+    def test_open(self):
+        # unit test
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open(self):
+        # unit test
+        self.breaker.failure()
+        self.breaker.failure()
+        self.now = 10
+
+        # one probe is let through
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        self.now = 20
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+
+class TwoLevelCacheTest(TestCase):
+    """ Test module for the local and shared cache tiers """
+
+    def setUp(self):
+        cache.clear()
+        self.now = 0
+        # two workers sharing the cache
+        self.worker = TwoLevelCache('test', local_size=2, local_timeout=10, shared_timeout=60, clock=lambda: self.now)
+        self.other_worker = TwoLevelCache('test', local_size=2, local_timeout=10, shared_timeout=60, clock=lambda: self.now)
+
+    def test_tiers(self):
+        # unit test
+        with mock.patch('app.cache.cache_requests_counter') as counter:
+            self.assertEqual(self.worker.get_or_load('a', lambda: 1), 1)
+            self.assertEqual(self.worker.get_or_load('a', lambda: 2), 1)
+            self.assertEqual(self.other_worker.get_or_load('a', lambda: 2), 1)
+
+        self.assertEqual([call.kwargs['result'] for call in counter.inc.call_args_list], ['miss', 'local', 'shared'])
+        self.assertIsNone(self.worker.get_or_load('b', lambda: None))
+        self.assertEqual(self.worker.get_or_load('b', lambda: 3), 3)
+
+    def test_lru(self):
+        # unit test
+        for key in ('a', 'b', 'c'):
+            self.worker.get_or_load(key, lambda: key)
+            self.worker.get_or_load('a', lambda: 'a')
+
+        self.assertEqual(list(self.worker._local), ['c', 'a'])
+
+    def test_delete(self):
+        # unit test
+        self.worker.get_or_load('a', lambda: 1)
+        self.other_worker.get_or_load('a', lambda: 1)
+
+        self.worker.delete('a')
+        # the other worker checks the version of its local copy
+        self.assertEqual(self.other_worker.get_or_load('a', lambda: 2), 2)
+        self.assertEqual(self.worker.get_or_load('a', lambda: 3), 2)
+
+    def test_deleted_while_loading(self):
+        # unit test
+        def load():
+            self.other_worker.delete('a')
+            return 'old'
+
+        self.assertEqual(self.worker.get_or_load('a', load), 'old')
+        self.assertEqual(self.worker.get_or_load('a', lambda: 'new'), 'new')
+        self.assertEqual(self.other_worker.get_or_load('a', lambda: 'newer'), 'new')
+
+    def test_clear(self):
+        # unit test
+        self.worker.get_or_load('a', lambda: 1)
+        self.other_worker.get_or_load('b', lambda: 1)
+
+        self.other_worker.clear()
+        self.assertEqual(self.worker.get_or_load('a', lambda: 2), 2)
+        self.assertEqual(self.other_worker.get_or_load('b', lambda: 2), 2)
+        self.assertEqual(self.other_worker.get_or_load('a', lambda: 3), 2)
+
+    def test_trusted_local(self):
+        # unit test
+        worker = TwoLevelCache('test', local_size=2, local_timeout=10, shared_timeout=60, verify_local=False, clock=lambda: self.now)
+        worker.get_or_load('a', lambda: 1)
+        self.other_worker.delete('a')
+
+        self.assertEqual(worker.get_or_load('a', lambda: 2), 1)
+        self.now = 10
+        self.assertEqual(worker.get_or_load('a', lambda: 2), 2)
+
+
+class ObjectCacheTest(TestCase):
+    """ Test module for the Team and Player object caches """
+
+    def setUp(self):
+        cache.clear()
+        self.team = Team.objects.generate_team()
+        self.player = self.team.players.first()
+
+    def test_get(self):
+        # unit test
+        with self.assertNumQueries(1):
+            team_cache.get(self.team.id)
+        with self.assertNumQueries(0):
+            team = team_cache.get(str(self.team.id))
+
+        self.assertEqual(team.name, self.team.name)
+        # every lookup gets its own copy
+        team.name = 'changed'
+        self.assertEqual(team_cache.get(self.team.id).name, self.team.name)
+
+        with self.assertRaises(Team.DoesNotExist):
+            team_cache.get(0)
+
+    def test_invalidation(self):
+        # unit test
+        team_cache.get(self.team.id)
+        player_cache.get(self.player.id)
+
+        self.team.update_counters(budget=100)
+        self.assertEqual(team_cache.get(self.team.id).budget, self.team.budget)
+
+        self.player.first_name = 'changed'
+        self.player.save()
+        self.assertEqual(player_cache.get(self.player.id).first_name, 'changed')
+
+        self.team.remove_player(self.player)
+        self.assertIsNone(player_cache.get(self.player.id).team_id)
+
+        self.team.delete()
+        with self.assertRaises(Team.DoesNotExist):
+            team_cache.get(self.team.id)
+
+    def test_transfer(self):
+        # unit test
+        buying_team = Team.objects.generate_team()
+        team_cache.get(self.team.id)
+        team_cache.get(buying_team.id)
+        player_cache.get(self.player.id)
+
+        self.player.set_to_transfer_list(1000000)
+        TransferList.objects.get(player=self.player).make_transfer(buying_team)
+
+        self.assertEqual(player_cache.get(self.player.id).team_id, buying_team.id)
+        self.assertEqual(team_cache.get(self.team.id).budget, self.team.budget + 1000000)
+        self.assertEqual(team_cache.get(buying_team.id).budget, buying_team.budget)
+
+
+class SamplerTest(TestCase):
+    """ Test module for the player attributes sampler """
+
+    def test_seeded(self):
+        # unit test
+        categories = ['GK', 'DEF', 'MID', 'FWD']
+        self.assertEqual(Sampler(seed=7).players(categories), Sampler(seed=7).players(categories))
+
+    def test_players(self):
+        # unit test
+        players = Sampler().players(['GK'] * 50)
+
+        self.assertEqual(len(players), 50)
+        for player in players:
+            self.assertEqual(player['category'], 'GK')
+            self.assertTrue(player['first_name'] and player['last_name'])
+            self.assertIn(player['country'], country_names)
+            self.assertTrue(18 <= player['age'] <= 40)
+
+
 class PlayerTest(TestCase):
     """ Test module for Player model """
 
@@ -64,3 +592,126 @@ class PlayerTest(TestCase):
         old_price = self.p1.price
         self.p1.increase_price()
         self.assertGreater(self.p1.price, old_price)
+
+
+class MetricsTest(TestCase):
+    """ Test module for the multi-process Prometheus metrics """
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.counter = self.registry.register(metrics.Counter('transfers_total', 'Transfers'))
+        self.gauge = self.registry.register(metrics.Gauge('breaker_state', 'Breaker state'))
+        self.histogram = self.registry.register(metrics.Histogram('latency_seconds', 'Latency', buckets=(0.1, 1)))
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_histogram(self):
+        # unit test
+        for value in (0.05, 0.1, 0.5, 3):
+            self.histogram.observe(value, view='transfer_buy')
+
+        labels, value = self.histogram.samples()[0]
+        self.assertEqual(labels, {'view': 'transfer_buy'})
+        self.assertEqual(value['buckets'], {'0.1': 2, '1.0': 3, '+Inf': 4})
+        self.assertEqual(value['count'], 4)
+        self.assertAlmostEqual(value['sum'], 3.65)
+
+    def test_collect_all(self):
+        # unit test
+        self.counter.inc(2, result='success')
+        self.gauge.set(1, name='search')
+        self.histogram.observe(0.5)
+        # another worker, which exited
+        dead = {
+            'transfers_total': {'type': 'counter', 'help': 'Transfers', 'samples': [
+                {'labels': {'result': 'success'}, 'value': 3}, {'labels': {'result': 'failed'}, 'value': 1}]},
+            'breaker_state': {'type': 'gauge', 'help': 'Breaker state', 'samples': [{'labels': {'name': 'search'}, 'value': 2}]},
+            'latency_seconds': {'type': 'histogram', 'help': 'Latency', 'samples': [
+                {'labels': {}, 'value': {'buckets': {'0.1': 1, '1.0': 1, '+Inf': 1}, 'count': 1, 'sum': 0.05}}]},
+        }
+        os.makedirs(os.path.join(self.directory.name, metrics.HOST))
+        with open(os.path.join(self.directory.name, metrics.HOST, '999999-exited.json'), 'w') as f:
+            json.dump(dead, f)
+
+        collected = self.registry.collect_all(self.directory.name)
+
+        samples = {json.dumps(sample['labels'], sort_keys=True): sample['value'] for sample in collected['transfers_total']['samples']}
+        self.assertEqual(samples, {'{"result": "success"}': 5, '{"result": "failed"}': 1})
+        # gauges are kept per worker, those of exited workers are dropped
+        self.assertEqual(collected['breaker_state']['samples'],
+                         [{'labels': {'name': 'search', 'host': metrics.HOST, 'pid': str(os.getpid())}, 'value': 1}])
+        self.assertEqual(collected['latency_seconds']['samples'][0]['value']['buckets'], {'0.1': 1, '1.0': 2, '+Inf': 2})
+        # the exited worker is kept in the archive, and counted once
+        self.assertNotIn('999999-exited.json', os.listdir(os.path.join(self.directory.name, metrics.HOST)))
+        self.assertIn(metrics.ARCHIVE_FILE, os.listdir(self.directory.name))
+        collected = self.registry.collect_all(self.directory.name)
+        samples = {json.dumps(sample['labels'], sort_keys=True): sample['value'] for sample in collected['transfers_total']['samples']}
+        self.assertEqual(samples, {'{"result": "success"}': 5, '{"result": "failed"}': 1})
+
+    def test_reused_pid(self):
+        # unit test
+        self.counter.inc(2, result='success')
+        # an exited worker which had the pid of this process
+        os.makedirs(os.path.join(self.directory.name, metrics.HOST))
+        path = os.path.join(self.directory.name, metrics.HOST, '{pid}-exited.json'.format(pid=os.getpid()))
+        with open(path, 'w') as f:
+            json.dump({
+                'transfers_total': {'type': 'counter', 'help': 'Transfers', 'samples': [{'labels': {'result': 'success'}, 'value': 3}]},
+                'breaker_state': {'type': 'gauge', 'help': 'Breaker state', 'samples': [{'labels': {'name': 'search'}, 'value': 2}]},
+            }, f)
+        os.utime(path, (0, 0))
+
+        collected = self.registry.collect_all(self.directory.name)
+
+        self.assertEqual(collected['transfers_total']['samples'], [{'labels': {'result': 'success'}, 'value': 5}])
+        self.assertEqual(collected['breaker_state']['samples'], [])
+        self.assertFalse(os.path.exists(path))
+
+    def test_other_host(self):
+        # unit test
+        # a container sharing the directory, whose pids can not be checked from this one
+        host = os.path.join(self.directory.name, 'team-pool')
+        os.makedirs(host)
+        for file_name, value, written in (('1-restarted.json', 3, 0), ('1-running.json', 2, 10)):
+            with open(os.path.join(host, file_name), 'w') as f:
+                json.dump({
+                    'transfers_total': {'type': 'counter', 'help': 'Transfers', 'samples': [{'labels': {}, 'value': value}]},
+                    'breaker_state': {'type': 'gauge', 'help': 'Breaker state', 'samples': [{'labels': {}, 'value': value}]},
+                }, f)
+            os.utime(os.path.join(host, file_name), (written, written))
+
+        collected = self.registry.collect_all(self.directory.name)
+
+        self.assertEqual(collected['transfers_total']['samples'], [{'labels': {}, 'value': 5}])
+        # the latest file of the pid is taken as alive, the one before it as exited
+        self.assertEqual(collected['breaker_state']['samples'], [{'labels': {'host': 'team-pool', 'pid': '1'}, 'value': 2}])
+        self.assertEqual(os.listdir(host), ['1-running.json'])
+
+    def test_render_text(self):
+        # unit test
+        self.counter.inc(result='say "hi"')
+        self.histogram.observe(0.5, view='transfer_list')
+
+        text = metrics.render_text(self.registry.collect())
+
+        self.assertIn('# TYPE transfers_total counter\ntransfers_total{result="say \\"hi\\""} 1.0\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.1",view="transfer_list"} 0.0\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf",view="transfer_list"} 1.0\n', text)
+        self.assertIn('latency_seconds_count{view="transfer_list"} 1.0\n', text)
+
+
+class BenchmarkTest(TestCase):
+    """ Test module for comparing benchmark results to the baseline """
+
+    def test_regressions(self):
+        # unit test
+        baseline = {'make_transfer': {'ops_per_sec': 200, 'p50_ms': 5, 'p99_ms': 6, 'queries': 7}}
+
+        self.assertEqual(regressions({'make_transfer': {'ops_per_sec': 180, 'p50_ms': 5.5, 'p99_ms': 60, 'queries': 7},
+                                      'generate_team': {'ops_per_sec': 1, 'p50_ms': 900, 'p99_ms': 900, 'queries': 2}},
+                                     baseline, 0.2), [])
+        self.assertEqual(regressions({'make_transfer': {'ops_per_sec': 150, 'p50_ms': 6.5, 'p99_ms': 6, 'queries': 8}}, baseline, 0.2), [
+            'make_transfer: 8 queries, baseline 7',
+            'make_transfer: p50 6.50 ms, baseline 5.00 ms',
+            'make_transfer: 150.0 ops/sec, baseline 200.0',
+        ])
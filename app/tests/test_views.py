@@ -1,10 +1,31 @@
+import base64
+import json
+import os
+import pickle
+import tempfile
+import threading
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+from django.test import override_settings
 from rest_framework import status
 from django.urls import reverse
+from elasticsearch.exceptions import ConnectionError as ElasticsearchConnectionError
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase, APIClient
-from ..models import User, Team, Player, TransferList
+import structlog
+from ..models import User, Team, Player, TransferList, SearchIndexOutbox, player_cache
+from .. import instrumentation, search
+from ..breaker import CircuitBreaker
+from ..api.mixins import QueryBudgetExceeded
+from ..api.authentication import token_cache, token_digest
+from ..api.permissions import IsOwnerOrAdmin
 from ..api.serializers import UserSerializer
+from ..api.views import TeamListView
 
 
 # initialize the APIClient app
@@ -44,6 +65,21 @@ class UserTest(APITestCase):
         self.assertIsNotNone(user.team)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
+    def test_register_claims_pooled_team(self):
+        # e2e test
+        pooled_team = Team.objects.generate_teams(1, in_pool=True)[0]
+        response = api_client.post(reverse('user_register'),
+                                   data={'email': 'test6@mail.ru',
+                                         'password': 'password1234567',
+                                         'first_name': 'fname',
+                                         'last_name': 'lname'})
+
+        user = User.objects.get(email='test6@mail.ru')
+        self.assertEqual(response.data['team_id'], pooled_team.id)
+        self.assertEqual(user.team, pooled_team)
+        self.assertFalse(Team.objects.get(id=pooled_team.id).in_pool)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
     def test_update(self):
         # e2e test
         response = api_client.put(reverse('user_update'),
@@ -73,6 +109,24 @@ class UserTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 
+    def test_get_all_users_paginated(self):
+        # e2e test
+        users = User.objects.filter(role=User.USER).order_by('id')
+        response = api_client.get(reverse('users_list'), {'page_size': 3})
+
+        self.assertEqual(response.data, UserSerializer(users[:3], many=True).data)
+        self.assertIn('rel="next"', response['Link'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        next_url = response['Link'].split(';')[0].strip('<>')
+        response = api_client.get(next_url)
+
+        self.assertEqual(response.data, UserSerializer(users[3:], many=True).data)
+        self.assertIn('rel="prev"', response['Link'])
+        self.assertNotIn('rel="next"', response['Link'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
 class TeamTest(APITestCase):
     def setUp(self):
         u = User.objects.create_superuser(email='admin@mail.ru', password='password1234567')
@@ -120,6 +174,23 @@ class TeamTest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
 
+    def test_delete_owned_team(self):
+        # e2e test
+        # everything a delete cascades to: an owner, a listing and transfers on both sides, within the query budget
+        owner = User.objects.create_user(email='owner@mail.ru', password='password1234567')
+        Token.objects.create(user=owner)
+        team = Team.objects.generate_team(owner)
+        team.players.first().set_to_transfer_list(1)
+        listing = TransferList.objects.create(player=self.t1.players.first(), asking_price=1)
+        listing.make_transfer(team)
+        team.players.exclude(transfer_offer__isnull=False).last().set_to_transfer_list(1)
+        TransferList.objects.get(player__team=team, player__in=team.players.order_by('-id')[:1]).make_transfer(self.t1)
+
+        response = api_client.delete(reverse('team_delete'), data={'id': team.id})
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Team.objects.filter(id=team.id).exists())
+
     def test_add_player(self):
         # e2e test
         # set one fwd player to transfer list so that team can have available position for fwd (last() is fwd player)
@@ -164,6 +235,17 @@ class PlayerTest(APITestCase):
         self.assertIsNotNone(response.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_list_without_pool(self):
+        # e2e test
+        pooled_team = Team.objects.generate_teams(1, in_pool=True)[0]
+        response = api_client.get(reverse('player_list'), {'page_size': 1000})
+
+        ids = [player['id'] for player in response.data]
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(self.p1.id, ids)
+        self.assertTrue(set(self.t1.players.values_list('id', flat=True)) <= set(ids))
+        self.assertFalse(set(pooled_team.players.values_list('id', flat=True)) & set(ids))
+
     def test_update(self):
         # e2e test
         response = api_client.put(reverse('player_update'),
@@ -191,6 +273,7 @@ class PlayerTest(APITestCase):
 
 class TransferTest(APITestCase):
     def setUp(self):
+        cache.clear()
         u = User.objects.create_superuser(email='admin@mail.ru', password='password1234567')
         token, created = Token.objects.get_or_create(user=u)
         api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
@@ -234,3 +317,811 @@ class TransferTest(APITestCase):
         test_set(self)
         test_list(self)
         test_buy(self)
+
+    def test_set_sold_player(self):
+        # e2e test
+        player = self.t1.players.last()
+        # cached by this worker, then sold by another one
+        player_cache.get(player.id)
+        Player.objects.filter(id=player.id).update(team=Team.objects.generate_team())
+
+        token, created = Token.objects.get_or_create(user=self.u1)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        response = api_client.post(reverse('set_player_to_transfer_list'), data={"player_id": player.id, "asking_price": 1200000},
+                                   format='json')
+
+        self.assertEqual(list(response.data), ['Player not found in your team'])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(TransferList.objects.filter(player=player).exists())
+
+    def test_buy_claimed(self):
+        # e2e test
+        self.p1.set_to_transfer_list(1300000)
+        TransferList.claim(self.p1.id)
+
+        u = User.objects.get(email='test1@mail.ru')
+        token, created = Token.objects.get_or_create(user=u)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        with self.assertNumQueries(1):
+            # token authentication only
+            response = api_client.post(reverse('transfer_buy'), data={"player_id": self.p1.id})
+
+        self.assertEqual(list(response.data), ['This player is being sold to another team'])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(TransferList.objects.filter(player=self.p1).exists())
+
+    def test_buy_sold(self):
+        # e2e test
+        self.p1.set_to_transfer_list(1300000)
+
+        u = User.objects.get(email='test1@mail.ru')
+        token, created = Token.objects.get_or_create(user=u)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        response = api_client.post(reverse('transfer_buy'), data={"player_id": self.p1.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = api_client.post(reverse('transfer_buy'), data={"player_id": self.p1.id})
+        self.assertEqual(list(response.data), ['This player is already sold'])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    @override_settings(ELASTICSEARCH_DSL_AUTOSYNC=True)
+    def test_buy_from_team(self):
+        # e2e test
+        seller = Team.objects.generate_team()
+        player = seller.players.first()
+        player.set_to_transfer_list(1300000)
+        listing_id = player.transfer_offer.id
+        SearchIndexOutbox.objects.all().delete()
+
+        token, created = Token.objects.get_or_create(user=self.u1)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        response = api_client.post(reverse('transfer_buy'), data={"player_id": player.id})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Player.objects.get(id=player.id).team_id, self.t1.id)
+        # the listing is only queued for removal from the index
+        self.assertEqual(list(SearchIndexOutbox.objects.values_list('object_id', 'action')), [(listing_id, 'delete')])
+
+
+class TransferSearchTest(APITestCase):
+    def setUp(self):
+        search.search_breaker.success()
+        u = User.objects.create_user(email='test1@mail.ru', password='password1234567')
+        token, created = Token.objects.get_or_create(user=u)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def test_search_from_hits(self):
+        # e2e test
+        hit = {'player': {'id': 1, 'first_name': 'fname', 'last_name': 'lname', 'age': 20, 'price': 1000000.0,
+                          'country': 'UZ', 'category': 'FWD'},
+               'asking_price': 1500000.0}
+        with mock.patch('app.search.search_transfers', return_value=([hit], 'next-cursor')) as search_transfers:
+            with self.assertNumQueries(1):
+                # token authentication only
+                response = api_client.generic('GET', reverse('transfer_list'), json.dumps({'player__country': 'UZ'}),
+                                              content_type='application/json')
+
+        filters = search_transfers.call_args[0][0]
+        self.assertEqual(filters.terms, {'player__country': ['UZ']})
+        self.assertEqual(response.data, [hit])
+        self.assertIn('cursor=next-cursor', response['Link'])
+        self.assertEqual(response['X-Search-Backend'], search.ELASTICSEARCH)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_search_fallback(self):
+        # e2e test
+        team = Team.objects.generate_team()
+        for player in team.players.filter(category='DEF')[:3]:
+            player.set_to_transfer_list(1500000)
+
+        outage = ElasticsearchConnectionError('N/A', 'es is down', None)
+        with mock.patch('app.search.search_transfers', side_effect=outage):
+            response = api_client.get(reverse('transfer_list'), {'player__category': 'def', 'page_size': 2})
+            self.assertEqual(response['X-Search-Backend'], search.get_backend(settings.SEARCH_FALLBACK_BACKEND).name)
+            self.assertEqual(len(response.data), 2)
+            self.assertEqual(response.data[0]['asking_price'], 1500000.0)
+
+            next_page = response['Link'].split(';')[0].strip('<>')
+            response = api_client.get(next_page)
+            self.assertEqual(len(response.data), 1)
+            self.assertNotIn('Link', response)
+
+    def test_breaker_open(self):
+        # e2e test
+        outage = ElasticsearchConnectionError('N/A', 'es is down', None)
+        with mock.patch('app.search.search_transfers', side_effect=outage) as search_transfers:
+            for i in range(settings.SEARCH_BREAKER_FAILURE_THRESHOLD + 2):
+                response = api_client.get(reverse('transfer_list'), {'player__category': 'DEF'})
+                self.assertEqual(response['X-Search-Backend'], search.get_backend(settings.SEARCH_FALLBACK_BACKEND).name)
+
+        self.assertEqual(search_transfers.call_count, settings.SEARCH_BREAKER_FAILURE_THRESHOLD)
+        self.assertEqual(search.search_breaker.state, CircuitBreaker.OPEN)
+
+    def test_db_search_ordering(self):
+        # unit test
+        team = Team.objects.generate_team()
+        for price, player in zip((3, 1, 2), team.players.filter(category='MID')):
+            player.set_to_transfer_list(price * 1000000)
+
+        backend = search.get_backend(settings.SEARCH_FALLBACK_BACKEND)
+        filters = search.parse_params({'ordering': '-asking_price'})
+        results, cursor = backend.search(search.TRANSFERS, filters, 2)
+        self.assertEqual([r['asking_price'] for r in results], [3000000.0, 2000000.0])
+
+        results, cursor = backend.search(search.TRANSFERS, filters, 2, search.decode_cursor(cursor))
+        self.assertEqual([r['asking_price'] for r in results], [1000000.0])
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor(self):
+        # e2e test
+        response = api_client.generic('GET', reverse('transfer_list') + '?cursor=xyz', json.dumps({'player__country': 'UZ'}),
+                                      content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_wrong_param(self):
+        # e2e test
+        response = api_client.get(reverse('transfer_list'), {'player__height': 180, 'asking_price__gte': 'cheap'})
+
+        self.assertEqual(set(response.data), {'wrong param is sent: player__height', 'asking_price__gte must be number'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_build_search(self):
+        # unit test
+        filters = search.parse_params({'player__category': 'def', 'player__age__lt': '25', 'asking_price__gte': 1000000,
+                                       'asking_price__lte': 3000000, 'ordering': 'asking_price'})
+        query = search.build_search(filters).to_dict()
+
+        self.assertEqual(query['query'], {'bool': {'filter': [
+            {'terms': {'player.category': ['DEF']}},
+            {'range': {'player.age': {'lt': 25}}},
+            {'range': {'asking_price': {'gte': 1000000.0, 'lte': 3000000.0}}},
+        ]}})
+        self.assertEqual(query['sort'], [{'asking_price': 'asc'}, {'id': 'asc'}])
+
+    def test_cursor(self):
+        # unit test
+        cursor = search.decode_cursor(search.encode_cursor(search.ELASTICSEARCH, [{'id': 'asc'}], [1.5, 42]))
+        self.assertEqual(cursor, {'backend': search.ELASTICSEARCH, 'sort': [{'id': 'asc'}], 'after': [1.5, 42]})
+        with self.assertRaises(search.InvalidCursor):
+            search.decode_cursor('xyz')
+        with self.assertRaises(search.InvalidCursor):
+            # cursors of the old format, the bare sort values
+            search.decode_cursor(base64.urlsafe_b64encode(json.dumps([1.5, 42]).encode()).decode())
+
+    def test_db_cursor_prices(self):
+        # unit test
+        team = Team.objects.generate_team()
+        for player in team.players.filter(category='MID')[:3]:
+            player.set_to_transfer_list(Decimal('12345678.91'))
+
+        backend = search.get_backend(search.DATABASE)
+        filters = search.parse_params({'ordering': 'asking_price'})
+        results, cursor = backend.search(search.TRANSFERS, filters, 1)
+        # prices are kept exactly, as strings of the decimal
+        self.assertEqual(search.decode_cursor(cursor)['after'][0], '12345678.91')
+
+        pages = 1
+        while cursor:
+            results, cursor = backend.search(search.TRANSFERS, filters, 1, search.decode_cursor(cursor))
+            self.assertEqual(len(results), 1)
+            pages += 1
+        self.assertEqual(pages, 3)
+
+    def test_cursor_of_other_backend(self):
+        # unit test
+        team = Team.objects.generate_team()
+        for price, player in zip((1, 2, 3), team.players.filter(category='MID')):
+            player.set_to_transfer_list(price * 1000000)
+
+        backend = search.get_backend(search.DATABASE)
+        filters = search.parse_params({'ordering': 'asking_price'})
+        # written by elasticsearch before an outage, with its sort values
+        cursor = search.encode_cursor(search.ELASTICSEARCH, [{'asking_price': 'asc'}, {'id': 'asc'}], [1000000.0, 7])
+        results, next_cursor = backend.search(search.TRANSFERS, filters, 2, search.decode_cursor(cursor))
+        # the search starts over from the first page
+        self.assertEqual([r['asking_price'] for r in results], [1000000.0, 2000000.0])
+
+        # the same backend, ordered another way
+        filters = search.parse_params({'ordering': '-asking_price'})
+        results, _ = backend.search(search.TRANSFERS, filters, 2, search.decode_cursor(next_cursor))
+        self.assertEqual([r['asking_price'] for r in results], [3000000.0, 2000000.0])
+
+
+class PlayerSearchTest(APITestCase):
+    def setUp(self):
+        u = User.objects.create_user(email='test1@mail.ru', password='password1234567')
+        token, created = Token.objects.get_or_create(user=u)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        self.team = Team.objects.generate_team(name='Pakhtakor')
+        Team.objects.generate_teams(1, in_pool=True)
+
+    def test_search(self):
+        # e2e test
+        player = self.team.players.filter(category='FWD').first()
+        response = api_client.get(reverse('player_search'), {'name': player.last_name.lower(), 'category': 'fwd',
+                                                             'team__name': 'pakhtakor'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Search-Backend'], search.get_backend(settings.SEARCH_BACKENDS['players']).name)
+        self.assertIn(player.id, [result['id'] for result in response.data])
+        for result in response.data:
+            self.assertEqual(result['category'], 'FWD')
+
+    @skipUnless(connection.vendor == 'postgresql', 'trigram similarity needs postgres')
+    def test_search_typo(self):
+        # e2e test
+        player = self.team.players.first()
+        player.last_name = 'Djokovic'
+        player.save()
+        response = api_client.get(reverse('player_search'), {'name': 'djokovich'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Search-Backend'], search.POSTGRES)
+        self.assertEqual(response.data[0]['id'], player.id)
+
+    def test_backend_of_database(self):
+        # unit test
+        expected = search.POSTGRES if connection.vendor == 'postgresql' else search.DATABASE
+        self.assertEqual(search.get_backend(search.POSTGRES).name, expected)
+        self.assertEqual(search.get_backend(search.DATABASE).name, search.DATABASE)
+
+    def test_pages(self):
+        # e2e test
+        response = api_client.get(reverse('player_search'), {'ordering': '-age', 'page_size': 10})
+        ages = [result['age'] for result in response.data]
+
+        # players of pooled teams are not found
+        self.assertEqual(len(response.data), 10)
+        self.assertEqual(ages, sorted(ages, reverse=True))
+
+        next_page = response['Link'].split(';')[0].strip('<>')
+        response = api_client.get(next_page)
+        self.assertEqual(len(response.data), settings.TEAM_TOTAL_PLAYERS - 10)
+        self.assertNotIn('Link', response)
+
+    def test_wrong_param(self):
+        # e2e test
+        response = api_client.get(reverse('player_search'), {'asking_price': 100})
+
+        self.assertEqual(list(response.data), ['wrong param is sent: asking_price'])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AutocompleteTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        search.search_breaker.success()
+        u = User.objects.create_user(email='test1@mail.ru', password='password1234567')
+        token, created = Token.objects.get_or_create(user=u)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        self.team = Team.objects.generate_team()
+        self.players = list(self.team.players.order_by('id')[:3])
+        for player, (first_name, last_name) in zip(self.players, (('Lionel', 'Messi'), ('Mesut', 'Ozil'), ('Luka', 'Modric'))):
+            player.first_name, player.last_name = first_name, last_name
+            player.save()
+
+    def test_cached_prefix(self):
+        # e2e test
+        suggestions = [{'id': self.players[0].id, 'name': 'Lionel Messi'}]
+        with mock.patch('app.search.suggest_transfers', return_value=suggestions) as suggest_transfers:
+            response = api_client.get(reverse('transfer_autocomplete'), {'q': 'Mes', 'size': 5})
+            self.assertEqual(response.data, suggestions)
+            self.assertEqual(response['X-Search-Backend'], search.ELASTICSEARCH)
+
+            with self.assertNumQueries(0):
+                # the token and the same prefix typed differently are answered from the cache
+                response = api_client.get(reverse('transfer_autocomplete'), {'q': ' mes ', 'size': 5})
+
+        suggest_transfers.assert_called_once_with('mes', 5)
+        self.assertEqual(response.data, suggestions)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_fallback(self):
+        # e2e test
+        for player in self.players[:2]:
+            player.set_to_transfer_list(1500000)
+
+        outage = ElasticsearchConnectionError('N/A', 'es is down', None)
+        with mock.patch('app.search.suggest_transfers', side_effect=outage):
+            response = api_client.get(reverse('transfer_autocomplete'), {'q': 'me'})
+
+        self.assertEqual(response['X-Search-Backend'], search.get_backend(settings.SEARCH_FALLBACK_BACKEND).name)
+        # Luka Modric is not on the transfer list
+        self.assertEqual(response.data, [{'id': self.players[0].id, 'name': 'Lionel Messi'},
+                                         {'id': self.players[1].id, 'name': 'Mesut Ozil'}])
+
+    def test_player_autocomplete(self):
+        # e2e test
+        response = api_client.get(reverse('player_autocomplete'), {'q': 'lionel me'})
+        self.assertEqual(response.data, [{'id': self.players[0].id, 'name': 'Lionel Messi'}])
+
+        response = api_client.get(reverse('player_autocomplete'), {'q': 'm', 'size': 1})
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_wrong_params(self):
+        # e2e test
+        response = api_client.get(reverse('player_autocomplete'), {'size': 'ten'})
+
+        self.assertEqual(set(response.data), {'q is not sent', 'size must be number'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class FacetsTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        search.search_breaker.success()
+        u = User.objects.create_user(email='test1@mail.ru', password='password1234567')
+        token, created = Token.objects.get_or_create(user=u)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        team = Team.objects.generate_team(country='UZ')
+        for age, asking_price, player in zip((19, 22, 23, 35), (500000, 1500000, 1700000, 2500000), team.players.filter(category='DEF')):
+            player.age, player.country = age, 'UZ'
+            player.save()
+            player.set_to_transfer_list(asking_price)
+        player = team.players.filter(category='FWD').first()
+        player.age, player.country = 24, 'KZ'
+        player.save()
+        player.set_to_transfer_list(1200000)
+
+    def test_database_facets(self):
+        # e2e test
+        outage = ElasticsearchConnectionError('N/A', 'es is down', None)
+        with mock.patch('app.search.facet_transfers', side_effect=outage):
+            response = api_client.get(reverse('transfer_facets'), {'asking_price__gte': 1000000})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Search-Backend'], search.get_backend(settings.SEARCH_FALLBACK_BACKEND).name)
+        self.assertIn('max-age={timeout}'.format(timeout=settings.SEARCH_FACETS_CACHE_TIMEOUT), response['Cache-Control'])
+        self.assertEqual(response.data['total'], 4)
+        self.assertEqual(response.data['category'], [{'value': 'DEF', 'count': 3}, {'value': 'FWD', 'count': 1}])
+        self.assertEqual(response.data['country'], [{'value': 'UZ', 'count': 3}, {'value': 'KZ', 'count': 1}])
+        self.assertEqual(response.data['price'], [{'from': 1000000.0, 'to': 2000000.0, 'count': 3},
+                                                  {'from': 2000000.0, 'to': 3000000.0, 'count': 1}])
+        self.assertEqual([bucket['count'] for bucket in response.data['age']], [0, 3, 0, 1])
+
+    def test_cached_filters(self):
+        # e2e test
+        facets = {'total': 0, 'category': [], 'country': [], 'price': [], 'age': []}
+        with mock.patch('app.search.facet_transfers', return_value=facets) as facet_transfers:
+            api_client.get(reverse('transfer_facets'), {'player__category': 'def,fwd', 'player__age__lt': 30})
+            with self.assertNumQueries(0):
+                # the token and the same filters in another order are answered from the cache
+                response = api_client.get(reverse('transfer_facets'), {'player__age__lt': 30, 'player__category': 'FWD,DEF'})
+
+        facet_transfers.assert_called_once()
+        self.assertEqual(response.data, facets)
+        self.assertEqual(response['X-Search-Backend'], search.ELASTICSEARCH)
+
+    def test_facet_aggregations(self):
+        # unit test
+        response = mock.MagicMock()
+        response.hits.total.value = 2
+        response.aggregations.category.buckets = [mock.Mock(key='DEF', doc_count=2)]
+        response.aggregations.country.buckets = [mock.Mock(key='UZ', doc_count=2)]
+        response.aggregations.price.buckets = [mock.Mock(key=1000000.0, doc_count=2)]
+        response.aggregations.age.buckets = [mock.Mock(doc_count=count) for count in (0, 2, 0, 0)]
+
+        with mock.patch('elasticsearch_dsl.Search.execute', return_value=response):
+            facets = search.facet_transfers(search.parse_params({'player__category': 'DEF'}))
+
+        self.assertEqual(facets['price'], [{'from': 1000000.0, 'to': 2000000.0, 'count': 2}])
+        self.assertEqual(facets['age'][0], {'from': None, 'to': 21, 'count': 0})
+
+
+class CachedTokenAuthenticationTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='test1@mail.ru', password='password1234567')
+        token, created = Token.objects.get_or_create(user=self.user)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def test_cached(self):
+        # e2e test
+        with self.assertNumQueries(2):
+            response = api_client.get(reverse('player_autocomplete'), {'q': 'zz'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.assertNumQueries(1):
+            # the autocomplete query only, the token is answered from the cache
+            response = api_client.get(reverse('player_autocomplete'), {'q': 'zzz'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_cached_value(self):
+        # unit test
+        key = self.user.auth_token.key
+        api_client.get(reverse('player_autocomplete'), {'q': 'zz'})
+
+        version, user = cache.get(token_cache.shared_key(token_digest(key)))
+        self.assertEqual(user.pk, self.user.pk)
+        # neither the credential nor the password hash are in the shared cache
+        stored = pickle.dumps(user)
+        self.assertNotIn(key.encode(), stored)
+        self.assertNotIn(self.user.password.encode(), stored)
+        self.assertEqual(user.get_deferred_fields(), {'password'})
+
+    def test_logout(self):
+        # e2e test
+        api_client.get(reverse('player_autocomplete'), {'q': 'zz'})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = api_client.post(reverse('user_logout'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = api_client.get(reverse('player_autocomplete'), {'q': 'zz'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_role_change(self):
+        # e2e test
+        response = api_client.get(reverse('users_list'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.role = User.ADMIN
+            self.user.save()
+
+        response = api_client.get(reverse('users_list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_user_delete(self):
+        # e2e test
+        api_client.get(reverse('player_autocomplete'), {'q': 'zz'})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+
+        response = api_client.get(reverse('player_autocomplete'), {'q': 'zz'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class OwnershipTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='test1@mail.ru', password='password1234567')
+        self.team = Team.objects.generate_team(self.user)
+        self.other_team = Team.objects.generate_team()
+        self.player = self.team.players.first()
+        self.other_player = self.other_team.players.first()
+        self.free_player = Player.objects.create(category='FWD', first_name='fname', last_name='lname', country='UZ',
+                                                 age=18, price=1000000)
+        token, created = Token.objects.get_or_create(user=self.user)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def test_permission(self):
+        # unit test
+        user = User.objects.get(id=self.user.id)
+        admin = User(role=User.ADMIN)
+        permission = IsOwnerOrAdmin()
+
+        with self.assertNumQueries(0):
+            self.assertTrue(permission.has_object_permission(mock.Mock(user=user), None, self.team))
+            self.assertTrue(permission.has_object_permission(mock.Mock(user=user), None, self.player))
+            self.assertFalse(permission.has_object_permission(mock.Mock(user=user), None, self.other_team))
+            self.assertFalse(permission.has_object_permission(mock.Mock(user=user), None, self.other_player))
+            self.assertFalse(permission.has_object_permission(mock.Mock(user=user), None, self.free_player))
+            self.assertTrue(permission.has_object_permission(mock.Mock(user=admin), None, self.other_player))
+
+    def test_no_extra_queries(self):
+        # e2e test
+        # token and team lookups are cached by the first requests, the ownership checks add nothing
+        api_client.generic('GET', reverse('team_details'), json.dumps({'id': self.other_team.id}), content_type='application/json')
+        api_client.post(reverse('set_player_to_transfer_list'), data={'player_id': self.other_player.id, 'asking_price': 1000000},
+                        format='json')
+
+        with self.assertNumQueries(0):
+            response = api_client.generic('GET', reverse('team_details'), json.dumps({'id': self.other_team.id}),
+                                          content_type='application/json')
+        self.assertEqual(list(response.data), ['Can not see other user\'s team'])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with self.assertNumQueries(1):
+            # the player to list is read from the database
+            response = api_client.post(reverse('set_player_to_transfer_list'),
+                                       data={'player_id': self.other_player.id, 'asking_price': 1000000}, format='json')
+        self.assertEqual(list(response.data), ['Player not found in your team'])
+
+        with self.assertNumQueries(1):
+            # the team to update is read from the database
+            response = api_client.put(reverse('team_update'), data={'id': self.other_team.id, 'name': 'name', 'country': 'UZ'},
+                                      format='json')
+        self.assertEqual(list(response.data), ['Can not update other user\'s team'])
+
+        with self.assertNumQueries(1):
+            # the player to update is read from the database
+            response = api_client.put(reverse('player_update'), data={'id': self.other_player.id, 'age': 20, 'price': 2000000,
+                                                                      'category': 'FWD'}, format='json')
+        self.assertEqual(list(response.data), ['Player not found in your team'])
+
+    def test_own_team(self):
+        # e2e test
+        response = api_client.post(reverse('set_player_to_transfer_list'),
+                                   data={'player_id': self.player.id, 'asking_price': 1000000}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = api_client.generic('GET', reverse('team_details'), json.dumps({'id': self.team.id}),
+                                      content_type='application/json')
+        self.assertEqual(response.data['id'], self.team.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class QueryBudgetTest(APITestCase):
+    """ The number of queries of an endpoint must not grow with the number of returned rows """
+
+    def setUp(self):
+        u = User.objects.create_superuser(email='admin@mail.ru', password='password1234567')
+        token, created = Token.objects.get_or_create(user=u)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        for i in range(3):
+            user = User.objects.create_user(email='test{i}@mail.ru'.format(i=i), password='password1234567')
+            team = Team.objects.generate_team(user)
+            team.players.last().set_to_transfer_list(1500000)
+        self.team = team
+
+    def test_list_endpoints(self):
+        # e2e test
+        for url_name in ('users_list', 'team_list', 'player_list', 'transfer_list'):
+            response = api_client.get(reverse(url_name))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertGreater(len(response.data), 1)
+
+    def test_team_details(self):
+        # e2e test
+        # team details reads the id from the request body
+        response = api_client.generic('GET', reverse('team_details'), json.dumps({'id': self.team.id}),
+                                      content_type='application/json')
+
+        self.assertEqual(len(response.data['players']), settings.TEAM_TOTAL_PLAYERS)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_budget_exceeded(self):
+        # unit test
+        with mock.patch.object(TeamListView, 'max_queries', 1):
+            with self.assertRaises(QueryBudgetExceeded):
+                api_client.get(reverse('team_list'))
+
+
+class InstrumentationTest(APITestCase):
+    def setUp(self):
+        u = User.objects.create_user(email='test1@mail.ru', password='password1234567')
+        token, created = Token.objects.get_or_create(user=u)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        Team.objects.generate_team(u)
+
+    def test_server_timing(self):
+        # e2e test
+        response = api_client.get(reverse('transfer_list'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        metrics = {metric.split(';')[0]: metric for metric in response['Server-Timing'].split(', ')}
+        self.assertEqual(list(metrics), ['db', 'es', 'serializer', 'render', 'total'])
+        self.assertNotIn('desc="0 calls"', metrics['db'])
+        self.assertIn('desc="0 calls"', metrics['es'])
+
+    @override_settings(SERVER_TIMING_HEADER=False)
+    def test_no_server_timing(self):
+        # e2e test
+        response = api_client.get(reverse('transfer_list'))
+
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(SLOW_REQUEST_THRESHOLD_MS=0, SLOW_REQUEST_MAX_QUERIES=1)
+    def test_slow_request(self):
+        # e2e test
+        with mock.patch('app.instrumentation.logger') as logger:
+            api_client.post(reverse('user_login'), data={'email': 'test1@mail.ru', 'password': 'password1234567'})
+
+        logger.bind.assert_not_called()
+        event, = [call for call in logger.warning.call_args_list if call.args == ('slow_request',)]
+        self.assertGreater(event.kwargs['sql_queries'], 1)
+        self.assertEqual(event.kwargs['es_calls'], 0)
+        self.assertEqual(event.kwargs['path'], reverse('user_login'))
+        self.assertEqual(len(event.kwargs['queries']), 1)
+        # the query texts never hold parameters
+        self.assertNotIn('test1@mail.ru', json.dumps(event.kwargs['queries']))
+
+    def test_consecutive_requests(self):
+        # e2e test
+        with structlog.testing.capture_logs() as events:
+            api_client.get(reverse('transfer_list'))
+            api_client.get(reverse('transfer_list'))
+
+        finished = [event for event in events if event['event'] == 'request_finished']
+        self.assertEqual(len(finished), 2)
+        self.assertTrue(all(event['sql_queries'] > 0 for event in finished))
+        # the totals of the first request are not left in the context of the thread
+        started = [event for event in events if event['event'] == 'request_started']
+        self.assertEqual(len(started), 2)
+        self.assertFalse([event for event in events if event['event'] != 'request_finished' and 'duration_ms' in event])
+
+    def test_timed(self):
+        # unit test
+        timings = instrumentation.RequestTimings()
+        token = instrumentation.current_timings.set(timings)
+        try:
+            with instrumentation.timed(instrumentation.SERIALIZER):
+                with instrumentation.timed(instrumentation.SERIALIZER):
+                    pass
+                with instrumentation.timed(instrumentation.RENDER):
+                    pass
+        finally:
+            instrumentation.current_timings.reset(token)
+
+        self.assertEqual(timings.counts[instrumentation.SERIALIZER], 1)
+        self.assertEqual(timings.counts[instrumentation.RENDER], 1)
+        # outside of requests nothing is recorded
+        with instrumentation.timed(instrumentation.SERIALIZER):
+            pass
+        self.assertEqual(timings.counts[instrumentation.SERIALIZER], 1)
+
+    def test_elasticsearch_transport(self):
+        # unit test
+        timings = instrumentation.RequestTimings()
+        transport = instrumentation.InstrumentedTransport([{'host': 'localhost'}])
+        token = instrumentation.current_timings.set(timings)
+        try:
+            with mock.patch('elasticsearch.Transport.perform_request', return_value={'hits': {}}):
+                transport.perform_request('GET', '/transfers/_search', body={'query': {'match_all': {}}})
+        finally:
+            instrumentation.current_timings.reset(token)
+
+        self.assertEqual(timings.counts[instrumentation.ES], 1)
+        self.assertEqual(timings.queries[0]['text'], 'GET /transfers/_search {"query": {"match_all": {}}}')
+
+
+class PrometheusMetricsTest(APITestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser(email='admin@mail.ru', password='password1234567')
+        self.admin_token, created = Token.objects.get_or_create(user=admin)
+        user = User.objects.create_user(email='test1@mail.ru', password='password1234567')
+        self.user_token, created = Token.objects.get_or_create(user=user)
+
+    def test_allowed_network(self):
+        # e2e test
+        client = APIClient()
+        client.get(reverse('transfer_list'))
+        response = client.get(reverse('metrics_prometheus'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('# TYPE http_request_duration_seconds histogram', response.content.decode())
+
+    @override_settings(METRICS_ALLOWED_NETWORKS=[])
+    def test_admin_only(self):
+        # e2e test
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + self.user_token.key)
+        self.assertEqual(client.get(reverse('metrics_prometheus')).status_code, status.HTTP_403_FORBIDDEN)
+
+        client.credentials(HTTP_AUTHORIZATION='Token ' + self.admin_token.key)
+        self.assertEqual(client.get(reverse('metrics_prometheus')).status_code, status.HTTP_200_OK)
+
+    def test_registrations(self):
+        # e2e test
+        api_client.credentials()
+        api_client.post(reverse('user_register'), data={'email': 'test2@mail.ru', 'password': 'password1234567', 'first_name': 'a', 'last_name': 'b'})
+        api_client.post(reverse('user_register'), data={'email': 'test3@mail.ru'})
+
+        response = APIClient().get(reverse('metrics_prometheus'))
+
+        text = response.content.decode()
+        self.assertRegex(text, r'user_registrations_total\{result="success"\} [1-9]')
+        self.assertRegex(text, r'user_registrations_total\{result="failed"\} [1-9]')
+        self.assertIn('http_request_duration_seconds_count{method="POST",status="201",view="user_register"}', text)
+
+
+class ProfilerTest(APITestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser(email='admin@mail.ru', password='password1234567')
+        self.admin_token, created = Token.objects.get_or_create(user=admin)
+        user = User.objects.create_user(email='test1@mail.ru', password='password1234567')
+        self.user_token, created = Token.objects.get_or_create(user=user)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        cache.clear()
+
+    def profile(self, token, url_name='team_list', **extra):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        with override_settings(PROFILER_DIR=self.directory, PROFILER_INTERVAL=0.001):
+            return client.get(reverse(url_name), **extra)
+
+    def test_profile(self):
+        # e2e test
+        response = self.profile(self.admin_token, HTTP_X_PROFILE='1')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(os.listdir(self.directory), [response['X-Profile']])
+        self.assertTrue(response['X-Profile'].endswith('-team_list-{pid}.folded'.format(pid=os.getpid())))
+        with open(os.path.join(self.directory, response['X-Profile'])) as f:
+            for line in f:
+                stack, count = line.rsplit(' ', 1)
+                self.assertGreater(int(count), 0)
+
+    def test_search_parameter(self):
+        # e2e test
+        # the parameter is not taken for a search parameter
+        response = self.profile(self.admin_token, 'player_search', data={'profile': '1', 'category': 'fwd'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(os.listdir(self.directory), [response['X-Profile']])
+
+    def test_not_admin(self):
+        # e2e test
+        response = self.profile(self.user_token, HTTP_X_PROFILE='1')
+
+        self.assertFalse(response.has_header('X-Profile'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @override_settings(PROFILER_MAX_PER_MINUTE=1)
+    def test_rate_limit(self):
+        # e2e test
+        self.assertNotEqual(self.profile(self.admin_token, data={'profile': '1'})['X-Profile'], 'refused')
+        self.assertEqual(self.profile(self.admin_token, data={'profile': '1'})['X-Profile'], 'refused')
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+class SlowQueryTest(APITestCase):
+    def setUp(self):
+        u = User.objects.create_superuser(email='admin@mail.ru', password='password1234567')
+        token, created = Token.objects.get_or_create(user=u)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        cache.clear()
+
+    def test_fingerprint(self):
+        # unit test
+        self.assertEqual(instrumentation.fingerprint('SELECT * FROM app_player WHERE id IN (%s, %s)'),
+                         instrumentation.fingerprint('SELECT *  FROM app_player\nWHERE id IN (%s)'))
+        self.assertNotEqual(instrumentation.fingerprint('SELECT * FROM app_player WHERE id = %s'),
+                            instrumentation.fingerprint('SELECT * FROM app_team WHERE id = %s'))
+
+    def test_redact(self):
+        # unit test
+        plan = [{'Plan': {'Node Type': 'Seq Scan', 'Filter': "((email)::text = 'admin@mail.ru'::text)", 'Plan Rows': 1}}]
+
+        self.assertEqual(instrumentation.redact(plan),
+                         [{'Plan': {'Node Type': 'Seq Scan', 'Filter': "((email)::text = '?'::text)", 'Plan Rows': 1}}])
+
+    def test_explained_in_background(self):
+        # unit test
+        threads = list()
+
+        def explain(alias, sql, params):
+            threads.append(threading.get_ident())
+            return [{'Plan': {'Node Type': 'Seq Scan', 'Filter': "((email)::text = 'admin@mail.ru'::text)"}}]
+
+        with mock.patch('app.instrumentation.explain', side_effect=explain), mock.patch('app.instrumentation.logger') as logger:
+            self.assertTrue(instrumentation.plan_explainer.submit('team_list', 'default', 'SELECT 1', [], 0.2, 'fingerprint'))
+            instrumentation.plan_explainer.join()
+
+        # not on the thread of the request
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+        event = logger.warning.call_args
+        self.assertEqual(event.args, ('slow_query_plan', ))
+        self.assertEqual(event.kwargs['plan'], [{'Plan': {'Node Type': 'Seq Scan', 'Filter': "((email)::text = '?'::text)"}}])
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=0)
+    def test_plan_logged_once(self):
+        # e2e test
+        with mock.patch('app.instrumentation.logger') as logger:
+            api_client.get(reverse('team_list'))
+            api_client.get(reverse('team_list'))
+            instrumentation.plan_explainer.join()
+
+        plans = [call.kwargs for call in logger.warning.call_args_list if call.args == ('slow_query_plan', )]
+        if connection.vendor != 'postgresql':
+            self.assertEqual(plans, [])
+            return
+        self.assertTrue(plans)
+        self.assertEqual({plan['view'] for plan in plans}, {'team_list'})
+        # each query once, though both requests ran them
+        fingerprints = [plan['fingerprint'] for plan in plans]
+        self.assertEqual(len(fingerprints), len(set(fingerprints)))
+        self.assertIn('Plan', plans[0]['plan'][0])
@@ -54,6 +54,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'app',
     'rest_framework',
     'rest_framework.authtoken',
@@ -69,6 +70,8 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "django_structlog.middlewares.RequestMiddleware",
+    'app.instrumentation.InstrumentationMiddleware',
+    'app.profiling.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'soccer.urls'
@@ -108,6 +111,17 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': 'memcached:11211',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -245,9 +259,20 @@ TEAM_INITIAL_BUDGET = 5_000_000
 
 TEAM_TOTAL_PLAYERS = TEAM_GOALKEEPERS + TEAM_MIDFIELDERS + TEAM_DEFENDERS + TEAM_FORWARDS
 
+# pre-generated teams claimed by users on registration, kept topped up by `manage.py refill_team_pool`
+TEAM_POOL_SIZE = 1000
+TEAM_POOL_REFILL_BATCH_SIZE = 100
+
+# transfers give up waiting for row locks after this timeout, and retry on deadlocks this many times
+TRANSFER_LOCK_TIMEOUT_MS = 5000
+TRANSFER_MAX_RETRIES = 3
+# seconds a buyer holds the claim on a listing, and seconds a sold listing keeps rejecting buyers without a db lookup
+TRANSFER_LEASE_TIMEOUT = 10
+TRANSFER_SOLD_MARKER_TIMEOUT = 60
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication'
+        'app.api.authentication.CachedTokenAuthentication'
     ],
 
     'DEFAULT_PERMISSION_CLASSES': [
@@ -256,19 +281,114 @@ REST_FRAMEWORK = {
 
     'DEFAULT_RENDERER_CLASSES': [
         'app.api.renderers.Renderer',
-    ]
+    ],
+
+    'DEFAULT_PAGINATION_CLASS': 'app.api.pagination.KeysetPagination',
+    'PAGE_SIZE': 100,
 }
 
+# users of authenticated tokens, by token digest, kept per worker (most recently used first) and seconds they stay
+# in the worker and in the shared cache. Deleted tokens and tokens of saved users are removed at once from both
+AUTH_TOKEN_CACHE_LOCAL_SIZE = 10000
+AUTH_TOKEN_CACHE_LOCAL_TIMEOUT = 60
+AUTH_TOKEN_CACHE_TIMEOUT = 300
+
+# teams and players read by id are kept per worker and in the shared cache, like tokens, but a worker trusts its
+# own copies for OBJECT_CACHE_LOCAL_TIMEOUT seconds: changes made in other workers may be seen that much later
+OBJECT_CACHE_LOCAL_SIZE = 10000
+OBJECT_CACHE_LOCAL_TIMEOUT = 2
+OBJECT_CACHE_TIMEOUT = 300
+
+# requests taking at least SLOW_REQUEST_THRESHOLD_MS are logged as slow_request with their SQL and elasticsearch
+# queries, at most SLOW_REQUEST_MAX_QUERIES of them, each cut to SLOW_REQUEST_MAX_QUERY_LENGTH characters.
+# SQL parameters are never logged
+SLOW_REQUEST_THRESHOLD_MS = 500
+SLOW_REQUEST_MAX_QUERIES = 100
+SLOW_REQUEST_MAX_QUERY_LENGTH = 2000
+# the postgres plan of SQL queries taking at least SLOW_QUERY_THRESHOLD_MS is logged as slow_query_plan,
+# once per query (whatever its parameters) every SLOW_QUERY_EXPLAIN_INTERVAL seconds.
+# Plans are made by a thread of each worker after the response, at most SLOW_QUERY_EXPLAIN_QUEUE_SIZE queries wait for it
+SLOW_QUERY_THRESHOLD_MS = 100
+SLOW_QUERY_EXPLAIN_INTERVAL = 3600
+SLOW_QUERY_EXPLAIN_QUEUE_SIZE = 100
+# send the time spent in the database, elasticsearch, serializers and rendering in the Server-Timing header
+SERVER_TIMING_HEADER = True
+
+# directory where each gunicorn worker, and the refill_team_pool and drain_search_index loops, write their metrics,
+# at most every METRICS_FLUSH_INTERVAL seconds, so the metrics endpoints add up all processes. It is shared by
+# their containers, each writing in a directory named after its host. Files of exited processes are merged into
+# archive.json. Without it, the endpoints only show the worker answering the request
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = 1
+# addresses allowed to read metrics/prometheus without an admin token
+METRICS_ALLOWED_NETWORKS = ['127.0.0.1/32', '::1/128']
+
+# admin role users get a profile of a request by sending the X-Profile header or ?profile=1.
+# Its stack is sampled every PROFILER_INTERVAL seconds for at most PROFILER_MAX_SECONDS, and written to PROFILER_DIR.
+# A worker profiles one request at a time, and all workers at most PROFILER_MAX_PER_MINUTE requests
+PROFILER_DIR = os.path.join(BASE_DIR, "logs", "profiles")
+PROFILER_INTERVAL = 0.005
+PROFILER_MAX_SECONDS = 30
+PROFILER_MAX_PER_MINUTE = 6
+
+# results of manage.py benchmark to compare with, and the slowdown against them it fails on (0.2 for 20%)
+BENCHMARK_BASELINE = os.path.join(BASE_DIR, "benchmarks", "baseline.json")
+BENCHMARK_TOLERANCE = 0.2
+
+# clients may ask for smaller or bigger pages with ?page_size=, up to this limit
+API_MAX_PAGE_SIZE = 1000
+
+# views running more queries than their max_queries log a warning, or fail when strict (as in tests)
+API_QUERY_BUDGET_STRICT = False
+
 elk_base_url = 'elasticsearch://{user_name}:{password}@{host_ip}:{host_port}'
 elastic_search_url = elk_base_url.format(user_name='elastic',
                                          password=urlquote('6PjUc8BTe5E9Hg1bwEp2'),
                                          # password may contain special characters
                                          host_ip='localhost',
                                          host_port=9200)
+# seconds a search request may wait for elasticsearch before the database answers it
+SEARCH_REQUEST_TIMEOUT = 0.5
 ELASTICSEARCH_DSL = {
     'default': {
         'hosts': 'es:9200'
     },
+    # client of the API searches, created once per worker and reused: a small keep-alive pool, no retries
+    'search': {
+        'hosts': 'es:9200',
+        'timeout': SEARCH_REQUEST_TIMEOUT,
+        'max_retries': 0,
+        'retry_on_timeout': False,
+        'maxsize': 2,
+    },
+}
+SEARCH_CONNECTION = 'search'
+# backend of each search: elasticsearch (transfers only), postgres (full text and trigram indexes) or database (any database).
+# Deployments without an elasticsearch node use postgres for both. postgres is answered by database on other databases
+SEARCH_BACKENDS = {
+    'transfers': 'elasticsearch',
+    'players': 'postgres',
 }
+# answers elasticsearch searches while it is failing
+SEARCH_FALLBACK_BACKEND = 'postgres'
+# searches go to the database for SEARCH_BREAKER_RESET_TIMEOUT seconds after this many elasticsearch failures in a row
+SEARCH_BREAKER_FAILURE_THRESHOLD = 5
+SEARCH_BREAKER_RESET_TIMEOUT = 30
+# autocomplete suggestions per request by default and at most, and seconds a prefix's suggestions stay cached
+SEARCH_AUTOCOMPLETE_SIZE = 10
+SEARCH_AUTOCOMPLETE_MAX_SIZE = 25
+SEARCH_AUTOCOMPLETE_MAX_LENGTH = 50
+SEARCH_AUTOCOMPLETE_CACHE_TIMEOUT = 30
+# facets of transfer/facets: price histogram interval, age ranges (from inclusive, to exclusive, None unbounded),
+# values counted per category and country, and seconds the facets of the same filters stay cached
+SEARCH_FACET_PRICE_INTERVAL = 1000000
+SEARCH_FACET_AGE_RANGES = [(None, 21), (21, 26), (26, 31), (31, None)]
+SEARCH_FACET_TERMS_SIZE = 250
+SEARCH_FACETS_CACHE_TIMEOUT = 5
+
+# documents are reindexed on save only when one of their Django.tracked_fields changed,
+# writes are queued in the outbox table and sent to Elasticsearch by the drain_search_index command
+ELASTICSEARCH_DSL_SIGNAL_PROCESSOR = 'app.signals.QueuedSignalProcessor'
+SEARCH_INDEX_DRAIN_BATCH_SIZE = 500
 
 # Documentation: https://documenter.getpostman.com/view/2726228/Tzm9iDyj
@@ -1,3 +1,11 @@
 from ._base import *
 
 DEBUG = True
+
+API_QUERY_BUDGET_STRICT = True
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}